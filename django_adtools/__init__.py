@@ -6,5 +6,7 @@ __date__ = '2020-06-05'
 
 from . import ad_tools
 from . import discover_dc
-
-
+from . import ldap_pool
+from . import caches
+from . import async_ad_tools
+from . import circuit_breaker
@@ -0,0 +1,492 @@
+"""
+django_adtools/ad_sync.py
+
+Mirrors users and groups of Active Directory into ADUser and ADGroup models,
+members of groups into ADMembership model
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-08"
+
+import uuid
+import datetime
+import logging
+from .ldap_compat import ldap
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from .ad_tools import paged_search, _ldap_bind, _domain_base, FAILOVER_ERRORS
+from .models import ADUser, ADGroup, ADMembership, SyncState
+from .membership import get_default_membership_index
+# type hints
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+USER_FILTER: str = '(&(objectCategory=person)(objectClass=user))'  #: the search filter of users
+GROUP_FILTER: str = '(objectClass=group)'  #: the search filter of groups
+USER_ATTRIBUTES: List[str] = [
+    'objectGUID', 'sAMAccountName', 'userPrincipalName', 'givenName', 'sn', 'displayName', 'mail',
+    'userAccountControl', 'uSNChanged',
+]
+GROUP_ATTRIBUTES: List[str] = ['objectGUID', 'sAMAccountName', 'description', 'member', 'uSNChanged']
+ACCOUNTDISABLE: int = 0x2  #: the flag of userAccountControl of a disabled account
+#: the control which makes a search return deleted objects (tombstones)
+LDAP_SERVER_SHOW_DELETED_OID: str = '1.2.840.113556.1.4.417'
+
+Entry = Tuple[str, Dict[str, List[bytes]]]  #: a distinguished name and attributes of an entry
+
+
+def _value(entry: Dict[str, List[bytes]], name: str, default: str = '') -> str:
+    """
+    Returns the first value of the attribute decoded from utf-8
+    """
+    values: List[bytes] = entry.get(name) or []
+    return values[0].decode('utf-8', errors='replace') if values else default
+
+
+def object_guid(value: bytes) -> str:
+    """
+    Returns the string form of an objectGUID attribute, e.g. **f81d4fae-7dec-11d0-a765-00a0c91e6bf6**
+
+    :param value: the binary value of objectGUID
+    :type value: bytes
+    :rtype: str
+    """
+    return str(uuid.UUID(bytes_le=value))
+
+
+def user_fields(dn: str, entry: Dict[str, List[bytes]]) -> Dict[str, Any]:
+    """
+    Maps attributes of a user entry to fields of ADUser model
+
+    :param dn: a distinguished name of the user
+    :type dn: str
+    :param entry: attributes of the user
+    :type entry: Dict[str, List[bytes]]
+    :rtype: Dict[str, Any]
+    """
+    return {
+        'object_guid': object_guid(entry['objectGUID'][0]),
+        'dn': dn,
+        'username': _value(entry, 'sAMAccountName'),
+        'user_principal_name': _value(entry, 'userPrincipalName'),
+        'first_name': _value(entry, 'givenName'),
+        'last_name': _value(entry, 'sn'),
+        'display_name': _value(entry, 'displayName'),
+        'email': _value(entry, 'mail'),
+        'is_active': not int(_value(entry, 'userAccountControl', '0')) & ACCOUNTDISABLE,
+        'usn_changed': int(_value(entry, 'uSNChanged', '0')),
+    }
+
+
+def group_fields(dn: str, entry: Dict[str, List[bytes]]) -> Dict[str, Any]:
+    """
+    Maps attributes of a group entry to fields of ADGroup model
+
+    :param dn: a distinguished name of the group
+    :type dn: str
+    :param entry: attributes of the group
+    :type entry: Dict[str, List[bytes]]
+    :rtype: Dict[str, Any]
+    """
+    return {
+        'object_guid': object_guid(entry['objectGUID'][0]),
+        'dn': dn,
+        'name': _value(entry, 'sAMAccountName'),
+        'description': _value(entry, 'description'),
+        'usn_changed': int(_value(entry, 'uSNChanged', '0')),
+    }
+
+
+def group_members(conn: ldap.ldapobject.SimpleLDAPObject, dn: str, entry: Dict[str, List[bytes]]) -> List[str]:
+    """
+    Returns distinguished names of members of the group in lowercase.
+    Active Directory returns at most MaxValRange (1500) values of the member attribute of a large group
+    as **member;range=0-1499**, the next ranges are read by base searches of the group,
+    so it must not be called while a paged search of the connection is outstanding (see has_more_ranges)
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param dn: a distinguished name of the group
+    :type dn: str
+    :param entry: attributes of the group
+    :type entry: Dict[str, List[bytes]]
+    :rtype: List[str]
+    :raises ldap.LDAPError: if a search of a range failed
+    """
+    values: List[bytes] = list(entry.get('member') or [])
+    ranged: Optional[str] = _ranged(entry)
+    while ranged is not None:
+        values.extend(entry[ranged])
+        end: str = ranged.rsplit('-', 1)[-1]
+        if end == '*':
+            break
+        attribute: str = f'member;range={int(end) + 1}-*'
+        results = conn.search_s(dn, ldap.SCOPE_BASE, '(objectClass=group)', [attribute])
+        entry = next((x for y, x in results if y is not None), {})
+        ranged = _ranged(entry)
+    return [x.decode('utf-8').lower() for x in values]
+
+
+def _ranged(entry: Dict[str, List[bytes]]) -> Optional[str]:
+    """
+    Returns the name of a range of the member attribute, e.g. **member;range=0-1499**
+    """
+    return next((x for x in entry if x.lower().startswith('member;range=')), None)
+
+
+def has_more_ranges(entry: Dict[str, List[bytes]]) -> bool:
+    """
+    True if group_members has to search the next ranges of the member attribute of the group
+    """
+    ranged: Optional[str] = _ranged(entry)
+    return ranged is not None and not ranged.endswith('-*')
+
+
+def write_memberships(conn: ldap.ldapobject.SimpleLDAPObject,
+                      entries: List[Entry],
+                      counts: Dict[str, int],
+                      deferred: Optional[List[Entry]] = None,
+                      ) -> None:
+    """
+    Makes rows of ADMembership of the groups equal to their member attributes,
+    rows of the groups must be written before
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param entries: entries of groups
+    :type entries: List[Entry]
+    :param counts: a dict with keys: created, deleted, numbers of written rows are added to it
+    :type counts: Dict[str, int]
+    :param deferred: if it is given, groups with more ranges of the member attribute are appended to it
+        instead of being written, e.g. while the paged search of the groups is outstanding on the connection.
+        They are written by the next call after the search, defaults to **None**
+    :type deferred: List[Entry], optional
+    """
+    if deferred is not None:
+        deferred.extend(x for x in entries if has_more_ranges(x[1]))
+        entries = [x for x in entries if not has_more_ranges(x[1])]
+    members: Dict[str, List[str]] = {
+        object_guid(entry['objectGUID'][0]): group_members(conn, dn, entry) for dn, entry in entries
+    }
+    group_ids: Dict[str, int] = dict(
+        ADGroup.objects.filter(object_guid__in=list(members)).values_list('object_guid', 'pk')
+    )
+    existing: Dict[Tuple[int, str], int] = {
+        (group_id, member_dn): pk for pk, group_id, member_dn in ADMembership.objects.filter(
+            group_id__in=list(group_ids.values())
+        ).values_list('pk', 'group_id', 'member_dn')
+    }
+    wanted: set = {(group_ids[guid], dn) for guid, dns in members.items() if guid in group_ids for dn in dns}
+    creates: List[ADMembership] = [ADMembership(group_id=group_id, member_dn=dn) for group_id, dn in wanted
+                                   if (group_id, dn) not in existing]
+    deletes: List[int] = [pk for key, pk in existing.items() if key not in wanted]
+    with transaction.atomic():
+        ADMembership.objects.bulk_create(creates)
+        if deletes:
+            ADMembership.objects.filter(pk__in=deletes).delete()
+    counts['created'] += len(creates)
+    counts['deleted'] += len(deletes)
+
+
+def _write_batch(model: type, batch: List[Dict[str, Any]], synced: datetime.datetime) -> Tuple[int, int]:
+    """
+    Creates new rows and updates changed ones of one batch, unchanged rows get only the new sync time
+
+    :return: numbers of created and updated rows
+    """
+    existing: Dict[str, models.Model] = model.objects.filter(
+        object_guid__in=[fields['object_guid'] for fields in batch]
+    ).in_bulk(field_name='object_guid')
+    creates: List[models.Model] = []
+    updates: List[models.Model] = []
+    unchanged: List[int] = []
+    for fields in batch:
+        obj = existing.get(fields['object_guid'])
+        if obj is None:
+            creates.append(model(synced=synced, **fields))
+        elif any(getattr(obj, name) != value for name, value in fields.items()):
+            for name, value in fields.items():
+                setattr(obj, name, value)
+            obj.synced = synced
+            updates.append(obj)
+        else:
+            unchanged.append(obj.pk)
+    with transaction.atomic():
+        model.objects.bulk_create(creates)
+        if updates:
+            model.objects.bulk_update(updates, fields=list(batch[0].keys()) + ['synced'])
+        if unchanged:
+            model.objects.filter(pk__in=unchanged).update(synced=synced)
+    return len(creates), len(updates)
+
+
+def sync_entries(model: type,
+                 entries: Iterable[Entry],
+                 to_fields: Callable[[str, Dict[str, List[bytes]]], Dict[str, Any]],
+                 synced: datetime.datetime,
+                 batch_size: int = 1000,
+                 after_batch: Optional[Callable[[List[Entry]], None]] = None,
+                 ) -> Dict[str, int]:
+    """
+    Writes entries to the model in batches, so at most **batch_size** entries are kept in memory
+
+    :param model: ADUser or ADGroup
+    :type model: type
+    :param entries: an iterator of entries, e.g. from paged_search
+    :type entries: Iterable[Entry]
+    :param to_fields: maps an entry to fields of the model, the fields must contain **object_guid**
+    :type to_fields: Callable
+    :param synced: the start time of the sync, it is stored in every row seen
+    :type synced: datetime.datetime
+    :param batch_size: number of entries written at once, defaults to **1000**
+    :type batch_size: int
+    :param after_batch: a function called with entries of every written batch, defaults to **None**
+    :type after_batch: Callable[[List[Entry]], None], optional
+    :return: a dict with keys: created, updated
+    :rtype: Dict[str, int]
+    """
+    counts: Dict[str, int] = {'created': 0, 'updated': 0}
+    batch: List[Dict[str, Any]] = []
+    raw: List[Entry] = []
+    for dn, entry in entries:
+        if not entry.get('objectGUID'):
+            logger.warning(f'{__package__} sync_entries skipped an entry without objectGUID dn={dn}')
+            continue
+        batch.append(to_fields(dn, entry))
+        raw.append((dn, entry))
+        if len(batch) >= batch_size:
+            _flush(model, batch, raw, synced, counts, after_batch)
+            batch, raw = [], []
+    if batch:
+        _flush(model, batch, raw, synced, counts, after_batch)
+    return counts
+
+
+def _flush(model: type,
+           batch: List[Dict[str, Any]],
+           raw: List[Entry],
+           synced: datetime.datetime,
+           counts: Dict[str, int],
+           after_batch: Optional[Callable[[List[Entry]], None]],
+           ) -> None:
+    created, updated = _write_batch(model, batch, synced)
+    counts['created'] += created
+    counts['updated'] += updated
+    if after_batch is not None:
+        after_batch(raw)
+
+
+def _write_deferred(conn: ldap.ldapobject.SimpleLDAPObject,
+                    deferred: List[Entry],
+                    counts: Dict[str, int],
+                    batch_size: int,
+                    ) -> None:
+    """
+    Writes memberships of groups deferred by write_memberships, the paged search of the groups must be completed
+    """
+    for i in range(0, len(deferred), batch_size):
+        write_memberships(conn, deferred[i:i + batch_size], counts)
+    deferred.clear()
+
+
+def full_sync(conn: ldap.ldapobject.SimpleLDAPObject,
+              domain: str,
+              page_size: int = 1000,
+              batch_size: int = 1000,
+              ) -> Dict[str, Dict[str, int]]:
+    """
+    Reads all users and groups of the domain, rows of entries which were not found are deleted
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param domain: full name of active directory domain
+    :type domain: str
+    :param page_size: number of entries requested at once, defaults to **1000**
+    :type page_size: int
+    :param batch_size: number of rows written at once, defaults to **1000**
+    :type batch_size: int
+    :return: model name -> a dict with keys: created, updated, deleted;
+        ADMembership -> a dict with keys: created, deleted
+    :rtype: Dict[str, Dict[str, int]]
+    :raises ldap.LDAPError: if a search failed, rows are not deleted in this case
+    """
+    synced: datetime.datetime = timezone.now()
+    memberships: Dict[str, int] = {'created': 0, 'deleted': 0}
+    deferred: List[Entry] = []  # groups with ranges of members, they are read after the paged search
+    result: Dict[str, Dict[str, int]] = {}
+    for model, search_filter, attributes, to_fields, after_batch in (
+            (ADGroup, GROUP_FILTER, GROUP_ATTRIBUTES, group_fields,
+             lambda batch: write_memberships(conn, batch, memberships, deferred=deferred)),
+            (ADUser, USER_FILTER, USER_ATTRIBUTES, user_fields, None),
+    ):
+        entries: Iterable[Entry] = paged_search(
+            conn, _domain_base(domain), search_filter, attributes, page_size=page_size,
+        )
+        counts: Dict[str, int] = sync_entries(model, entries, to_fields, synced, batch_size=batch_size,
+                                              after_batch=after_batch)
+        _write_deferred(conn, deferred, memberships, batch_size)
+        counts['deleted'] = model.objects.filter(synced__lt=synced).delete()[0]  # with memberships of groups
+        logger.info(f'{__package__} full_sync {model.__name__} {counts}')
+        result[model.__name__] = counts
+    result[ADMembership.__name__] = memberships
+    return result
+
+
+def highest_committed_usn(conn: ldap.ldapobject.SimpleLDAPObject) -> int:
+    """
+    Returns the highest update sequence number committed by the domain controller (from its rootDSE)
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :rtype: int
+    :raises ldap.LDAPError: if the rootDSE can not be read
+    """
+    for dn, entry in conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['highestCommittedUSN']):
+        if dn is not None and entry.get('highestCommittedUSN'):
+            return int(entry['highestCommittedUSN'][0])
+    raise ldap.OPERATIONS_ERROR({'desc': 'highestCommittedUSN is not available'})
+
+
+def _changed_filter(search_filter: str, usn: int) -> str:
+    """
+    Returns the search filter of entries changed after the update sequence number
+    """
+    return '(&%s(uSNChanged>=%d))' % (search_filter, usn + 1)
+
+
+def incremental_sync(conn: ldap.ldapobject.SimpleLDAPObject,
+                     domain: str,
+                     usn: int,
+                     page_size: int = 1000,
+                     batch_size: int = 1000,
+                     ) -> Dict[str, Dict[str, int]]:
+    """
+    Reads users and groups changed after the update sequence number, deletes rows of entries
+    which were deleted after it (their tombstones are read using the Show Deleted control).
+    The update sequence number must be read from the same domain controller
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param domain: full name of active directory domain
+    :type domain: str
+    :param usn: highestCommittedUSN of the domain controller at the start of the previous sync
+    :type usn: int
+    :param page_size: number of entries requested at once, defaults to **1000**
+    :type page_size: int
+    :param batch_size: number of rows written at once, defaults to **1000**
+    :type batch_size: int
+    :return: model name -> a dict with keys: created, updated, deleted;
+        ADMembership -> a dict with keys: created, deleted
+    :rtype: Dict[str, Dict[str, int]]
+    :raises ldap.LDAPError: if a search failed
+    """
+    synced: datetime.datetime = timezone.now()
+    base: str = _domain_base(domain)
+    memberships: Dict[str, int] = {'created': 0, 'deleted': 0}
+    deferred: List[Entry] = []  # groups with ranges of members, they are read after the paged search
+    result: Dict[str, Dict[str, int]] = {}
+    for model, search_filter, attributes, to_fields, after_batch in (
+            (ADGroup, GROUP_FILTER, GROUP_ATTRIBUTES, group_fields,
+             lambda batch: write_memberships(conn, batch, memberships, deferred=deferred)),
+            (ADUser, USER_FILTER, USER_ATTRIBUTES, user_fields, None),
+    ):
+        entries: Iterable[Entry] = paged_search(
+            conn, base, _changed_filter(search_filter, usn), attributes, page_size=page_size,
+        )
+        result[model.__name__] = sync_entries(model, entries, to_fields, synced, batch_size=batch_size,
+                                              after_batch=after_batch)
+        _write_deferred(conn, deferred, memberships, batch_size)
+        result[model.__name__]['deleted'] = 0
+    result[ADMembership.__name__] = memberships
+    tombstones: Iterable[Entry] = paged_search(
+        conn, base, _changed_filter('(isDeleted=TRUE)', usn), ['objectGUID'], page_size=page_size,
+        controls=[ldap.controls.LDAPControl(LDAP_SERVER_SHOW_DELETED_OID, True, None)],
+    )
+    batch: List[str] = []
+    for dn, entry in tombstones:
+        if entry.get('objectGUID'):
+            batch.append(object_guid(entry['objectGUID'][0]))
+        if len(batch) >= batch_size:
+            _delete_batch(batch, result)
+            batch = []
+    _delete_batch(batch, result)
+    logger.info(f'{__package__} incremental_sync usn={usn} {result}')
+    return result
+
+
+def _delete_batch(guids: List[str], result: Dict[str, Dict[str, int]]) -> None:
+    """
+    Deletes rows of deleted entries, counts them in the result
+    """
+    if not guids:
+        return
+    for model in (ADGroup, ADUser):
+        result[model.__name__]['deleted'] += model.objects.filter(object_guid__in=guids).delete()[0]
+
+
+def sync(conn: ldap.ldapobject.SimpleLDAPObject,
+         dc: str,
+         domain: str,
+         page_size: int = 1000,
+         batch_size: int = 1000,
+         full: bool = False,
+         ) -> Dict[str, Dict[str, int]]:
+    """
+    Performs the incremental sync if the domain controller has been synced before, otherwise the full sync.
+    highestCommittedUSN read before the searches is stored in SyncState model,
+    so changes made during the sync are read again next time.
+    The membership index of the process is refreshed if it has been loaded
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param dc: a hostname or an ip address of the domain controller of the connection
+    :type dc: str
+    :param domain: full name of active directory domain
+    :type domain: str
+    :param page_size: number of entries requested at once, defaults to **1000**
+    :type page_size: int
+    :param batch_size: number of rows written at once, defaults to **1000**
+    :type batch_size: int
+    :param full: perform the full sync anyway, defaults to **False**
+    :type full: bool
+    :return: model name -> a dict with keys: created, updated, deleted
+    :rtype: Dict[str, Dict[str, int]]
+    :raises ldap.LDAPError: if a search failed, the high-water mark is not changed in this case
+    """
+    usn: int = highest_committed_usn(conn)
+    state: Optional[SyncState] = SyncState.objects.filter(dc=dc).first()
+    if full or state is None:
+        result: Dict[str, Dict[str, int]] = full_sync(conn, domain, page_size=page_size, batch_size=batch_size)
+    else:
+        result = incremental_sync(conn, domain, state.highest_usn, page_size=page_size, batch_size=batch_size)
+    SyncState.objects.update_or_create(dc=dc, defaults={'highest_usn': usn, 'synced': timezone.now()})
+    if get_default_membership_index().loaded:
+        get_default_membership_index().refresh()
+    return result
+
+
+def service_connection(dcs: List[str]) -> Tuple[str, ldap.ldapobject.SimpleLDAPObject]:
+    """
+    Connects to the first available domain controller using the service account
+    configured by ADTOOLS_BIND_USERNAME and ADTOOLS_BIND_PASSWORD settings
+
+    :param dcs: domain controllers ordered from the best one
+    :type dcs: List[str]
+    :return: the domain controller and the bound connection
+    :rtype: Tuple[str, ldap.ldapobject.SimpleLDAPObject]
+    :raises ldap.LDAPError: if no domain controller is available or the service account can not bind
+    """
+    error: ldap.LDAPError = ldap.SERVER_DOWN({'desc': 'no domain controllers'})
+    for dc in dcs:
+        try:
+            return dc, _ldap_bind(
+                dc=dc,
+                username=getattr(settings, 'ADTOOLS_BIND_USERNAME', ''),
+                password=getattr(settings, 'ADTOOLS_BIND_PASSWORD', ''),
+            )
+        except FAILOVER_ERRORS as e:
+            logger.error(f'{__package__} service_connection domain controller is not available: {str(e)}, dc={dc}')
+            error = e
+    raise error
@@ -4,19 +4,28 @@ django_adtools/ad_tools.py
 Some tools to use
 
 REQUIREMENTS:
-   pip install python-ldap  # on linux
+   pip install python-ldap  # on linux, not required by ADTOOLS_LDAP_BACKEND = 'pure'
    # on Windows download compiled package for your system from https://www.lfd.uci.edu/~gohlke/pythonlibs/#python-ldap
 """
 __author__ = "shmakovpn <shmakovpn@yandex.ru>"
 __date__ = "2020-04-15"
 
 import re
-import ldap
-import ldap.filter  # escaping character in ldap requests
+from .ldap_compat import ldap
 import logging
+from contextlib import closing
+from .ldap_pool import LDAPConnectionPool, LDAPPoolExhausted, ldap_uri, apply_deadline
+from .ldap_backends import initialize
+from .tls import apply_tls
+from .deadline import Deadline, DeadlineExceeded, as_deadline
+from .caches import CredentialCache, GroupCache
+from .circuit_breaker import CircuitBreaker
+from .throttle import LoginThrottle
+from .instrumentation import phase, PHASE_LOGIN, PHASE_BIND, PHASE_USER_DN, PHASE_DN_GROUPS, PHASE_USER_DN_GROUPS
 # type hints
-from typing import TypeVar, List, Tuple, Dict
+from typing import TypeVar, List, Tuple, Dict, Optional, Union, Iterator, Iterable
 LdapSearchResult = List[Tuple[str, Dict[str, List[bytes]]]]  # the type of an ldap search result
+LdapEntry = Tuple[str, Dict[str, List[bytes]]]  # the type of an entry of an ldap search result
 LDAP_CONNECTION = TypeVar('LDAP_CONNECTION', ldap.ldapobject.SimpleLDAPObject, type(None))
 
 domain_suffix_pattern = re.compile(r'@.*$')  #: pattern for domain suffix
@@ -25,6 +34,17 @@ domain_prefix_pattern = re.compile(r'^[^\\]*\\')  #: patter for domain prefix
 #: logger for this __package__
 logger = logging.getLogger(__package__)
 
+#: the Active Directory matching rule that walks the chain of nested group membership
+LDAP_MATCHING_RULE_IN_CHAIN: str = '1.2.840.113556.1.4.1941'
+
+GROUP_RESOLUTION_SEARCH: str = 'search'  #: user_dn, then dn_groups (direct groups only)
+GROUP_RESOLUTION_NESTED: str = 'nested'  #: user_dn, then dn_groups with nested=True (direct and nested groups)
+GROUP_RESOLUTION_MEMBER_OF: str = 'member_of'  #: user_dn_groups, one search (direct groups only, common names)
+GROUP_RESOLUTIONS: Tuple[str, ...] = (GROUP_RESOLUTION_SEARCH, GROUP_RESOLUTION_NESTED, GROUP_RESOLUTION_MEMBER_OF)
+
+#: errors which mean that a domain controller is not available, ad_login fails over to the next one
+FAILOVER_ERRORS: Tuple[type, ...] = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR, ldap.UNAVAILABLE, ldap.BUSY)
+
 
 def ad_clear_username(username: str) -> str:
     """
@@ -40,7 +60,7 @@ def ad_clear_username(username: str) -> str:
     return username
 
 
-def ldap_connect(dc: str, username: str, password: str) -> LDAP_CONNECTION:
+def ldap_connect(dc: str, username: str, password: str, timeout: Optional[float] = None) -> LDAP_CONNECTION:
     """
     Inits ldap connection, binds to ldap using username and password, returns ldap connection if binding was ok
 
@@ -50,16 +70,13 @@ def ldap_connect(dc: str, username: str, password: str) -> LDAP_CONNECTION:
     :type username: str
     :param password: an active directory user password
     :type password: str
+    :param timeout: seconds for the connection and the bind, defaults to **None** (no limit)
+    :type timeout: float, optional
     :return: ldap connection if binding was ok, None otherwise
     :rtype: ldap.ldapobject.SimpleLDAPObject
     """
-    ldap_connection: ldap.ldapobject.SimpleLDAPObject = ldap.initialize('ldap://%s' % dc)
-    # ldap_connection.protocol_version = 3
-    ldap_connection.set_option(ldap.OPT_REFERRALS, 0)
-    # ldap_connection.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
     try:
-        ldap_connection.bind_s(username, password)
-        return ldap_connection
+        return _ldap_bind(dc=dc, username=username, password=password, deadline=as_deadline(timeout))
     except ldap.INVALID_CREDENTIALS:
         logger.warning(f'{__package__} ldap_connect failed, ldap.INVALID_CREDENTIALS '
                        f'dc={dc}, username={username}, password={password}')
@@ -67,9 +84,188 @@ def ldap_connect(dc: str, username: str, password: str) -> LDAP_CONNECTION:
     except ldap.SERVER_DOWN:
         logger.error(f'{__package__} ldap_connect failed, ldap.SERVER_DOWN dc={dc}')
         return None
+    except (ldap.TIMEOUT, DeadlineExceeded):
+        logger.error(f'{__package__} ldap_connect failed, timeout={timeout} exceeded dc={dc}')
+        return None
 
 
-def user_dn(conn: ldap.ldapobject.SimpleLDAPObject, username: str, domain: str) -> str:
+def _ldap_bind(dc: str, username: str, password: str, deadline: Optional[Deadline] = None
+               ) -> ldap.ldapobject.SimpleLDAPObject:
+    """
+    Inits ldap connection, binds to ldap using username and password
+
+    :param deadline: limits the connection and the bind by seconds left, defaults to **None**
+    :type deadline: Deadline, optional
+    :return: the bound ldap connection
+    :raises ldap.LDAPError: if binding failed
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    ldap_connection: ldap.ldapobject.SimpleLDAPObject = initialize(ldap_uri(dc))
+    # ldap_connection.protocol_version = 3
+    ldap_connection.set_option(ldap.OPT_REFERRALS, 0)
+    try:
+        if deadline is not None:
+            ldap_connection.set_option(ldap.OPT_NETWORK_TIMEOUT, deadline.check('connect'))
+        apply_tls(ldap_connection)
+        if deadline is not None:
+            apply_deadline(ldap_connection, deadline, 'bind')
+        ldap_connection.bind_s(username, password)
+    except BaseException:
+        _unbind(ldap_connection)
+        raise
+    return ldap_connection
+
+
+def _unbind(conn: ldap.ldapobject.SimpleLDAPObject) -> None:
+    """
+    Closes the connection, errors are ignored because the connection may be broken already
+    """
+    try:
+        conn.unbind_s()
+    except ldap.LDAPError:
+        pass
+
+
+def _domain_base(domain: str) -> str:
+    """
+    Returns the search base of the domain, e.g. **dc=example,dc=com** for **example.com**
+    """
+    return ','.join('dc=%s' % x for x in domain.split('.'))
+
+
+def _user_filter(username: str) -> str:
+    """
+    Returns the search filter of the user entry by username
+    """
+    return '(|(&(objectClass=person)(sAMAccountName=%s)))' % ldap.filter.escape_filter_chars(
+        ad_clear_username(username)
+    )
+
+
+def _groups_filter(dn: str, nested: bool) -> str:
+    """
+    Returns the search filter of groups whose user with DN is member of
+    """
+    member: str = 'member:%s:' % LDAP_MATCHING_RULE_IN_CHAIN if nested else 'member'
+    return '(|(&(objectClass=group)(%s=%s)))' % (member, ldap.filter.escape_filter_chars(dn))
+
+
+def _member_of_names(attributes: Dict[str, List[bytes]]) -> List[str]:
+    """
+    Returns common names of groups from the memberOf attribute
+    """
+    return [ldap.dn.str2dn(group_dn.decode())[0][0][1] for group_dn in attributes.get('memberOf', [])]
+
+
+def search_iter(conn: ldap.ldapobject.SimpleLDAPObject,
+                base: str,
+                search_filter: str,
+                attributes: Optional[List[str]] = None,
+                scope: int = ldap.SCOPE_SUBTREE,
+                page_size: int = 0,
+                controls: Optional[List[ldap.controls.RequestControl]] = None,
+                deadline: Optional[Deadline] = None,
+                ) -> Iterator[LdapEntry]:
+    """
+    Yields entries found by the search one by one as they arrive from the domain controller.
+    Search references (referrals) are skipped. If the iteration is stopped early (the generator is closed),
+    the search is abandoned, so the domain controller stops sending entries.
+    With **page_size** the search is performed page by page using the Simple Paged Results control,
+    so a result set larger than the size limit of a domain controller (1000 entries by default) is read completely
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param base: a search base, e.g. **dc=example,dc=com**
+    :type base: str
+    :param search_filter: a search filter
+    :type search_filter: str
+    :param attributes: names of attributes to request, defaults to **None** (all attributes)
+    :type attributes: List[str], optional
+    :param scope: a search scope, defaults to **ldap.SCOPE_SUBTREE**
+    :type scope: int
+    :param page_size: number of entries in a page, defaults to **0** (the search is not paged)
+    :type page_size: int
+    :param controls: other server controls of the search, defaults to **None**
+    :type controls: List[ldap.controls.RequestControl], optional
+    :param deadline: every wait for results (of every page) is limited by seconds left, defaults to **None**
+    :type deadline: Deadline, optional
+    :return: an iterator of (distinguished name, attributes)
+    :rtype: Iterator[LdapEntry]
+    :raises ldap.LDAPError: if the search failed
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    page_control: Optional[ldap.controls.SimplePagedResultsControl] = ldap.controls.SimplePagedResultsControl(
+        True, size=page_size, cookie='',
+    ) if page_size else None
+    while True:
+        server_controls: List[ldap.controls.RequestControl] = ([page_control] if page_control else []) + (
+            controls or [])
+        apply_deadline(conn, deadline, 'search')
+        msgid: int = conn.search_ext(base, scope, search_filter, attributes, serverctrls=server_controls or None)
+        completed: bool = False
+        try:
+            while not completed:
+                if deadline is None:
+                    result_type, results, _, response_controls = conn.result3(msgid, all=0)
+                else:
+                    result_type, results, _, response_controls = conn.result3(msgid, all=0,
+                                                                              timeout=deadline.check('search'))
+                completed = result_type == ldap.RES_SEARCH_RESULT
+                if result_type == ldap.RES_SEARCH_REFERENCE:
+                    continue
+                for dn, entry in results or []:
+                    if dn is not None:
+                        yield dn, entry
+        finally:
+            if not completed:
+                try:
+                    conn.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
+        if page_control is None:
+            return
+        cookies: List[bytes] = [
+            control.cookie for control in response_controls or []
+            if control.controlType == ldap.controls.SimplePagedResultsControl.controlType
+        ]
+        if not cookies or not cookies[0]:
+            return
+        page_control.cookie = cookies[0]
+
+
+def paged_search(conn: ldap.ldapobject.SimpleLDAPObject,
+                 base: str,
+                 search_filter: str,
+                 attributes: List[str],
+                 page_size: int = 1000,
+                 scope: int = ldap.SCOPE_SUBTREE,
+                 controls: Optional[List[ldap.controls.RequestControl]] = None,
+                 ) -> Iterator[LdapEntry]:
+    """
+    Yields entries found by the search page by page, the same as search_iter with **page_size** defaults to **1000**
+
+    :return: an iterator of (distinguished name, attributes)
+    :rtype: Iterator[LdapEntry]
+    :raises ldap.LDAPError: if the search failed
+    """
+    return search_iter(conn, base, search_filter, attributes, scope=scope, page_size=page_size, controls=controls)
+
+
+def _first_entry(conn: ldap.ldapobject.SimpleLDAPObject,
+                 base: str,
+                 search_filter: str,
+                 attributes: List[str],
+                 deadline: Optional[Deadline] = None,
+                 ) -> Optional[LdapEntry]:
+    """
+    Returns the first entry found by the search, the rest of the search is abandoned
+    """
+    with closing(search_iter(conn, base, search_filter, attributes, deadline=deadline)) as entries:
+        return next(entries, None)
+
+
+def user_dn(conn: ldap.ldapobject.SimpleLDAPObject, username: str, domain: str,
+            deadline: Optional[Deadline] = None) -> str:
     """
     Requests user DN from active directory by username
 
@@ -79,30 +275,32 @@ def user_dn(conn: ldap.ldapobject.SimpleLDAPObject, username: str, domain: str)
     :type username: str
     :param domain: full name of active directory domain
     :type domain: str
+    :param deadline: the search is limited by seconds left, defaults to **None**
+    :type deadline: Deadline, optional
     :return: distinguished name for username if success, empty string otherwise
     :rtype: str
+    :raises DeadlineExceeded: if the deadline has passed
     """
     if not conn:
         logger.error(f'{__package__} user_dn failed "conn" is null')
         return ''
-    ldap_base: str = ','.join('dc=%s' % x for x in domain.split('.'))
-    search_filter: str = '(|(&(objectClass=person)(sAMAccountName=%s)))' % ad_clear_username(username)
+    ldap_base: str = _domain_base(domain)
+    search_filter: str = _user_filter(username)
     try:
-        results: List[str] = list(
-            filter(lambda x: x[0] is not None, conn.search_s(ldap_base, ldap.SCOPE_SUBTREE, search_filter, ['']))
-        )
-        if not len(results):
+        result: Optional[LdapEntry] = _first_entry(conn, ldap_base, search_filter, [''], deadline=deadline)
+        if result is None:
             logger.warning(f'{__package__} user_dn failed:'
                            f' results is empty, ldap_base={ldap_base}, search_filter={search_filter}')
             return ''
-        return results[0][0]
+        return result[0]
     except ldap.OPERATIONS_ERROR as e:
         logger.error(f'{__package__} user_dn failed:'
                      f' {str(e)}, ldap_base={ldap_base}, search_filter={search_filter}')
         return ''
 
 
-def dn_groups(conn: ldap.ldapobject.SimpleLDAPObject, dn: str, domain: str) -> List[str]:
+def dn_groups(conn: ldap.ldapobject.SimpleLDAPObject, dn: str, domain: str, nested: bool = False,
+              deadline: Optional[Deadline] = None) -> List[str]:
     """
     Request group names from active directory by user DN
 
@@ -112,35 +310,177 @@ def dn_groups(conn: ldap.ldapobject.SimpleLDAPObject, dn: str, domain: str) -> L
     :type dn: str
     :param domain: full name of active directory domain
     :type domain: str
+    :param nested: include groups the user is a member of through other groups
+        (uses LDAP_MATCHING_RULE_IN_CHAIN), defaults to **False**
+    :type nested: bool
+    :param deadline: the search is limited by seconds left, defaults to **None**
+    :type deadline: Deadline, optional
     :return: list of group names whose user with DN is member of (SUCCESS), empty list otherwise
     :rtype: List[str]
+    :raises DeadlineExceeded: if the deadline has passed
     """
     if not conn:
         logger.error(f'django_adtool.ad.ad_tools dn_groups failed. "conn" is null. dn={dn}, domain={domain}')
         return []
-    ldap_base: str = ','.join('dc=%s' % x for x in domain.split('.'))
-    search_filter: str = '(|(&(objectClass=group)(member=%s)))' % ldap.filter.escape_filter_chars(dn)
+    ldap_base: str = _domain_base(domain)
+    search_filter: str = _groups_filter(dn, nested)
     try:
-        results: LdapSearchResult = list(
-            filter(
-                lambda x: x[0] is not None,
-                conn.search_s(ldap_base, ldap.SCOPE_SUBTREE, search_filter, ['sAMAccountName'])
-            )
-        )
-        if not results:
+        groups: List[str] = [
+            entry['sAMAccountName'][0].decode()
+            for _, entry in search_iter(conn, ldap_base, search_filter, ['sAMAccountName'], deadline=deadline)
+        ]
+        if not groups:
             logger.error(f'{__package__} dn_group failed. results is empty, dn={dn}, domain={domain}')
-        return [item[1]['sAMAccountName'][0].decode() for item in results]
+        return groups
     except ldap.OPERATIONS_ERROR as e:
         logger.error(f'{__package__} dn_group failed: {str(e)}, dn={dn}, domain={domain}')
         return []
 
 
-def ad_login(dc: str, username: str, password: str, domain: str, group: str) -> bool:
+def user_dn_groups(conn: ldap.ldapobject.SimpleLDAPObject, username: str, domain: str,
+                   deadline: Optional[Deadline] = None) -> Tuple[str, List[str]]:
+    """
+    Requests user DN and group names from active directory by username using one search.
+    Group names are taken from the memberOf attribute of the user,
+    so they are common names of groups the user is a direct member of (the primary group is not included)
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param username: an active directory username
+    :type username: str
+    :param domain: full name of active directory domain
+    :type domain: str
+    :param deadline: the search is limited by seconds left, defaults to **None**
+    :type deadline: Deadline, optional
+    :return: distinguished name and list of group names if success, empty string and empty list otherwise
+    :rtype: Tuple[str, List[str]]
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    if not conn:
+        logger.error(f'{__package__} user_dn_groups failed "conn" is null')
+        return '', []
+    ldap_base: str = _domain_base(domain)
+    search_filter: str = _user_filter(username)
+    try:
+        result: Optional[LdapEntry] = _first_entry(conn, ldap_base, search_filter, ['memberOf'], deadline=deadline)
+        if result is None:
+            logger.warning(f'{__package__} user_dn_groups failed:'
+                           f' results is empty, ldap_base={ldap_base}, search_filter={search_filter}')
+            return '', []
+        dn, attributes = result
+        groups: List[str] = _member_of_names(attributes)
+        if not groups:
+            logger.error(f'{__package__} user_dn_groups failed. memberOf is empty, dn={dn}, domain={domain}')
+        return dn, groups
+    except ldap.OPERATIONS_ERROR as e:
+        logger.error(f'{__package__} user_dn_groups failed:'
+                     f' {str(e)}, ldap_base={ldap_base}, search_filter={search_filter}')
+        return '', []
+
+
+def batch_user_groups(conn: ldap.ldapobject.SimpleLDAPObject,
+                      usernames: Iterable[str],
+                      domain: str,
+                      nested: bool = False,
+                      depth: int = 32,
+                      ) -> Dict[str, Tuple[str, List[str]]]:
+    """
+    Requests DNs and group names of many users over one connection. Searches are pipelined:
+    up to **depth** searches are sent without waiting for answers, so the time of the batch depends
+    on the pipeline depth rather than on the round trip time to the domain controller.
+
+    Without **nested** one search of every user is performed, group names are common names from memberOf
+    (like user_dn_groups), with **nested** the DN of the user is searched first, then its groups including nested ones
+    (like user_dn and dn_groups with nested=True, group names are sAMAccountName)
+
+    :param conn: established connection to domain controller, e.g. a pooled one of the service account
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param usernames: active directory usernames
+    :type usernames: Iterable[str]
+    :param domain: full name of active directory domain
+    :type domain: str
+    :param nested: include groups the users are members of through other groups, defaults to **False**
+    :type nested: bool
+    :param depth: maximum number of outstanding searches, defaults to **32**
+    :type depth: int
+    :return: username -> (distinguished name, group names), an empty DN means the user was not found
+    :rtype: Dict[str, Tuple[str, List[str]]]
+    :raises FAILOVER_ERRORS: if the domain controller is not available
+    """
+    ldap_base: str = _domain_base(domain)
+    queue: Iterator[str] = iter(usernames)
+    pending: Dict[int, Tuple[str, str]] = {}  # msgid -> (username, DN of the user or '' if it is searched)
+    results: Dict[str, Tuple[str, List[str]]] = {}
+
+    def submit() -> None:
+        while len(pending) < depth:
+            username: Optional[str] = next(queue, None)
+            if username is None:
+                return
+            msgid: int = conn.search_ext(ldap_base, ldap.SCOPE_SUBTREE, _user_filter(username),
+                                         [''] if nested else ['memberOf'])
+            pending[msgid] = (username, '')
+
+    try:
+        submit()
+        while pending:
+            try:
+                _, data, msgid, _ = conn.result3(ldap.RES_ANY, all=1)
+            except FAILOVER_ERRORS:
+                raise
+            except ldap.LDAPError as e:
+                info: Dict = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+                if info.get('msgid') not in pending:
+                    raise
+                username, dn = pending.pop(info['msgid'])
+                logger.error(f'{__package__} batch_user_groups failed: {str(e)}, username={username}')
+                results[username] = (dn, [])
+                submit()
+                continue
+            if msgid not in pending:
+                continue
+            username, dn = pending.pop(msgid)
+            entries: List[LdapEntry] = [x for x in data or [] if x[0] is not None]
+            if dn:
+                results[username] = (dn, [entry['sAMAccountName'][0].decode() for _, entry in entries])
+            elif not entries:
+                results[username] = ('', [])
+            elif nested:
+                dn = entries[0][0]
+                pending[conn.search_ext(ldap_base, ldap.SCOPE_SUBTREE, _groups_filter(dn, nested=True),
+                                        ['sAMAccountName'])] = (username, dn)
+            else:
+                results[username] = (entries[0][0], _member_of_names(entries[0][1]))
+            submit()
+    finally:
+        for msgid in pending:
+            try:
+                conn.abandon(msgid)
+            except ldap.LDAPError:
+                pass
+    return results
+
+
+def ad_login(dc: Union[str, List[str]],
+             username: str,
+             password: str,
+             domain: str,
+             group: str,
+             pool: Optional[LDAPConnectionPool] = None,
+             credential_cache: Optional[CredentialCache] = None,
+             group_cache: Optional[GroupCache] = None,
+             group_resolution: str = GROUP_RESOLUTION_SEARCH,
+             breaker: Optional[CircuitBreaker] = None,
+             deadline: Union[None, float, Deadline] = None,
+             throttle: Optional[LoginThrottle] = None,
+             source: Optional[str] = None,
+             ) -> bool:
     """
     Returns true if the user can log in and is included in the desired group
 
-    :param dc: hostname or ip address of a domain controller
-    :type dc: str
+    :param dc: hostname or ip address of a domain controller, or a list of them ordered from the best one
+        (e.g. DomainController.get_list()), the next one is used if a domain controller is not available
+    :type dc: Union[str, List[str]]
     :param username:
     :type username: str
     :param password:
@@ -149,42 +489,364 @@ def ad_login(dc: str, username: str, password: str, domain: str, group: str) ->
     :type domain: str
     :param group: a name of valid domain group, if an user is in this group, then it can log in
     :type group: str
+    :param pool: a pool of service account connections, if it is set the password is verified on a pooled
+        connection and searches are performed using the service account, defaults to **None** (a new connection
+        bound with the user credentials is opened and closed for every call)
+    :type pool: LDAPConnectionPool, optional
+    :param credential_cache: a cache of successful verifications, if the user has logged in with the same password
+        recently, its groups are taken from the cache without any request to the domain controller,
+        defaults to **None**
+    :type credential_cache: CredentialCache, optional
+    :param group_cache: a cache of groups of users by distinguished name, defaults to **None**
+    :type group_cache: GroupCache, optional
+    :param group_resolution: how groups of the user are requested: **GROUP_RESOLUTION_SEARCH** (user_dn, then
+        dn_groups), **GROUP_RESOLUTION_NESTED** (user_dn, then dn_groups including nested groups) or
+        **GROUP_RESOLUTION_MEMBER_OF** (user_dn_groups, one search, common names of direct groups, so **group**
+        must be a common name which may differ from sAMAccountName returned by other modes),
+        defaults to **GROUP_RESOLUTION_SEARCH**
+    :type group_resolution: str
+    :param breaker: a circuit breaker, domain controllers with the open circuit are skipped, defaults to **None**
+    :type breaker: CircuitBreaker, optional
+    :param deadline: the time budget of the whole call in seconds (or a Deadline shared with the caller),
+        every step (connection, bind, searches, failover to the next domain controller) gets the time left,
+        defaults to **None** (no budget)
+    :type deadline: Union[None, float, Deadline]
+    :param throttle: a throttle of failed logins, if the password has failed recently or there were too many
+        failures of the username or from the source, the login is rejected without any request to the domain
+        controller, defaults to **None**
+    :type throttle: LoginThrottle, optional
+    :param source: a source of the login for the throttle, e.g. an ip address of the client, defaults to **None**
+    :type source: str, optional
     :return: true if the user can log in and is included in the desired group
     :rtype: bool
+    :raises DeadlineExceeded: if the budget is spent before the result is known
     """
-    if not dc:
-        logger.error(f'{__package__} ad_login failed. "dc" is null')
-        return False
-    conn = ldap_connect(
+    groups: Optional[List[str]] = ad_user_groups(
         dc=dc,
         username=username,
         password=password,
-    )
-    if not conn:
-        logger.error(f'{__package__} ad_login failed.'
-                     f' "ldap_connect" failed dc={dc}, username={username}, password={password}')
-        return False
-    dn = user_dn(
-        conn=conn,
-        username=username,
         domain=domain,
+        pool=pool,
+        credential_cache=credential_cache,
+        group_cache=group_cache,
+        group_resolution=group_resolution,
+        breaker=breaker,
+        deadline=deadline,
+        throttle=throttle,
+        source=source,
     )
+    if groups is None:
+        return False
+    return _ad_group_allowed(groups=groups, group=group, dc=dc, username=username)
+
+
+def ad_user_groups(dc: Union[str, List[str]],
+                   username: str,
+                   password: str,
+                   domain: str,
+                   pool: Optional[LDAPConnectionPool] = None,
+                   credential_cache: Optional[CredentialCache] = None,
+                   group_cache: Optional[GroupCache] = None,
+                   group_resolution: str = GROUP_RESOLUTION_SEARCH,
+                   breaker: Optional[CircuitBreaker] = None,
+                   deadline: Union[None, float, Deadline] = None,
+                   throttle: Optional[LoginThrottle] = None,
+                   source: Optional[str] = None,
+                   ) -> Optional[List[str]]:
+    """
+    Verifies the user credentials like ad_login does, returns groups of the user instead of checking one of them.
+    Arguments are the same as arguments of ad_login
+
+    :return: a list of group names of the user if the user can log in, None otherwise
+    :rtype: List[str], optional
+    :raises DeadlineExceeded: if the budget is spent before the result is known
+    """
+    deadline = as_deadline(deadline)
+    with phase(PHASE_LOGIN) as login_phase:
+        if credential_cache is not None:
+            cached_groups: Optional[List[str]] = credential_cache.check(username=username, password=password,
+                                                                        group_resolution=group_resolution)
+            if cached_groups is not None:
+                login_phase.outcome = 'cached'
+                return cached_groups
+        if throttle is not None and not throttle.allow(username=username, password=password, source=source):
+            login_phase.outcome = 'throttled'
+            return None
+        groups: Optional[List[str]] = _ad_login_groups(
+            dc=dc,
+            username=username,
+            password=password,
+            domain=domain,
+            pool=pool,
+            group_cache=group_cache,
+            group_resolution=group_resolution,
+            breaker=breaker,
+            deadline=deadline,
+            throttle=throttle,
+            source=source,
+        )
+        if groups is None:
+            login_phase.outcome = 'denied'
+        if credential_cache is not None:
+            if groups is None:
+                credential_cache.invalidate_user(username)
+            else:
+                credential_cache.store(username=username, password=password, groups=groups,
+                                       group_resolution=group_resolution)
+        return groups
+
+
+def _dc_candidates(dc: Union[str, List[str]]) -> List[str]:
+    """
+    Returns domain controllers to try in order
+    """
+    dcs: List[str] = [x for x in ([dc] if isinstance(dc, str) else dc or []) if x]
+    if not dcs:
+        logger.error(f'{__package__} ad_login failed. "dc" is null')
+    return dcs
+
+
+class _Attempt:
+    """
+    A request to one domain controller guarded by the circuit breaker. The circuit is checked just before
+    the request, so a half-open probe is taken only for a domain controller which is really tried.
+    The probe is given back if neither a success nor a failure was recorded (an unexpected exception,
+    the deadline, a return before the result)
+
+    .. code-block:: python
+
+        with _Attempt(breaker, dc) as attempt:
+            if attempt.allowed:
+                ...
+                attempt.success()
+    """
+
+    def __init__(self, breaker: Optional[CircuitBreaker], dc: str):
+        self.breaker: Optional[CircuitBreaker] = breaker
+        self.dc: str = dc
+        self.allowed: bool = breaker is None or breaker.allow(dc)
+        self.recorded: bool = False
+
+    def success(self) -> None:
+        if self.breaker is not None:
+            self.breaker.record_success(self.dc)
+        self.recorded = True
+
+    def failure(self) -> None:
+        if self.breaker is not None:
+            self.breaker.record_failure(self.dc)
+        self.recorded = True
+
+    def __enter__(self) -> '_Attempt':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if self.breaker is not None and self.allowed and not self.recorded:
+            self.breaker.release(self.dc)
+
+
+def _ad_login_groups(dc: Union[str, List[str]],
+                     username: str,
+                     password: str,
+                     domain: str,
+                     pool: Optional[LDAPConnectionPool],
+                     group_cache: Optional[GroupCache],
+                     group_resolution: str,
+                     breaker: Optional[CircuitBreaker] = None,
+                     deadline: Optional[Deadline] = None,
+                     throttle: Optional[LoginThrottle] = None,
+                     source: Optional[str] = None,
+                     ) -> Optional[List[str]]:
+    """
+    Verifies the user credentials and requests groups of the user, fails over to the next domain controller
+    if a domain controller is not available
+
+    :return: a list of group names of the user if the user can log in, None otherwise
+    :rtype: List[str], optional
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    candidates: List[str] = _dc_candidates(dc)
+    for candidate in candidates:
+        if deadline is not None:
+            deadline.check(f'dc={candidate}')
+        with _Attempt(breaker, candidate) as attempt:
+            if not attempt.allowed:
+                continue
+            try:
+                groups: Optional[List[str]] = _ad_login_groups_dc(
+                    dc=candidate,
+                    username=username,
+                    password=password,
+                    domain=domain,
+                    pool=pool,
+                    group_cache=group_cache,
+                    group_resolution=group_resolution,
+                    deadline=deadline,
+                    throttle=throttle,
+                    source=source,
+                )
+            except FAILOVER_ERRORS as e:
+                if deadline is not None and deadline.expired():
+                    # the domain controller was cut off by the budget, it is not its failure, the probe is released
+                    raise DeadlineExceeded(f'{__package__} the deadline of {deadline.timeout}s exceeded: {str(e)}, '
+                                           f'dc={candidate}') from e
+                logger.error(f'{__package__} ad_login domain controller is not available: {str(e)}, dc={candidate}')
+                attempt.failure()
+                continue
+            attempt.success()
+            return groups
+    if candidates:
+        logger.error(f'{__package__} ad_login failed. no domain controller is available, dc={candidates}')
+    return None
+
+
+def _ad_login_groups_dc(dc: str,
+                        username: str,
+                        password: str,
+                        domain: str,
+                        pool: Optional[LDAPConnectionPool],
+                        group_cache: Optional[GroupCache],
+                        group_resolution: str,
+                        deadline: Optional[Deadline] = None,
+                        throttle: Optional[LoginThrottle] = None,
+                        source: Optional[str] = None,
+                        ) -> Optional[List[str]]:
+    """
+    Verifies the user credentials and requests groups of the user using one domain controller,
+    credentials rejected by the domain controller are recorded by the throttle
+
+    :return: a list of group names of the user if the user can log in, None otherwise
+    :rtype: List[str], optional
+    :raises FAILOVER_ERRORS: if the domain controller is not available
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    if pool is not None:
+        try:
+            with phase(PHASE_BIND) as bind_phase:
+                verified: bool = pool.verify_credentials(dc=dc, username=username, password=password,
+                                                         deadline=deadline)
+                if not verified:
+                    bind_phase.outcome = 'invalid_credentials'
+            if not verified:
+                logger.error(f'{__package__} ad_login failed.'
+                             f' "verify_credentials" failed dc={dc}, username={username}')
+                if throttle is not None:
+                    throttle.record_failure(username=username, password=password, source=source)
+                return None
+            with pool.connection(dc, deadline=deadline) as conn:
+                return _ad_groups(
+                    conn=conn, dc=dc, username=username, domain=domain,
+                    group_cache=group_cache, group_resolution=group_resolution, deadline=deadline,
+                )
+        except FAILOVER_ERRORS:
+            raise
+        except (ldap.LDAPError, LDAPPoolExhausted) as e:
+            logger.error(f'{__package__} ad_login failed. {str(e)}, dc={dc}, username={username}')
+            return None
+    try:
+        with phase(PHASE_BIND) as bind_phase:
+            try:
+                conn: Optional[ldap.ldapobject.SimpleLDAPObject] = _ldap_bind(
+                    dc=dc,
+                    username=username,
+                    password=password,
+                    deadline=deadline,
+                )
+            except ldap.INVALID_CREDENTIALS:
+                bind_phase.outcome = 'invalid_credentials'
+                conn = None
+        if conn is None:
+            logger.error(f'{__package__} ad_login failed.'
+                         f' "ldap_connect" failed, ldap.INVALID_CREDENTIALS dc={dc}, username={username}')
+            if throttle is not None:
+                throttle.record_failure(username=username, password=password, source=source)
+            return None
+        try:
+            return _ad_groups(
+                conn=conn, dc=dc, username=username, domain=domain,
+                group_cache=group_cache, group_resolution=group_resolution, deadline=deadline,
+            )
+        finally:
+            _unbind(conn)
+    except FAILOVER_ERRORS:
+        raise
+    except ldap.LDAPError as e:
+        logger.error(f'{__package__} ad_login failed. {str(e)}, dc={dc}, username={username}')
+        return None
+
+
+def _ad_groups(conn: ldap.ldapobject.SimpleLDAPObject,
+               dc: str,
+               username: str,
+               domain: str,
+               group_cache: Optional[GroupCache],
+               group_resolution: str,
+               deadline: Optional[Deadline] = None,
+               ) -> Optional[List[str]]:
+    """
+    Requests groups of the user, the connection has to be bound already.
+    Every search is limited by seconds left before the deadline
+
+    :return: a list of group names of the user, None if the user or its groups were not found
+    :rtype: List[str], optional
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    if group_resolution == GROUP_RESOLUTION_MEMBER_OF:
+        with phase(PHASE_USER_DN_GROUPS) as search_phase:
+            apply_deadline(conn, deadline, 'user_dn_groups')
+            dn, groups = user_dn_groups(conn=conn, username=username, domain=domain, deadline=deadline)
+            if not groups:
+                search_phase.outcome = 'not_found'
+        if not groups:
+            logger.error(f'{__package__} ad_login failed.'
+                         f' "user_dn_groups" failed dc={dc}, username={username}')
+            return None
+        return groups
+    if group_resolution not in (GROUP_RESOLUTION_SEARCH, GROUP_RESOLUTION_NESTED):
+        raise ValueError(f'{__package__} ad_login unknown group_resolution={group_resolution}')
+    nested: bool = group_resolution == GROUP_RESOLUTION_NESTED
+    with phase(PHASE_USER_DN) as search_phase:
+        apply_deadline(conn, deadline, 'user_dn')
+        dn = user_dn(
+            conn=conn,
+            username=username,
+            domain=domain,
+            deadline=deadline,
+        )
+        if not dn:
+            search_phase.outcome = 'not_found'
     if not dn:
         logger.error(f'{__package__} ad_login failed.'
-                     f' "user_dn" failed dc={dc}, username={username}, password={password}')
-        return False
-    groups = dn_groups(
-        conn=conn,
-        dn=dn,
-        domain=domain,
-    )
+                     f' "user_dn" failed dc={dc}, username={username}')
+        return None
+    with phase(PHASE_DN_GROUPS) as search_phase:
+        apply_deadline(conn, deadline, 'dn_groups')
+        if group_cache is not None:
+            groups = group_cache.dn_groups(conn=conn, dn=dn, domain=domain, nested=nested, deadline=deadline)
+        else:
+            groups = dn_groups(
+                conn=conn,
+                dn=dn,
+                domain=domain,
+                nested=nested,
+                deadline=deadline,
+            )
+        if not groups:
+            search_phase.outcome = 'not_found'
     if not groups:
         logger.error(f'{__package__} ad_login failed.'
-                     f' "dn_goups" failed dc={dc}, username={username}, password={password}')
-        return False
+                     f' "dn_goups" failed dc={dc}, username={username}')
+        return None
+    return groups
+
+
+def _ad_group_allowed(groups: List[str], group: str, dc: str, username: str) -> bool:
+    """
+    Returns true if the desired group is empty or it is in groups of the user
+    """
     if not group or group in groups:
         return True  # user is authenticated
     else:
         logger.error(f'{__package__} ad_login failed.'
-                     f' group={groups} not in {groups}.  dc={dc}, username={username}, password={password}')
+                     f' group={group} not in {groups}.  dc={dc}, username={username}')
         return False
@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class DjangoAdtoolsConfig(AppConfig):
     name = 'django_adtools'
+
+    def ready(self):
+        if getattr(settings, 'ADTOOLS_METRICS', False):
+            from .instrumentation import get_default_metrics
+            get_default_metrics()  # registers the hook counting phases of ad_login and discovery
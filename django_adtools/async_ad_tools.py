@@ -0,0 +1,593 @@
+"""
+django_adtools/async_ad_tools.py
+
+Asyncio variants of ad_tools functions for async views.
+
+LDAP operations are sent using the asynchronous python-ldap API and their message ids are polled
+without blocking the event loop, so one worker can wait for many domain controller round trips at the same time.
+Only the first operation on a new connection (which opens the TCP connection), pool waits and caches
+(which may be shared through the network) run in an executor.
+Connections of the pure backend (ADTOOLS_LDAP_BACKEND = 'pure') are opened and read in the event loop
+without polling. The functions take the same arguments and return the same values as their synchronous counterparts.
+
+REQUIREMENTS:
+   pip install python-ldap  # on linux, not required by ADTOOLS_LDAP_BACKEND = 'pure'
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-09-28"
+
+import asyncio
+import functools
+from .ldap_compat import ldap
+from .ad_tools import (
+    logger, LdapSearchResult, LDAP_CONNECTION,
+    GROUP_RESOLUTION_SEARCH, GROUP_RESOLUTION_NESTED, GROUP_RESOLUTION_MEMBER_OF, FAILOVER_ERRORS,
+    _domain_base, _user_filter, _groups_filter, _member_of_names, _ad_group_allowed, _dc_candidates, _Attempt, _unbind,
+)
+from .ldap_pool import LDAPConnectionPool, LDAPPoolExhausted, ldap_uri
+from .ldap_backends import initialize
+from .pure_ldap import PureLDAPObject
+from .caches import CredentialCache, GroupCache
+from .circuit_breaker import CircuitBreaker
+from .deadline import Deadline, DeadlineExceeded, as_deadline
+from .throttle import LoginThrottle
+from .tls import apply_tls, set_tls_options, get_tls_mode, TLS_NONE, TLS_STARTTLS
+from .instrumentation import phase, PHASE_LOGIN, PHASE_BIND, PHASE_USER_DN, PHASE_DN_GROUPS, PHASE_USER_DN_GROUPS
+# type hints
+from typing import Any, Awaitable, Callable, List, Tuple, Optional, Union
+
+POLL_INTERVAL_MIN: float = 0.001  #: the first delay between polls of a pending operation, seconds
+POLL_INTERVAL_MAX: float = 0.05  #: the maximum delay between polls of a pending operation, seconds
+
+
+async def _result(conn: ldap.ldapobject.SimpleLDAPObject, msgid: int) -> Tuple[int, LdapSearchResult]:
+    """
+    Waits for the result of the operation polling it without blocking the event loop.
+    The operation is abandoned if the waiting coroutine is cancelled
+
+    :return: a type and data of the result
+    :raises ldap.LDAPError: if the operation failed
+    """
+    delay: float = POLL_INTERVAL_MIN
+    try:
+        if isinstance(conn, PureLDAPObject):
+            result_type, result_data, _, _ = await conn.async_result(msgid)
+            return result_type, result_data
+        while True:
+            result_type, result_data, _, _ = conn.result3(msgid, all=1, timeout=0)
+            if result_type is not None:
+                return result_type, result_data
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, POLL_INTERVAL_MAX)
+    except asyncio.CancelledError:
+        conn.abandon(msgid)
+        raise
+
+
+async def _call(operation: Callable[..., int], *args: Any, in_executor: bool = False) -> int:
+    """
+    Sends an asynchronous operation, returns its message id.
+    The operation is sent from an executor if it can open a TCP connection,
+    a connection of the pure backend is opened in the event loop
+    """
+    if in_executor and isinstance(getattr(operation, '__self__', None), PureLDAPObject):
+        await operation.__self__.async_connect()
+        return operation(*args)
+    if in_executor:
+        return await asyncio.get_running_loop().run_in_executor(None, operation, *args)
+    return operation(*args)
+
+
+async def _search(conn: ldap.ldapobject.SimpleLDAPObject,
+                  ldap_base: str,
+                  search_filter: str,
+                  attributes: List[str],
+                  ) -> LdapSearchResult:
+    """
+    Searches the subtree, returns entries without referrals
+    """
+    msgid: int = await _call(conn.search_ext, ldap_base, ldap.SCOPE_SUBTREE, search_filter, attributes)
+    _, results = await _result(conn, msgid)
+    return [item for item in results if item[0] is not None]
+
+
+async def _run(function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Calls a blocking function (a cache, a throttle) in the executor
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+
+async def _within(coroutine: Awaitable, deadline: Optional[Deadline], step: str) -> Any:
+    """
+    Awaits the coroutine, it is cancelled when the deadline passes
+
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    if deadline is None:
+        return await coroutine
+    try:
+        timeout: float = deadline.check(step)
+    except DeadlineExceeded:
+        coroutine.close()
+        raise
+    try:
+        return await asyncio.wait_for(coroutine, timeout)
+    except asyncio.TimeoutError as e:
+        raise DeadlineExceeded(f'{__package__} the deadline of {deadline.timeout}s exceeded during {step}') from e
+
+
+async def _acquire(pool: LDAPConnectionPool, dc: str, deadline: Optional[Deadline] = None
+                   ) -> ldap.ldapobject.SimpleLDAPObject:
+    """
+    Takes a connection from the pool in the executor, the wait is limited by the deadline.
+    The wait can not be interrupted in the executor, so it is shielded:
+    if the caller is cancelled, the connection taken afterwards is returned to the pool
+
+    :raises LDAPPoolExhausted: if there is no free connection
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    future: asyncio.Future = asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(pool.acquire, dc, deadline=deadline)
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        def release(acquired: asyncio.Future) -> None:
+            if not acquired.cancelled() and acquired.exception() is None:
+                pool.release(dc, acquired.result())
+
+        future.add_done_callback(release)
+        raise
+
+
+async def _start_tls(conn: ldap.ldapobject.SimpleLDAPObject) -> None:
+    """
+    Applies TLS settings to a new connection, the TLS handshake of the pure backend runs in the event loop
+    """
+    if get_tls_mode() == TLS_NONE:
+        return
+    if not isinstance(conn, PureLDAPObject):
+        await asyncio.get_running_loop().run_in_executor(None, apply_tls, conn)
+    else:
+        set_tls_options(conn)
+        await conn.async_connect()
+        if get_tls_mode() == TLS_STARTTLS:
+            await conn.async_start_tls()
+
+
+async def _bind(conn: ldap.ldapobject.SimpleLDAPObject, username: str, password: str, connect: bool) -> None:
+    if connect:
+        await _start_tls(conn)
+    msgid: int = await _call(conn.simple_bind, username, password, in_executor=connect)
+    await _result(conn, msgid)
+
+
+async def async_ldap_connect(dc: str, username: str, password: str) -> LDAP_CONNECTION:
+    """
+    Asyncio variant of ad_tools.ldap_connect
+
+    :param dc: an ip address of domain controller
+    :type dc: str
+    :param username: an active directory username
+    :type username: str
+    :param password: an active directory user password
+    :type password: str
+    :return: ldap connection if binding was ok, None otherwise
+    :rtype: ldap.ldapobject.SimpleLDAPObject
+    """
+    ldap_connection: ldap.ldapobject.SimpleLDAPObject = initialize(ldap_uri(dc))
+    ldap_connection.set_option(ldap.OPT_REFERRALS, 0)
+    try:
+        await _bind(ldap_connection, username, password, connect=True)
+        return ldap_connection
+    except ldap.INVALID_CREDENTIALS:
+        logger.warning(f'{__package__} async_ldap_connect failed, ldap.INVALID_CREDENTIALS '
+                       f'dc={dc}, username={username}')
+        return None
+    except ldap.SERVER_DOWN:
+        logger.error(f'{__package__} async_ldap_connect failed, ldap.SERVER_DOWN dc={dc}')
+        return None
+
+
+async def async_user_dn(conn: ldap.ldapobject.SimpleLDAPObject, username: str, domain: str) -> str:
+    """
+    Asyncio variant of ad_tools.user_dn
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param username: an active directory username
+    :type username: str
+    :param domain: full name of active directory domain
+    :type domain: str
+    :return: distinguished name for username if success, empty string otherwise
+    :rtype: str
+    """
+    if not conn:
+        logger.error(f'{__package__} async_user_dn failed "conn" is null')
+        return ''
+    ldap_base: str = _domain_base(domain)
+    search_filter: str = _user_filter(username)
+    try:
+        results: LdapSearchResult = await _search(conn, ldap_base, search_filter, [''])
+        if not len(results):
+            logger.warning(f'{__package__} async_user_dn failed:'
+                           f' results is empty, ldap_base={ldap_base}, search_filter={search_filter}')
+            return ''
+        return results[0][0]
+    except ldap.OPERATIONS_ERROR as e:
+        logger.error(f'{__package__} async_user_dn failed:'
+                     f' {str(e)}, ldap_base={ldap_base}, search_filter={search_filter}')
+        return ''
+
+
+async def async_dn_groups(conn: ldap.ldapobject.SimpleLDAPObject,
+                          dn: str,
+                          domain: str,
+                          nested: bool = False,
+                          ) -> List[str]:
+    """
+    Asyncio variant of ad_tools.dn_groups
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param dn: an active directory user DN
+    :type dn: str
+    :param domain: full name of active directory domain
+    :type domain: str
+    :param nested: include groups the user is a member of through other groups, defaults to **False**
+    :type nested: bool
+    :return: list of group names whose user with DN is member of (SUCCESS), empty list otherwise
+    :rtype: List[str]
+    """
+    if not conn:
+        logger.error(f'{__package__} async_dn_groups failed. "conn" is null. dn={dn}, domain={domain}')
+        return []
+    ldap_base: str = _domain_base(domain)
+    search_filter: str = _groups_filter(dn, nested)
+    try:
+        results: LdapSearchResult = await _search(conn, ldap_base, search_filter, ['sAMAccountName'])
+        if not results:
+            logger.error(f'{__package__} async_dn_groups failed. results is empty, dn={dn}, domain={domain}')
+        return [item[1]['sAMAccountName'][0].decode() for item in results]
+    except ldap.OPERATIONS_ERROR as e:
+        logger.error(f'{__package__} async_dn_groups failed: {str(e)}, dn={dn}, domain={domain}')
+        return []
+
+
+async def async_user_dn_groups(conn: ldap.ldapobject.SimpleLDAPObject,
+                               username: str,
+                               domain: str,
+                               ) -> Tuple[str, List[str]]:
+    """
+    Asyncio variant of ad_tools.user_dn_groups
+
+    :param conn: established connection to domain controller
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param username: an active directory username
+    :type username: str
+    :param domain: full name of active directory domain
+    :type domain: str
+    :return: distinguished name and list of group names if success, empty string and empty list otherwise
+    :rtype: Tuple[str, List[str]]
+    """
+    if not conn:
+        logger.error(f'{__package__} async_user_dn_groups failed "conn" is null')
+        return '', []
+    ldap_base: str = _domain_base(domain)
+    search_filter: str = _user_filter(username)
+    try:
+        results: LdapSearchResult = await _search(conn, ldap_base, search_filter, ['memberOf'])
+        if not len(results):
+            logger.warning(f'{__package__} async_user_dn_groups failed:'
+                           f' results is empty, ldap_base={ldap_base}, search_filter={search_filter}')
+            return '', []
+        dn, attributes = results[0]
+        groups: List[str] = _member_of_names(attributes)
+        if not groups:
+            logger.error(f'{__package__} async_user_dn_groups failed. memberOf is empty, dn={dn}, domain={domain}')
+        return dn, groups
+    except ldap.OPERATIONS_ERROR as e:
+        logger.error(f'{__package__} async_user_dn_groups failed:'
+                     f' {str(e)}, ldap_base={ldap_base}, search_filter={search_filter}')
+        return '', []
+
+
+async def async_ad_login(dc: Union[str, List[str]],
+                         username: str,
+                         password: str,
+                         domain: str,
+                         group: str,
+                         pool: Optional[LDAPConnectionPool] = None,
+                         credential_cache: Optional[CredentialCache] = None,
+                         group_cache: Optional[GroupCache] = None,
+                         group_resolution: str = GROUP_RESOLUTION_SEARCH,
+                         breaker: Optional[CircuitBreaker] = None,
+                         deadline: Union[None, float, Deadline] = None,
+                         throttle: Optional[LoginThrottle] = None,
+                         source: Optional[str] = None,
+                         ) -> bool:
+    """
+    Asyncio variant of ad_tools.ad_login, returns true if the user can log in and is included in the desired group
+
+    :param dc: hostname or ip address of a domain controller, or a list of them ordered from the best one
+    :type dc: Union[str, List[str]]
+    :param username:
+    :type username: str
+    :param password:
+    :type password: str
+    :param domain: a name of domain, e.g. example.com
+    :type domain: str
+    :param group: a name of valid domain group, if an user is in this group, then it can log in
+    :type group: str
+    :param pool: a pool of service account connections, defaults to **None**
+    :type pool: LDAPConnectionPool, optional
+    :param credential_cache: a cache of successful verifications, defaults to **None**
+    :type credential_cache: CredentialCache, optional
+    :param group_cache: a cache of groups of users by distinguished name, defaults to **None**
+    :type group_cache: GroupCache, optional
+    :param group_resolution: how groups of the user are requested, defaults to **GROUP_RESOLUTION_SEARCH**
+    :type group_resolution: str
+    :param breaker: a circuit breaker, domain controllers with the open circuit are skipped, defaults to **None**
+    :type breaker: CircuitBreaker, optional
+    :param deadline: the time budget of the whole call in seconds (or a Deadline shared with the caller),
+        pool waits, connections and requests to a domain controller are cancelled when it passes,
+        defaults to **None** (no budget)
+    :type deadline: Union[None, float, Deadline]
+    :param throttle: a throttle of failed logins, defaults to **None**
+    :type throttle: LoginThrottle, optional
+    :param source: a source of the login for the throttle, e.g. an ip address of the client, defaults to **None**
+    :type source: str, optional
+    :return: true if the user can log in and is included in the desired group
+    :rtype: bool
+    :raises DeadlineExceeded: if the budget is spent before the result is known
+    """
+    deadline = as_deadline(deadline)
+    with phase(PHASE_LOGIN) as login_phase:
+        if credential_cache is not None:
+            # a password hash is slow by design, it is calculated in the executor
+            cached_groups: Optional[List[str]] = await _run(credential_cache.check, username, password,
+                                                                group_resolution)
+            if cached_groups is not None:
+                login_phase.outcome = 'cached'
+                return _ad_group_allowed(groups=cached_groups, group=group, dc=dc, username=username)
+        if throttle is not None and not await _run(throttle.allow, username=username, password=password,
+                                                   source=source):
+            login_phase.outcome = 'throttled'
+            return False
+        groups: Optional[List[str]] = await _async_ad_login_groups(
+            dc=dc,
+            username=username,
+            password=password,
+            domain=domain,
+            pool=pool,
+            group_cache=group_cache,
+            group_resolution=group_resolution,
+            breaker=breaker,
+            deadline=deadline,
+            throttle=throttle,
+            source=source,
+        )
+        if groups is None:
+            login_phase.outcome = 'denied'
+            if credential_cache is not None:
+                await _run(credential_cache.invalidate_user, username)
+            return False
+        if credential_cache is not None:
+            await _run(credential_cache.store, username, password, groups, group_resolution)
+    return _ad_group_allowed(groups=groups, group=group, dc=dc, username=username)
+
+
+async def _async_verify_credentials(pool: LDAPConnectionPool, dc: str, username: str, password: str,
+                                    deadline: Optional[Deadline] = None) -> bool:
+    """
+    Asyncio variant of LDAPConnectionPool.verify_credentials
+    """
+    if not password:
+        logger.warning(f'{__package__} async_ad_login verify_credentials failed, empty password '
+                       f'dc={dc}, username={username}')
+        return False
+    conn: ldap.ldapobject.SimpleLDAPObject = await _acquire(pool, dc, deadline)
+    discard: bool = False
+    try:
+        try:
+            await _bind(conn, username, password, connect=False)
+            return True
+        except ldap.INVALID_CREDENTIALS:
+            logger.warning(f'{__package__} async_ad_login verify_credentials failed, ldap.INVALID_CREDENTIALS '
+                           f'dc={dc}, username={username}')
+            return False
+        except asyncio.CancelledError:
+            # the connection may stay bound with the user credentials, it is not returned into the pool
+            discard = True
+            raise
+        finally:
+            if not discard:
+                try:
+                    await _bind(conn, pool.bind_username, pool.bind_password, connect=False)
+                except ldap.LDAPError as e:
+                    logger.error(f'{__package__} async_ad_login rebind failed: {str(e)}, dc={dc}')
+                    discard = True
+                except asyncio.CancelledError:
+                    discard = True
+                    raise
+    finally:
+        pool.release(dc, conn, discard=discard)
+
+
+async def _async_ad_login_groups(dc: Union[str, List[str]],
+                                 username: str,
+                                 password: str,
+                                 domain: str,
+                                 pool: Optional[LDAPConnectionPool],
+                                 group_cache: Optional[GroupCache],
+                                 group_resolution: str,
+                                 breaker: Optional[CircuitBreaker] = None,
+                                 deadline: Optional[Deadline] = None,
+                                 throttle: Optional[LoginThrottle] = None,
+                                 source: Optional[str] = None,
+                                 ) -> Optional[List[str]]:
+    """
+    Asyncio variant of ad_tools._ad_login_groups, a request to a domain controller is cancelled
+    when the deadline passes
+
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    candidates: List[str] = _dc_candidates(dc)
+    for candidate in candidates:
+        if deadline is not None:
+            deadline.check(f'dc={candidate}')
+        with _Attempt(breaker, candidate) as attempt:
+            if not attempt.allowed:
+                continue
+            try:
+                groups: Optional[List[str]] = await _within(_async_ad_login_groups_dc(
+                    dc=candidate,
+                    username=username,
+                    password=password,
+                    domain=domain,
+                    pool=pool,
+                    group_cache=group_cache,
+                    group_resolution=group_resolution,
+                    deadline=deadline,
+                    throttle=throttle,
+                    source=source,
+                ), deadline, f'dc={candidate}')
+            except FAILOVER_ERRORS as e:
+                if deadline is not None and deadline.expired():
+                    # the domain controller was cut off by the budget, it is not its failure, the probe is released
+                    raise DeadlineExceeded(f'{__package__} the deadline of {deadline.timeout}s exceeded: {str(e)}, '
+                                           f'dc={candidate}') from e
+                logger.error(f'{__package__} async_ad_login domain controller is not available: {str(e)}, '
+                             f'dc={candidate}')
+                attempt.failure()
+                continue
+            attempt.success()
+            return groups
+    if candidates:
+        logger.error(f'{__package__} async_ad_login failed. no domain controller is available, dc={candidates}')
+    return None
+
+
+async def _async_ad_login_groups_dc(dc: str,
+                                    username: str,
+                                    password: str,
+                                    domain: str,
+                                    pool: Optional[LDAPConnectionPool],
+                                    group_cache: Optional[GroupCache],
+                                    group_resolution: str,
+                                    deadline: Optional[Deadline] = None,
+                                    throttle: Optional[LoginThrottle] = None,
+                                    source: Optional[str] = None,
+                                    ) -> Optional[List[str]]:
+    """
+    Asyncio variant of ad_tools._ad_login_groups_dc
+    """
+    if pool is not None:
+        try:
+            with phase(PHASE_BIND) as bind_phase:
+                verified: bool = await _async_verify_credentials(pool=pool, dc=dc, username=username,
+                                                                 password=password, deadline=deadline)
+                if not verified:
+                    bind_phase.outcome = 'invalid_credentials'
+            if not verified:
+                logger.error(f'{__package__} async_ad_login failed.'
+                             f' "verify_credentials" failed dc={dc}, username={username}')
+                if throttle is not None:
+                    await _run(throttle.record_failure, username=username, password=password, source=source)
+                return None
+            conn: ldap.ldapobject.SimpleLDAPObject = await _acquire(pool, dc, deadline)
+            discard: bool = False
+            try:
+                return await _async_ad_groups(
+                    conn=conn, dc=dc, username=username, domain=domain,
+                    group_cache=group_cache, group_resolution=group_resolution,
+                )
+            except FAILOVER_ERRORS:
+                discard = True
+                raise
+            finally:
+                pool.release(dc, conn, discard=discard)
+        except FAILOVER_ERRORS:
+            raise
+        except (ldap.LDAPError, LDAPPoolExhausted) as e:
+            logger.error(f'{__package__} async_ad_login failed. {str(e)}, dc={dc}, username={username}')
+            return None
+    conn = initialize(ldap_uri(dc))
+    conn.set_option(ldap.OPT_REFERRALS, 0)
+    if deadline is not None:
+        # the connection is opened in the executor which is not cancelled with the coroutine
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, deadline.check('connect'))
+    try:
+        with phase(PHASE_BIND) as bind_phase:
+            try:
+                await _bind(conn, username, password, connect=True)
+                verified = True
+            except ldap.INVALID_CREDENTIALS:
+                bind_phase.outcome = 'invalid_credentials'
+                verified = False
+        if not verified:
+            logger.error(f'{__package__} async_ad_login failed.'
+                         f' "async_ldap_connect" failed, ldap.INVALID_CREDENTIALS dc={dc}, username={username}')
+            if throttle is not None:
+                await _run(throttle.record_failure, username=username, password=password, source=source)
+            return None
+        return await _async_ad_groups(
+            conn=conn, dc=dc, username=username, domain=domain,
+            group_cache=group_cache, group_resolution=group_resolution,
+        )
+    except FAILOVER_ERRORS:
+        raise
+    except ldap.LDAPError as e:
+        logger.error(f'{__package__} async_ad_login failed. {str(e)}, dc={dc}, username={username}')
+        return None
+    finally:
+        _unbind(conn)
+
+
+async def _async_ad_groups(conn: ldap.ldapobject.SimpleLDAPObject,
+                           dc: str,
+                           username: str,
+                           domain: str,
+                           group_cache: Optional[GroupCache],
+                           group_resolution: str,
+                           ) -> Optional[List[str]]:
+    """
+    Asyncio variant of ad_tools._ad_groups
+    """
+    if group_resolution == GROUP_RESOLUTION_MEMBER_OF:
+        with phase(PHASE_USER_DN_GROUPS) as search_phase:
+            dn, groups = await async_user_dn_groups(conn=conn, username=username, domain=domain)
+            if not groups:
+                search_phase.outcome = 'not_found'
+        if not groups:
+            logger.error(f'{__package__} async_ad_login failed.'
+                         f' "async_user_dn_groups" failed dc={dc}, username={username}')
+            return None
+        return groups
+    if group_resolution not in (GROUP_RESOLUTION_SEARCH, GROUP_RESOLUTION_NESTED):
+        raise ValueError(f'{__package__} async_ad_login unknown group_resolution={group_resolution}')
+    nested: bool = group_resolution == GROUP_RESOLUTION_NESTED
+    with phase(PHASE_USER_DN) as search_phase:
+        dn: str = await async_user_dn(conn=conn, username=username, domain=domain)
+        if not dn:
+            search_phase.outcome = 'not_found'
+    if not dn:
+        logger.error(f'{__package__} async_ad_login failed.'
+                     f' "async_user_dn" failed dc={dc}, username={username}')
+        return None
+    with phase(PHASE_DN_GROUPS) as search_phase:
+        groups: Optional[List[str]] = None
+        if group_cache is not None:
+            groups = await _run(group_cache.cached, dn=dn, nested=nested)
+        if groups is None:
+            groups = await async_dn_groups(conn=conn, dn=dn, domain=domain, nested=nested)
+            if group_cache is not None:
+                await _run(group_cache.store, dn=dn, groups=groups, nested=nested)
+        if not groups:
+            search_phase.outcome = 'not_found'
+    if not groups:
+        logger.error(f'{__package__} async_ad_login failed.'
+                     f' "async_dn_goups" failed dc={dc}, username={username}')
+        return None
+    return groups
@@ -0,0 +1,231 @@
+"""
+django_adtools/backends.py
+
+Django authentication backend, verifies credentials in Active Directory and provisions Django users
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-07"
+
+import threading
+import logging
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Group
+from .ad_tools import ad_user_groups, ad_clear_username, GROUP_RESOLUTION_SEARCH
+from .caches import TTLCache, get_default_credential_cache, get_default_group_cache
+from .circuit_breaker import get_default_breaker
+from .deadline import DeadlineExceeded
+from .ldap_pool import get_default_pool
+from .throttle import get_default_throttle
+from .models import DomainController
+# type hints
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple, Union
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+#: Django groups of a user, is_staff and is_superuser flags, None means the flag is not managed
+GroupMapping = Tuple[FrozenSet[int], Optional[bool], Optional[bool]]
+
+_caches_lock: threading.Lock = threading.Lock()
+_user_cache: Optional[TTLCache] = None  #: lowercase username -> (primary key, GroupMapping)
+_permission_cache: Optional[TTLCache] = None  #: primary key of a user -> permissions of its groups
+_mapping_cache: Optional[TTLCache] = None  #: frozenset of AD groups -> GroupMapping
+_group_ids: Dict[str, int] = {}  #: Django group name -> primary key
+
+
+def _caches() -> Tuple[TTLCache, TTLCache, TTLCache]:
+    """
+    Returns caches configured by ADTOOLS_USER_CACHE_TTL and ADTOOLS_USER_CACHE_SIZE settings
+    """
+    global _user_cache, _permission_cache, _mapping_cache
+    if _user_cache is None:
+        with _caches_lock:
+            if _user_cache is None:
+                ttl: float = getattr(settings, 'ADTOOLS_USER_CACHE_TTL', 300.0)
+                max_size: int = getattr(settings, 'ADTOOLS_USER_CACHE_SIZE', 10000)
+                _permission_cache = TTLCache(ttl=ttl, max_size=max_size)
+                _mapping_cache = TTLCache(ttl=ttl, max_size=max_size)
+                _user_cache = TTLCache(ttl=ttl, max_size=max_size)
+    return _user_cache, _permission_cache, _mapping_cache
+
+
+def clear_caches() -> None:
+    """
+    Removes cached users, group mappings and permissions,
+    e.g. after ADTOOLS_GROUP_MAP or permissions of mapped groups were changed
+    """
+    for cache in _caches():
+        cache.clear()
+    with _caches_lock:
+        _group_ids.clear()
+
+
+class ADBackend(ModelBackend):
+    """
+    Authenticates users by ad_user_groups using the best available domain controllers from DomainController model,
+    the pool, the caches and the circuit breaker configured in settings.py.
+
+    A user must be a member of ADTOOLS_GROUP if it is set. Django users are named **username@domain**,
+    they are created at the first login. Groups of the user in Active Directory are mapped to Django groups
+    by ADTOOLS_GROUP_MAP, membership in ADTOOLS_STAFF_GROUPS and ADTOOLS_SUPERUSER_GROUPS sets
+    is_staff and is_superuser flags.
+
+    Authentication of a user lasts at most ADTOOLS_LOGIN_TIMEOUT seconds if it is set,
+    the user is not authenticated if the time is spent. If ADTOOLS_THROTTLE is set, repeated failures
+    of a username or from the REMOTE_ADDR of the request are rejected without requests to domain controllers.
+
+    The primary key of the user is cached during ADTOOLS_USER_CACHE_TTL seconds, so a repeated login
+    with unchanged groups costs one query. Permissions of groups of the user are cached too.
+
+    .. code-block:: python
+
+        AUTHENTICATION_BACKENDS = ['django_adtools.backends.ADBackend']
+    """
+
+    def authenticate(self, request, username: Optional[str] = None, password: Optional[str] = None, **kwargs):
+        """
+        Returns the user if its credentials are valid, otherwise None
+
+        :param request: the current request or None
+        :param username: a username in any form: **user**, **user@example.com** or **EXAMPLE\\user**
+        :type username: str, optional
+        :param password: a password of the user
+        :type password: str, optional
+        :return: the Django user or None
+        """
+        if not username or not password:
+            return None
+        domain: str = getattr(settings, 'ADTOOLS_DOMAIN')
+        try:
+            groups: Optional[List[str]] = ad_user_groups(
+                dc=DomainController.get_list(),
+                username=username,
+                password=password,
+                domain=domain,
+                pool=get_default_pool(),
+                credential_cache=get_default_credential_cache(),
+                group_cache=get_default_group_cache(),
+                group_resolution=getattr(settings, 'ADTOOLS_GROUP_RESOLUTION', GROUP_RESOLUTION_SEARCH),
+                breaker=get_default_breaker(),
+                deadline=getattr(settings, 'ADTOOLS_LOGIN_TIMEOUT', None),
+                throttle=get_default_throttle(),
+                source=None if request is None else request.META.get('REMOTE_ADDR'),
+            )
+        except DeadlineExceeded as e:
+            logger.error(f'{__package__} ADBackend failed. {str(e)}. username={username}')
+            return None
+        if groups is None:
+            return None
+        group: str = getattr(settings, 'ADTOOLS_GROUP', '')
+        if group and group not in groups:
+            logger.error(f'{__package__} ADBackend failed. group={group} not in {groups}. username={username}')
+            return None
+        user = self.provision(username=f'{ad_clear_username(username)}@{domain}', groups=groups)
+        return user if self.user_can_authenticate(user) else None
+
+    def map_groups(self, groups: List[str]) -> GroupMapping:
+        """
+        Maps groups of a user in Active Directory to primary keys of Django groups and is_staff, is_superuser flags.
+        The result is cached for every set of groups, missing Django groups are created
+
+        :param groups: names of groups of the user in Active Directory
+        :type groups: List[str]
+        :return: primary keys of Django groups, is_staff and is_superuser (None if the flag is not managed)
+        :rtype: GroupMapping
+        """
+        key: FrozenSet[str] = frozenset(groups)
+        mapping_cache: TTLCache = _caches()[2]
+        mapping: Optional[GroupMapping] = mapping_cache.get(key)
+        if mapping is not None:
+            return mapping
+        group_map: Dict[str, Union[str, List[str]]] = getattr(settings, 'ADTOOLS_GROUP_MAP', {})
+        names: Set[str] = set()
+        for ad_group in key:
+            mapped: Union[str, List[str]] = group_map.get(ad_group, [])
+            names.update([mapped] if isinstance(mapped, str) else mapped)
+        staff_groups: Optional[List[str]] = getattr(settings, 'ADTOOLS_STAFF_GROUPS', None)
+        superuser_groups: Optional[List[str]] = getattr(settings, 'ADTOOLS_SUPERUSER_GROUPS', None)
+        mapping = (
+            frozenset(self._group_id(name) for name in names),
+            None if staff_groups is None else bool(key.intersection(staff_groups)),
+            None if superuser_groups is None else bool(key.intersection(superuser_groups)),
+        )
+        mapping_cache.set(key, mapping)
+        return mapping
+
+    @staticmethod
+    def _group_id(name: str) -> int:
+        group_id: Optional[int] = _group_ids.get(name)
+        if group_id is None:
+            group_id = Group.objects.get_or_create(name=name)[0].pk
+            _group_ids[name] = group_id
+        return group_id
+
+    def _managed_group_ids(self) -> Set[int]:
+        """
+        Returns primary keys of all Django groups from ADTOOLS_GROUP_MAP, other groups of users are kept as is
+        """
+        names: Set[str] = set()
+        for mapped in getattr(settings, 'ADTOOLS_GROUP_MAP', {}).values():
+            names.update([mapped] if isinstance(mapped, str) else mapped)
+        return {self._group_id(name) for name in names}
+
+    def provision(self, username: str, groups: List[str]):
+        """
+        Returns the Django user, creates it and updates its groups and flags if needed
+
+        :param username: a Django username, e.g. **user@example.com**
+        :type username: str
+        :param groups: names of groups of the user in Active Directory
+        :type groups: List[str]
+        :return: the Django user
+        """
+        user_model = get_user_model()
+        user_cache, permission_cache, _ = _caches()
+        mapping: GroupMapping = self.map_groups(groups)
+        key: str = username.lower()
+        cached: Optional[Tuple[int, GroupMapping]] = user_cache.get(key)
+        if cached is not None and cached[1] == mapping:
+            try:
+                return user_model._default_manager.get(pk=cached[0])
+            except user_model.DoesNotExist:
+                user_cache.invalidate(key)
+        user, created = user_model._default_manager.get_or_create(**{
+            f'{user_model.USERNAME_FIELD}__iexact': username,
+            'defaults': {user_model.USERNAME_FIELD: username},
+        })
+        group_ids, is_staff, is_superuser = mapping
+        update_fields: List[str] = []
+        if created:
+            user.set_unusable_password()
+            update_fields.append('password')
+        for field, value in (('is_staff', is_staff), ('is_superuser', is_superuser)):
+            if value is not None and getattr(user, field) != value:
+                setattr(user, field, value)
+                update_fields.append(field)
+        if update_fields:
+            user.save(update_fields=update_fields)
+        managed: Set[int] = self._managed_group_ids()
+        if managed:
+            current: Set[int] = set(user.groups.values_list('pk', flat=True))
+            desired: Set[int] = (current - managed) | group_ids
+            if desired != current:
+                user.groups.set(desired)
+                permission_cache.invalidate(user.pk)
+        user_cache.set(key, (user.pk, mapping))
+        return user
+
+    def get_group_permissions(self, user_obj, obj=None) -> Set[str]:
+        """
+        Returns permissions of groups of the user, they are cached during ADTOOLS_USER_CACHE_TTL seconds
+        """
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        permission_cache: TTLCache = _caches()[1]
+        permissions: Optional[Set[str]] = permission_cache.get(user_obj.pk)
+        if permissions is None:
+            permissions = super().get_group_permissions(user_obj)
+            permission_cache.set(user_obj.pk, permissions)
+        return permissions
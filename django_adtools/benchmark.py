@@ -0,0 +1,310 @@
+"""
+django_adtools/benchmark.py
+
+Benchmarks of ad_login, user_dn, dn_groups and discovery of domain controllers against the LDAP emulator.
+Results are saved as JSON, so a run can be compared with a baseline to find regressions:
+
+.. code-block:: python
+
+    results = run_suite(users=1000, latency=0.002, concurrency=[1, 8, 32])
+    save(results, 'benchmark.json')
+    for regression in compare(results, load('baseline.json')):
+        print(regression)
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-10"
+
+import json
+import time
+import math
+import platform
+import datetime
+import threading
+import logging
+from .ldap_compat import ldap
+from dnslib.zoneresolver import ZoneResolver
+from dnslib.server import DNSServer, DNSLogger
+from django.test.utils import override_settings
+from .ad_tools import ad_login, user_dn, dn_groups, _ldap_bind, _unbind
+from .discover_dc import DCList
+from .ldap_emulator import LDAPDirectory, LDAPEmulator, DEFAULT_PASSWORD
+from .ldap_pool import LDAPConnectionPool
+from .ldap_backends import get_backend
+from .version import VERSION
+# type hints
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+SCENARIOS: List[str] = ['ad_login', 'ad_login_pool', 'user_dn', 'dn_groups', 'discover']  #: all benchmarks
+#: compared metrics, 1 means that a bigger value is better, -1 means that a smaller value is better
+METRICS: Dict[str, int] = {'throughput': 1, 'p50': -1, 'p95': -1, 'p99': -1}
+SERVICE_USERNAME: str = 'svc-benchmark'  #: the service account of benchmarks
+
+ZONE: str = """
+{domain}.               600   IN   SOA   localhost localhost ( 2007120710 1d 2h 4w 1h )
+{domain}.               400   IN   NS    localhost
+_ldap._tcp.dc._msdcs.{domain}.    600   IN   SRV   0 100 {port} {host}."""
+
+Result = Dict[str, Any]  #: metrics of a benchmark at one concurrency level
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Returns the percentile of values (the nearest-rank method)
+
+    :param values: sorted values
+    :type values: List[float]
+    :param q: a percentile from 0 to 100
+    :type q: float
+    :rtype: float
+    """
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def run(func: Callable[[int], Any], concurrency: int, iterations: int) -> Result:
+    """
+    Calls the function **iterations** times from **concurrency** threads, measures latencies of calls
+
+    :param func: a function of the number of the call, it raises an exception if the call failed
+    :type func: Callable[[int], Any]
+    :param concurrency: number of threads
+    :type concurrency: int
+    :param iterations: total number of calls
+    :type iterations: int
+    :return: concurrency, requests, errors, seconds, throughput (calls per second) and
+        mean, p50, p95, p99 latencies in milliseconds
+    :rtype: Result
+    """
+    counter = iter(range(iterations))
+    lock: threading.Lock = threading.Lock()
+    latencies: List[float] = []
+    errors: List[int] = []
+
+    def worker() -> None:
+        while True:
+            with lock:
+                index: Optional[int] = next(counter, None)
+            if index is None:
+                return
+            start: float = time.perf_counter()
+            try:
+                func(index)
+                failed: bool = False
+            except Exception as e:
+                logger.debug(f'{__package__} benchmark call {index} failed: {str(e)}')
+                failed = True
+            elapsed: float = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if failed:
+                    errors.append(index)
+
+    threads: List[threading.Thread] = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start: float = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds: float = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'seconds': round(seconds, 6),
+        'throughput': round(len(latencies) / seconds, 3) if seconds else 0.0,
+        'mean': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50': round(percentile(latencies, 50), 3),
+        'p95': round(percentile(latencies, 95), 3),
+        'p99': round(percentile(latencies, 99), 3),
+    }
+
+
+def _scenarios(emulator: LDAPEmulator,
+               usernames: List[str],
+               groups: int,
+               dns_port: int,
+               pool: LDAPConnectionPool,
+               opened: List[ldap.ldapobject.SimpleLDAPObject],
+               ) -> Dict[str, Callable[[int], Any]]:
+    """
+    Returns functions of benchmarks, connections of user_dn and dn_groups are opened once by every thread
+    and appended to **opened**
+    """
+    directory: LDAPDirectory = emulator.directory
+    domain: str = directory.domain
+    local: threading.local = threading.local()
+    lock: threading.Lock = threading.Lock()
+
+    def connection() -> ldap.ldapobject.SimpleLDAPObject:
+        if getattr(local, 'conn', None) is None:
+            local.conn = _ldap_bind(dc=emulator.dc, username=f'{SERVICE_USERNAME}@{domain}',
+                                    password=DEFAULT_PASSWORD)
+            with lock:
+                opened.append(local.conn)
+        return local.conn
+
+    def login(index: int, login_pool: Optional[LDAPConnectionPool] = None) -> None:
+        index %= len(usernames)
+        if not ad_login(dc=emulator.dc, username=f'{usernames[index]}@{domain}', password=DEFAULT_PASSWORD,
+                        domain=domain, group=f'group{index % groups}', pool=login_pool):
+            raise AssertionError(f'ad_login failed, username={usernames[index]}')
+
+    def search_dn(index: int) -> None:
+        if not user_dn(conn=connection(), username=usernames[index % len(usernames)], domain=domain):
+            raise AssertionError(f'user_dn failed, username={usernames[index % len(usernames)]}')
+
+    def search_groups(index: int) -> None:
+        dn: str = f'CN={usernames[index % len(usernames)]},CN=Users,{directory.base}'
+        if not dn_groups(conn=connection(), dn=dn, domain=domain):
+            raise AssertionError(f'dn_groups failed, dn={dn}')
+
+    def discover(index: int) -> None:
+        dc_list: DCList = DCList(domain=domain, nameservers=[emulator.host], port=dns_port)
+        if dc_list.get_available_dc_ip() is None:
+            raise AssertionError('get_available_dc_ip failed')
+
+    return {
+        'ad_login': login,
+        'ad_login_pool': lambda index: login(index, login_pool=pool),
+        'user_dn': search_dn,
+        'dn_groups': search_groups,
+        'discover': discover,
+    }
+
+
+def run_suite(users: int = 1000,
+              groups: int = 10,
+              latency: float = 0.0,
+              concurrency: Iterable[int] = (1, 4, 16),
+              iterations: int = 200,
+              scenarios: Optional[Iterable[str]] = None,
+              backend: Optional[str] = None,
+              ) -> Dict[str, Any]:
+    """
+    Starts the LDAP emulator with a seeded directory and a DNS emulator with the SRV record of it,
+    runs benchmarks at every concurrency level
+
+    :param users: number of seeded users, defaults to **1000**
+    :type users: int
+    :param groups: number of seeded groups, defaults to **10**
+    :type groups: int
+    :param latency: seconds added by the LDAP emulator before every response, defaults to **0**
+    :type latency: float
+    :param concurrency: numbers of threads, defaults to **(1, 4, 16)**
+    :type concurrency: Iterable[int]
+    :param iterations: number of calls of a benchmark at a concurrency level, defaults to **200**
+    :type iterations: int
+    :param scenarios: names of benchmarks from SCENARIOS, defaults to **None** (all of them)
+    :type scenarios: Iterable[str], optional
+    :param backend: the LDAP backend (see ldap_backends), defaults to **None** (ADTOOLS_LDAP_BACKEND)
+    :type backend: str, optional
+    :return: a dict with keys: meta (parameters of the run) and results (a benchmark name -> list of Result)
+    :rtype: Dict[str, Any]
+    :raises ValueError: if a scenario is unknown
+    """
+    names: List[str] = list(scenarios or SCENARIOS)
+    unknown: List[str] = [x for x in names if x not in SCENARIOS]
+    if unknown:
+        raise ValueError(f'{__package__} unknown benchmarks {unknown}, available {SCENARIOS}')
+    levels: List[int] = list(concurrency)
+    backend = backend or get_backend()
+    directory: LDAPDirectory = LDAPDirectory('benchmark.local')
+    usernames: List[str] = directory.seed(users=users, groups=groups)
+    directory.add_user(SERVICE_USERNAME)
+    results: Dict[str, List[Result]] = {}
+    pool: LDAPConnectionPool = LDAPConnectionPool(
+        bind_username=f'{SERVICE_USERNAME}@{directory.domain}', bind_password=DEFAULT_PASSWORD,
+        max_size=max(levels, default=1),
+    )
+    opened: List[ldap.ldapobject.SimpleLDAPObject] = []
+    with LDAPEmulator(directory, latency=latency) as emulator, override_settings(ADTOOLS_LDAP_BACKEND=backend):
+        dns_server: DNSServer = DNSServer(
+            resolver=ZoneResolver(zone=ZONE.format(domain=directory.domain, host=emulator.host, port=emulator.port)),
+            address=emulator.host, port=0, tcp=False, logger=DNSLogger(logf=logger.debug),
+        )
+        dns_server.start_thread()
+        try:
+            functions: Dict[str, Callable[[int], Any]] = _scenarios(
+                emulator, usernames, groups, dns_server.server.server_address[1], pool, opened,
+            )
+            for name in names:
+                results[name] = [run(functions[name], concurrency=x, iterations=iterations) for x in levels]
+                logger.info(f'{__package__} benchmark {name}: {results[name]}')
+        finally:
+            pool.clear()
+            for conn in opened:
+                _unbind(conn)
+            dns_server.stop()
+            dns_server.server.server_close()
+    return {
+        'meta': {
+            'version': VERSION,
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'users': users,
+            'groups': groups,
+            'latency': latency,
+            'backend': backend,
+            'concurrency': levels,
+            'iterations': iterations,
+        },
+        'results': results,
+    }
+
+
+def save(results: Dict[str, Any], path: str) -> None:
+    """
+    Saves results of run_suite as JSON
+    """
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path: str) -> Dict[str, Any]:
+    """
+    Loads results saved by save
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float = 0.1) -> List[Dict[str, Any]]:
+    """
+    Compares results of two runs by METRICS at the same benchmarks and concurrency levels
+
+    :param current: results of run_suite
+    :type current: Dict[str, Any]
+    :param baseline: results of a previous run
+    :type baseline: Dict[str, Any]
+    :param threshold: a relative change of a metric which is a regression, defaults to **0.1** (10%)
+    :type threshold: float
+    :return: regressions, dicts with keys: benchmark, concurrency, metric, baseline, current, change
+    :rtype: List[Dict[str, Any]]
+    """
+    regressions: List[Dict[str, Any]] = []
+    for name, levels in current['results'].items():
+        baseline_levels: Dict[int, Result] = {x['concurrency']: x for x in baseline['results'].get(name, [])}
+        for level in levels:
+            previous: Optional[Result] = baseline_levels.get(level['concurrency'])
+            if previous is None:
+                continue
+            for metric, direction in METRICS.items():
+                if not previous[metric]:
+                    continue
+                change: float = (level[metric] - previous[metric]) / previous[metric]
+                if change * direction < -threshold:
+                    regressions.append({
+                        'benchmark': name,
+                        'concurrency': level['concurrency'],
+                        'metric': metric,
+                        'baseline': previous[metric],
+                        'current': level[metric],
+                        'change': round(change, 4),
+                    })
+    return regressions
@@ -0,0 +1,223 @@
+"""
+django_adtools/ber.py
+
+A minimal codec of the Basic Encoding Rules (ITU-T X.690) used by LDAP messages (RFC 4511)
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-10"
+
+# type hints
+from typing import List, Optional, Tuple, Union
+
+TAG_BOOLEAN: int = 0x01
+TAG_INTEGER: int = 0x02
+TAG_OCTET_STRING: int = 0x04
+TAG_NULL: int = 0x05
+TAG_ENUMERATED: int = 0x0a
+TAG_SEQUENCE: int = 0x30
+TAG_SET: int = 0x31
+
+CLASS_APPLICATION: int = 0x40
+CLASS_CONTEXT: int = 0x80
+CONSTRUCTED: int = 0x20
+
+Element = Tuple[int, bytes]  #: a tag and a value of an element
+
+
+class BERDecodeError(ValueError):
+    """
+    Raised if data is not a valid BER encoding
+    """
+
+
+def application(number: int, constructed: bool = True) -> int:
+    """
+    Returns the tag of an application class element, e.g. **0x63** for a SearchRequest ([APPLICATION 3])
+
+    :param number: the number of the tag
+    :type number: int
+    :param constructed: the element contains other elements, defaults to **True**
+    :type constructed: bool
+    :rtype: int
+    """
+    return CLASS_APPLICATION | (CONSTRUCTED if constructed else 0) | number
+
+
+def context(number: int, constructed: bool = False) -> int:
+    """
+    Returns the tag of a context-specific element, e.g. **0x80** for [0]
+
+    :param number: the number of the tag
+    :type number: int
+    :param constructed: the element contains other elements, defaults to **False**
+    :type constructed: bool
+    :rtype: int
+    """
+    return CLASS_CONTEXT | (CONSTRUCTED if constructed else 0) | number
+
+
+def encode_length(length: int) -> bytes:
+    """
+    Encodes a length in the short form (less than 128) or in the long form
+    """
+    if length < 0x80:
+        return bytes([length])
+    octets: bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(octets)]) + octets
+
+
+def encode(tag: int, value: bytes) -> bytes:
+    """
+    Encodes an element
+
+    :param tag: the tag of the element (one octet)
+    :type tag: int
+    :param value: the encoded content of the element
+    :type value: bytes
+    :rtype: bytes
+    """
+    return bytes([tag]) + encode_length(len(value)) + value
+
+
+def encode_integer(value: int, tag: int = TAG_INTEGER) -> bytes:
+    """
+    Encodes an INTEGER (or an ENUMERATED with **tag=TAG_ENUMERATED**) in two's complement
+    """
+    length: int = max(1, (value + (value < 0)).bit_length() // 8 + 1)
+    return encode(tag, value.to_bytes(length, 'big', signed=True))
+
+
+def encode_enumerated(value: int, tag: int = TAG_ENUMERATED) -> bytes:
+    """
+    Encodes an ENUMERATED
+    """
+    return encode_integer(value, tag=tag)
+
+
+def encode_boolean(value: bool, tag: int = TAG_BOOLEAN) -> bytes:
+    """
+    Encodes a BOOLEAN
+    """
+    return encode(tag, b'\xff' if value else b'\x00')
+
+
+def encode_octet_string(value: Union[bytes, str], tag: int = TAG_OCTET_STRING) -> bytes:
+    """
+    Encodes an OCTET STRING, a str is encoded to utf-8
+    """
+    return encode(tag, value.encode('utf-8') if isinstance(value, str) else value)
+
+
+def encode_sequence(elements: List[bytes], tag: int = TAG_SEQUENCE) -> bytes:
+    """
+    Encodes a SEQUENCE (or a constructed element with another tag) of encoded elements
+    """
+    return encode(tag, b''.join(elements))
+
+
+def encode_set(elements: List[bytes], tag: int = TAG_SET) -> bytes:
+    """
+    Encodes a SET of encoded elements
+    """
+    return encode(tag, b''.join(elements))
+
+
+def _header(data: bytes, offset: int) -> Optional[Tuple[int, int, int]]:
+    """
+    Returns the tag, the offset of the content and the length of the content of the element at the offset,
+    or None if the header is not complete
+    """
+    if len(data) < offset + 2:
+        return None
+    tag: int = data[offset]
+    if tag & 0x1f == 0x1f:
+        raise BERDecodeError('multi-octet tags are not supported')
+    first: int = data[offset + 1]
+    if first < 0x80:
+        return tag, offset + 2, first
+    count: int = first & 0x7f
+    if count == 0:
+        raise BERDecodeError('the indefinite length form is not supported')
+    if count > 4:
+        raise BERDecodeError(f'the length of {count} octets is too long')
+    if len(data) < offset + 2 + count:
+        return None
+    return tag, offset + 2 + count, int.from_bytes(data[offset + 2:offset + 2 + count], 'big')
+
+
+def element_length(data: bytes, offset: int = 0) -> Optional[int]:
+    """
+    Returns the length of the encoded element at the offset including its header,
+    or None if the data does not contain the whole element yet (useful for reading messages from a stream)
+
+    :param data: received data
+    :type data: bytes
+    :param offset: the offset of the element, defaults to **0**
+    :type offset: int
+    :rtype: int, optional
+    :raises BERDecodeError: if the header is not valid
+    """
+    header: Optional[Tuple[int, int, int]] = _header(data, offset)
+    if header is None:
+        return None
+    _, start, length = header
+    if len(data) < start + length:
+        return None
+    return start + length - offset
+
+
+def decode(data: bytes, offset: int = 0) -> Tuple[int, bytes, int]:
+    """
+    Decodes the element at the offset
+
+    :param data: encoded data
+    :type data: bytes
+    :param offset: the offset of the element, defaults to **0**
+    :type offset: int
+    :return: the tag, the content and the offset of the next element
+    :rtype: Tuple[int, bytes, int]
+    :raises BERDecodeError: if the element is not valid or truncated
+    """
+    header: Optional[Tuple[int, int, int]] = _header(data, offset)
+    if header is None:
+        raise BERDecodeError('truncated header')
+    tag, start, length = header
+    if len(data) < start + length:
+        raise BERDecodeError('truncated content')
+    return tag, data[start:start + length], start + length
+
+
+def decode_elements(data: bytes) -> List[Element]:
+    """
+    Decodes all elements of the content of a constructed element
+
+    :param data: the content of a SEQUENCE, a SET or another constructed element
+    :type data: bytes
+    :return: a list of (tag, content)
+    :rtype: List[Element]
+    :raises BERDecodeError: if an element is not valid
+    """
+    elements: List[Element] = []
+    offset: int = 0
+    while offset < len(data):
+        tag, value, offset = decode(data, offset)
+        elements.append((tag, value))
+    return elements
+
+
+def decode_integer(value: bytes) -> int:
+    """
+    Decodes the content of an INTEGER or an ENUMERATED
+    """
+    if not value:
+        raise BERDecodeError('empty integer')
+    return int.from_bytes(value, 'big', signed=True)
+
+
+def decode_boolean(value: bytes) -> bool:
+    """
+    Decodes the content of a BOOLEAN
+    """
+    if len(value) != 1:
+        raise BERDecodeError('a boolean must be one octet')
+    return value != b'\x00'
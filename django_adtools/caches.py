@@ -0,0 +1,407 @@
+"""
+django_adtools/caches.py
+
+In-process caches used to avoid round trips to domain controllers
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-09-25"
+
+import os
+import time
+import hmac
+import hashlib
+import threading
+from collections import OrderedDict
+from .ldap_compat import ldap
+from . import ad_tools
+from .shared_cache import SharedCache, get_default_shared_cache
+from .deadline import Deadline
+# type hints
+from typing import Any, Dict, List, Tuple, Optional, Hashable
+
+
+class TTLCache:
+    """
+    A thread-safe mapping with per-entry time to live and LRU eviction
+
+    :param ttl: seconds an entry is valid for
+    :type ttl: float
+    :param max_size: maximum number of entries, the least recently used entry is evicted when it is exceeded
+    :type max_size: int
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        if max_size < 1:
+            raise ValueError(f'{__package__} {type(self).__name__} max_size must be positive, got {max_size}')
+        self.ttl: float = ttl
+        self.max_size: int = max_size
+        self._lock: threading.Lock = threading.Lock()
+        self._data: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()  # key -> (expires, value)
+        self.hits: int = 0  #: number of get() calls that returned a value
+        self.misses: int = 0  #: number of get() calls that did not find a valid entry
+        self.evictions: int = 0  #: number of entries removed because max_size was exceeded
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Returns a value or None if there is no valid entry
+
+        :param key: a key of the entry
+        :return: the cached value or None
+        """
+        with self._lock:
+            item: Optional[Tuple[float, Any]] = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Stores a value
+
+        :param key: a key of the entry
+        :param value: a value to store
+        :param ttl: seconds the entry is valid for, defaults to the ttl of the cache
+        :type ttl: float, optional
+        """
+        expires: float = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Removes an entry
+
+        :param key: a key of the entry
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Removes all entries
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters of the cache
+
+        :return: a dict with keys: size, hits, misses, evictions
+        :rtype: Dict[str, int]
+        """
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class CredentialCache(TTLCache):
+    """
+    Caches successful verifications of user credentials together with groups of the user.
+
+    Passwords are never stored, only a salted PBKDF2 hash of them.
+    Keys are usernames cleared by ad_clear_username, so **user**, **user@example.com** and **EXAMPLE\\user**
+    share one entry, and the group resolution, because names of groups depend on it
+    (GROUP_RESOLUTION_MEMBER_OF returns common names, other modes return sAMAccountName).
+
+    :param ttl: seconds a verification is valid for, defaults to **300**
+    :type ttl: float
+    :param max_size: maximum number of cached users, defaults to **10000**
+    :type max_size: int
+    :param iterations: number of PBKDF2 iterations, defaults to **20000**
+    :type iterations: int
+    """
+
+    def __init__(self, ttl: float = 300.0, max_size: int = 10000, iterations: int = 20000):
+        super().__init__(ttl=ttl, max_size=max_size)
+        self.iterations: int = iterations
+
+    @staticmethod
+    def key(username: str, group_resolution: str = 'search') -> Tuple[str, str]:
+        """
+        Returns a normalized username and the group resolution used as a key of the cache
+
+        :param username: an active directory username
+        :type username: str
+        :param group_resolution: how groups of the user were requested, defaults to **GROUP_RESOLUTION_SEARCH**
+        :type group_resolution: str
+        :return: the normalized username and the group resolution
+        :rtype: Tuple[str, str]
+        """
+        return ad_tools.ad_clear_username(username).lower(), group_resolution
+
+    def _hash(self, password: str, salt: bytes) -> bytes:
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, self.iterations)
+
+    def check(self, username: str, password: str, group_resolution: str = 'search') -> Optional[List[str]]:
+        """
+        Returns cached groups of the user if the password matches the cached verification
+
+        :param username: an active directory username
+        :type username: str
+        :param password: an active directory user password
+        :type password: str
+        :param group_resolution: how groups of the user are requested, defaults to **GROUP_RESOLUTION_SEARCH**
+        :type group_resolution: str
+        :return: a list of group names or None if there is no valid verification for this password
+        :rtype: List[str], optional
+        """
+        item: Optional[Tuple[bytes, bytes, List[str]]] = self.get(self.key(username, group_resolution))
+        if item is None:
+            return None
+        salt, password_hash, groups = item
+        if not hmac.compare_digest(self._hash(password, salt), password_hash):
+            return None
+        return list(groups)
+
+    def store(self, username: str, password: str, groups: List[str], group_resolution: str = 'search') -> None:
+        """
+        Stores a successful verification of the user credentials
+
+        :param username: an active directory username
+        :type username: str
+        :param password: an active directory user password
+        :type password: str
+        :param groups: group names of the user
+        :type groups: List[str]
+        :param group_resolution: how the groups were requested, defaults to **GROUP_RESOLUTION_SEARCH**
+        :type group_resolution: str
+        """
+        salt: bytes = os.urandom(16)
+        self.set(self.key(username, group_resolution), (salt, self._hash(password, salt), tuple(groups)))
+
+    def invalidate_user(self, username: str) -> None:
+        """
+        Forgets verifications of the user with every group resolution,
+        e.g. after the user password was changed or the account was disabled
+
+        :param username: an active directory username
+        :type username: str
+        """
+        for group_resolution in ad_tools.GROUP_RESOLUTIONS:
+            self.invalidate(self.key(username, group_resolution))
+
+
+class GroupCache(TTLCache):
+    """
+    Caches group names of users by distinguished name, so authorization checks do not search the whole domain
+    every time. It can be used with any bound connection, independently of ad_login.
+
+    With a shared cache groups are also kept in a Django cache, a miss of the process is filled from it,
+    and only one process requests groups of a user missing in both
+
+    :param ttl: seconds groups of a user are valid for, defaults to **300**
+    :type ttl: float
+    :param max_size: maximum number of cached users, defaults to **10000**
+    :type max_size: int
+    :param shared_cache: the second level shared by processes, defaults to **None**
+    :type shared_cache: SharedCache, optional
+    """
+
+    def __init__(self, ttl: float = 300.0, max_size: int = 10000, shared_cache: Optional[SharedCache] = None):
+        super().__init__(ttl=ttl, max_size=max_size)
+        self.shared_cache: Optional[SharedCache] = shared_cache
+
+    @staticmethod
+    def key(dn: str, nested: bool = False) -> Tuple[str, bool]:
+        """
+        Returns a normalized distinguished name used as a key of the cache
+
+        :param dn: a distinguished name of a user
+        :type dn: str
+        :param nested: the key of nested groups of the user
+        :type nested: bool
+        :return: the normalized distinguished name and the nested flag
+        :rtype: Tuple[str, bool]
+        """
+        return dn.lower(), nested
+
+    @staticmethod
+    def shared_key(dn: str, nested: bool = False) -> Tuple[str, str, bool]:
+        """
+        Returns the key of groups of the user in the shared cache
+        """
+        return ('groups',) + GroupCache.key(dn, nested)
+
+    def dn_groups(self,
+                  conn: ldap.ldapobject.SimpleLDAPObject,
+                  dn: str,
+                  domain: str,
+                  nested: bool = False,
+                  deadline: Optional[Deadline] = None,
+                  ) -> List[str]:
+        """
+        Returns cached group names of the user, requests them using ad_tools.dn_groups on a cache miss
+
+        :param conn: established connection to domain controller
+        :type conn: ldap.ldapobject.SimpleLDAPObject
+        :param dn: an active directory user DN
+        :type dn: str
+        :param domain: full name of active directory domain
+        :type domain: str
+        :param nested: include nested groups, defaults to **False**
+        :type nested: bool
+        :param deadline: the search is limited by seconds left, defaults to **None**
+        :type deadline: Deadline, optional
+        :return: list of group names whose user with DN is member of (SUCCESS), empty list otherwise
+        :rtype: List[str]
+        :raises DeadlineExceeded: if the deadline has passed
+        """
+        groups: Optional[Tuple[str, ...]] = self.get(self.key(dn, nested))
+        if groups is not None:
+            return list(groups)
+        if self.shared_cache is None:
+            return self.refresh(conn=conn, dn=dn, domain=domain, nested=nested, deadline=deadline)
+        groups = self.shared_cache.get_or_refresh(
+            self.shared_key(dn, nested),
+            lambda: tuple(ad_tools.dn_groups(conn=conn, dn=dn, domain=domain, nested=nested, deadline=deadline)),
+            ttl=lambda x: self.ttl if x else 0,  # an empty result is not cached
+        )
+        if groups:
+            self.set(self.key(dn, nested), groups)
+        return list(groups)
+
+    def cached(self, dn: str, nested: bool = False) -> Optional[List[str]]:
+        """
+        Returns cached group names of the user without requests to the domain controller
+
+        :param dn: a distinguished name of a user
+        :type dn: str
+        :param nested: nested groups are requested
+        :type nested: bool
+        :return: list of group names or None if they are not cached
+        :rtype: List[str], optional
+        """
+        groups: Optional[Tuple[str, ...]] = self.get(self.key(dn, nested))
+        if groups is None and self.shared_cache is not None:
+            groups = self.shared_cache.get(self.shared_key(dn, nested))
+            if groups is not None:
+                self.set(self.key(dn, nested), groups)
+        return None if groups is None else list(groups)
+
+    def store(self, dn: str, groups: List[str], nested: bool = False) -> None:
+        """
+        Stores group names of the user requested elsewhere, an empty list removes the cached ones
+
+        :param dn: a distinguished name of a user
+        :type dn: str
+        :param groups: group names of the user
+        :type groups: List[str]
+        :param nested: groups include nested groups
+        :type nested: bool
+        """
+        if groups:
+            self.set(self.key(dn, nested), tuple(groups))
+            if self.shared_cache is not None:
+                self.shared_cache.set(self.shared_key(dn, nested), tuple(groups), self.ttl)
+        else:
+            self.invalidate(self.key(dn, nested))
+            if self.shared_cache is not None:
+                self.shared_cache.delete(self.shared_key(dn, nested))
+
+    def refresh(self,
+                conn: ldap.ldapobject.SimpleLDAPObject,
+                dn: str,
+                domain: str,
+                nested: bool = False,
+                deadline: Optional[Deadline] = None,
+                ) -> List[str]:
+        """
+        Requests group names of the user from the domain controller and replaces the cached ones.
+        An empty result is not cached
+
+        :param conn: established connection to domain controller
+        :type conn: ldap.ldapobject.SimpleLDAPObject
+        :param dn: an active directory user DN
+        :type dn: str
+        :param domain: full name of active directory domain
+        :type domain: str
+        :param nested: include nested groups, defaults to **False**
+        :type nested: bool
+        :param deadline: the search is limited by seconds left, defaults to **None**
+        :type deadline: Deadline, optional
+        :return: list of group names whose user with DN is member of (SUCCESS), empty list otherwise
+        :rtype: List[str]
+        :raises DeadlineExceeded: if the deadline has passed
+        """
+        groups: List[str] = ad_tools.dn_groups(conn=conn, dn=dn, domain=domain, nested=nested, deadline=deadline)
+        self.store(dn=dn, groups=groups, nested=nested)
+        return groups
+
+    def invalidate_dn(self, dn: str) -> None:
+        """
+        Forgets groups of the user, e.g. after its membership was changed
+
+        :param dn: a distinguished name of a user
+        :type dn: str
+        """
+        for nested in (False, True):
+            self.invalidate(self.key(dn, nested))
+            if self.shared_cache is not None:
+                self.shared_cache.delete(self.shared_key(dn, nested))
+
+
+_default_credential_cache: Optional[CredentialCache] = None  #: the cache configured in settings.py
+_default_credential_cache_lock: threading.Lock = threading.Lock()
+
+
+def get_default_credential_cache() -> Optional[CredentialCache]:
+    """
+    Returns the credential cache configured by ADTOOLS_CREDENTIAL_CACHE_TTL and ADTOOLS_CREDENTIAL_CACHE_SIZE settings,
+    or None if ADTOOLS_CREDENTIAL_CACHE_TTL is not set
+
+    :return: the credential cache shared by the process
+    :rtype: CredentialCache, optional
+    """
+    global _default_credential_cache
+    if _default_credential_cache is None:
+        from django.conf import settings
+        ttl: float = getattr(settings, 'ADTOOLS_CREDENTIAL_CACHE_TTL', 0)
+        if not ttl:
+            return None
+        with _default_credential_cache_lock:
+            if _default_credential_cache is None:
+                _default_credential_cache = CredentialCache(
+                    ttl=ttl,
+                    max_size=getattr(settings, 'ADTOOLS_CREDENTIAL_CACHE_SIZE', 10000),
+                )
+    return _default_credential_cache
+
+
+_default_group_cache: Optional[GroupCache] = None  #: the cache configured in settings.py
+_default_group_cache_lock: threading.Lock = threading.Lock()
+
+
+def get_default_group_cache() -> Optional[GroupCache]:
+    """
+    Returns the group cache configured by ADTOOLS_GROUP_CACHE_TTL and ADTOOLS_GROUP_CACHE_SIZE settings,
+    or None if ADTOOLS_GROUP_CACHE_TTL is not set. It uses the shared cache if ADTOOLS_SHARED_CACHE is set
+
+    :return: the group cache shared by the process
+    :rtype: GroupCache, optional
+    """
+    global _default_group_cache
+    if _default_group_cache is None:
+        from django.conf import settings
+        ttl: float = getattr(settings, 'ADTOOLS_GROUP_CACHE_TTL', 0)
+        if not ttl:
+            return None
+        with _default_group_cache_lock:
+            if _default_group_cache is None:
+                _default_group_cache = GroupCache(
+                    ttl=ttl,
+                    max_size=getattr(settings, 'ADTOOLS_GROUP_CACHE_SIZE', 10000),
+                    shared_cache=get_default_shared_cache(),
+                )
+    return _default_group_cache
@@ -0,0 +1,147 @@
+"""
+django_adtools/circuit_breaker.py
+
+Per domain controller circuit breaker, dead controllers are skipped without waiting for a connection timeout
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-05"
+
+import time
+import threading
+import logging
+# type hints
+from typing import Dict, Optional
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+STATE_CLOSED: str = 'closed'  #: requests are sent to the domain controller
+STATE_OPEN: str = 'open'  #: the domain controller is skipped
+STATE_HALF_OPEN: str = 'half-open'  #: one probe request is allowed, its result closes or opens the circuit again
+
+
+class _Circuit:
+    def __init__(self):
+        self.failures: int = 0
+        self.opened_at: Optional[float] = None
+        self.probing: bool = False
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures of every domain controller.
+    After **failure_threshold** failures the circuit opens and the controller is skipped,
+    after **reset_timeout** seconds one request is allowed to probe it (half-open state)
+
+    :param failure_threshold: consecutive failures which open the circuit, defaults to **3**
+    :type failure_threshold: int
+    :param reset_timeout: seconds the circuit stays open before a probe, defaults to **30**
+    :type reset_timeout: float
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+        self._lock: threading.Lock = threading.Lock()
+        self._circuits: Dict[str, _Circuit] = {}
+
+    def state(self, dc: str) -> str:
+        """
+        Returns the state of the circuit of the domain controller
+
+        :param dc: an ip address or a hostname of a domain controller
+        :type dc: str
+        :return: STATE_CLOSED, STATE_OPEN or STATE_HALF_OPEN
+        :rtype: str
+        """
+        with self._lock:
+            circuit: Optional[_Circuit] = self._circuits.get(dc)
+            if circuit is None or circuit.opened_at is None:
+                return STATE_CLOSED
+            if circuit.probing or time.monotonic() - circuit.opened_at >= self.reset_timeout:
+                return STATE_HALF_OPEN
+            return STATE_OPEN
+
+    def allow(self, dc: str) -> bool:
+        """
+        Checks that a request can be sent to the domain controller,
+        in the half-open state only one caller gets True until its result is recorded
+
+        :param dc: an ip address or a hostname of a domain controller
+        :type dc: str
+        :return: True if the request can be sent
+        :rtype: bool
+        """
+        with self._lock:
+            circuit: Optional[_Circuit] = self._circuits.get(dc)
+            if circuit is None or circuit.opened_at is None:
+                return True
+            if circuit.probing or time.monotonic() - circuit.opened_at < self.reset_timeout:
+                return False
+            circuit.probing = True
+            return True
+
+    def release(self, dc: str) -> None:
+        """
+        Gives back the half-open probe taken by allow without a result, e.g. the request was not sent
+        or failed for a reason unrelated to the domain controller, the next caller may probe it
+
+        :param dc: an ip address or a hostname of a domain controller
+        :type dc: str
+        """
+        with self._lock:
+            circuit: Optional[_Circuit] = self._circuits.get(dc)
+            if circuit is not None:
+                circuit.probing = False
+
+    def record_success(self, dc: str) -> None:
+        """
+        Closes the circuit of the domain controller
+
+        :param dc: an ip address or a hostname of a domain controller
+        :type dc: str
+        """
+        with self._lock:
+            circuit: Optional[_Circuit] = self._circuits.pop(dc, None)
+        if circuit is not None and circuit.opened_at is not None:
+            logger.info(f'{__package__} CircuitBreaker closed dc={dc}')
+
+    def record_failure(self, dc: str) -> None:
+        """
+        Counts a failure of the domain controller, opens its circuit if the threshold is reached
+        or the half-open probe failed
+
+        :param dc: an ip address or a hostname of a domain controller
+        :type dc: str
+        """
+        with self._lock:
+            circuit: _Circuit = self._circuits.setdefault(dc, _Circuit())
+            circuit.failures += 1
+            if circuit.probing or circuit.failures >= self.failure_threshold:
+                if circuit.opened_at is None:
+                    logger.error(f'{__package__} CircuitBreaker opened dc={dc} after {circuit.failures} failures')
+                circuit.opened_at = time.monotonic()
+                circuit.probing = False
+
+
+_default_breaker: Optional[CircuitBreaker] = None  #: the circuit breaker configured in settings.py
+_default_breaker_lock: threading.Lock = threading.Lock()
+
+
+def get_default_breaker() -> CircuitBreaker:
+    """
+    Returns the circuit breaker configured by ADTOOLS_BREAKER_THRESHOLD and ADTOOLS_BREAKER_RESET_TIMEOUT settings
+
+    :return: the circuit breaker shared by the process
+    :rtype: CircuitBreaker
+    """
+    global _default_breaker
+    if _default_breaker is None:
+        from django.conf import settings
+        with _default_breaker_lock:
+            if _default_breaker is None:
+                _default_breaker = CircuitBreaker(
+                    failure_threshold=getattr(settings, 'ADTOOLS_BREAKER_THRESHOLD', 3),
+                    reset_timeout=getattr(settings, 'ADTOOLS_BREAKER_RESET_TIMEOUT', 30.0),
+                )
+    return _default_breaker
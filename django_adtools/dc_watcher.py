@@ -0,0 +1,142 @@
+"""
+django_adtools/dc_watcher.py
+
+Periodic discovery of domain controllers, keeps DomainController model up to date
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-02"
+
+import os
+import random
+import threading
+import logging
+from django.conf import settings
+from .discover_dc import DCList, DCHostname, DEFAULT_PROBE_TIMEOUT
+from .models import DomainController
+from .shared_cache import get_default_shared_cache
+# type hints
+from typing import List, Optional
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+
+def settings_dc_list() -> DCList:
+    """
+    Creates DCList configured by ADTOOLS_DOMAIN, ADTOOLS_ROLE, ADTOOLS_NAMESERVERS, ADTOOLS_PROBE_TIMEOUT,
+    ADTOOLS_DNS_NEGATIVE_TTL, ADTOOLS_DNS_STALE_TTL, ADTOOLS_SITE and ADTOOLS_SITE_SUBNETS settings,
+    DNS answers are shared by processes if ADTOOLS_SHARED_CACHE is set
+
+    :return: a list of domain controllers of the domain
+    :rtype: DCList
+    :raises RuntimeError: if ADTOOLS_NAMESERVERS is not set on Windows
+    """
+    name_servers: List[str] = getattr(settings, 'ADTOOLS_NAMESERVERS', None)
+    if os.name == 'nt' and not name_servers:
+        raise RuntimeError("'ADTOOLS_NAMESERVERS' does not present in settings.py on Windows")
+    return DCList(
+        domain=getattr(settings, 'ADTOOLS_DOMAIN'),
+        role=getattr(settings, 'ADTOOLS_ROLE', 'dc'),
+        nameservers=name_servers,
+        probe_timeout=getattr(settings, 'ADTOOLS_PROBE_TIMEOUT', DEFAULT_PROBE_TIMEOUT),
+        negative_ttl=getattr(settings, 'ADTOOLS_DNS_NEGATIVE_TTL', 30.0),
+        stale_ttl=getattr(settings, 'ADTOOLS_DNS_STALE_TTL', 0.0),
+        site=getattr(settings, 'ADTOOLS_SITE', None),
+        site_subnets=getattr(settings, 'ADTOOLS_SITE_SUBNETS', None),
+        shared_cache=get_default_shared_cache(),
+    )
+
+
+class DCWatcher(threading.Thread):
+    """
+    A daemon thread, re-discovers domain controllers periodically.
+    DomainController model is updated only when the ordered list of available controllers changes
+
+    :param dc_list: domain controllers to watch, its ranker keeps latency history between rounds
+    :type dc_list: DCList
+    :param interval: seconds between rounds of discovery, defaults to **60**
+    :type interval: float
+    :param jitter: a random part of the interval, from 0 to 1, defaults to **0.1** (the interval +-10%)
+    :type jitter: float
+    :param ldap_probe: measure latency with an anonymous LDAP rootDSE read, defaults to **False**
+    :type ldap_probe: bool
+    """
+
+    def __init__(self, dc_list: DCList, interval: float = 60.0, jitter: float = 0.1, ldap_probe: bool = False):
+        super().__init__(name=f'{__package__}.DCWatcher', daemon=True)
+        self.dc_list: DCList = dc_list
+        self.interval: float = interval
+        self.jitter: float = jitter
+        self.ldap_probe: bool = ldap_probe
+        self.choice: Optional[List[str]] = None  #: ip addresses of available controllers stored the last time
+        self._stopped: threading.Event = threading.Event()
+
+    def discover_once(self) -> bool:
+        """
+        Discovers domain controllers, stores them if the choice has changed
+
+        :return: True if DomainController model was updated
+        :rtype: bool
+        """
+        dc_hostnames: List[DCHostname] = self.dc_list.get_ranked_dc_list(ldap_probe=self.ldap_probe)
+        choice: List[str] = [x.dc_ip for x in dc_hostnames if x.dc_ip and x.dc_rtt is not None]
+        if self.choice is None:
+            self.choice = DomainController.get_list()
+        if choice == self.choice:
+            return False
+        logger.info(f'{__package__} DCWatcher the choice of domain controllers changed from {self.choice} to {choice}')
+        DomainController.set_list(dc_hostnames)
+        self.choice = choice
+        return True
+
+    def next_delay(self) -> float:
+        """
+        Returns seconds to wait before the next round
+
+        :rtype: float
+        """
+        return max(0.0, self.interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def run(self) -> None:
+        """
+        Discovers domain controllers until stop() is called
+        """
+        while not self._stopped.is_set():
+            try:
+                self.discover_once()
+            except Exception as e:
+                # the watcher has to survive any failure of a round, the next round may succeed
+                logger.error(f'{__package__} DCWatcher discovery failed: {str(e)}', exc_info=True)
+            self._stopped.wait(self.next_delay())
+
+    def stop(self) -> None:
+        """
+        Stops the watcher after the current round
+        """
+        self._stopped.set()
+
+
+_watcher: Optional[DCWatcher] = None  #: the watcher started by start_watcher()
+_watcher_lock: threading.Lock = threading.Lock()
+
+
+def start_watcher() -> DCWatcher:
+    """
+    Starts the watcher of the process configured by ADTOOLS_DISCOVER_INTERVAL and ADTOOLS_DISCOVER_JITTER settings,
+    if it is not started yet. It is never started implicitly: every process which calls it (e.g. every worker
+    of a web server) runs discovery, so call it only from a server process, e.g. in wsgi.py,
+    or run one *python manage.py discover --watch* instead
+
+    :return: the watcher of the process
+    :rtype: DCWatcher
+    """
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None or not _watcher.is_alive():
+            _watcher = DCWatcher(
+                dc_list=settings_dc_list(),
+                interval=getattr(settings, 'ADTOOLS_DISCOVER_INTERVAL', 60.0),
+                jitter=getattr(settings, 'ADTOOLS_DISCOVER_JITTER', 0.1),
+            )
+            _watcher.start()
+        return _watcher
@@ -0,0 +1,106 @@
+"""
+django_adtools/deadline.py
+
+An overall time budget of an operation (e.g. ad_login) shared by its steps: DNS queries, TCP probes, bind and searches.
+Every step gets the remaining time as its timeout, so the operation does not last longer than the budget
+whichever component stalls
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-12"
+
+import time
+# type hints
+from typing import Optional, Union
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the time budget of an operation is spent, unlike a failure of a domain controller
+    there is no time to try another one
+    """
+    outcome: str = 'timeout'  #: the outcome of an instrumentation phase interrupted by this exception
+
+
+class Deadline:
+    """
+    A moment when an operation has to be finished
+
+    .. code-block:: python
+
+        deadline = Deadline(3.0)
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, deadline.check('bind'))
+
+    :param timeout: seconds from now
+    :type timeout: float
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout: float = timeout
+        self.expires: float = time.monotonic() + timeout
+
+    def remaining(self) -> float:
+        """
+        Returns seconds left, 0 if the deadline has passed
+        """
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self) -> bool:
+        """
+        Returns True if the deadline has passed
+        """
+        return time.monotonic() >= self.expires
+
+    def check(self, step: str = '') -> float:
+        """
+        Returns seconds left for the next step
+
+        :param step: a name of the step for the message of the exception
+        :type step: str
+        :return: seconds left, always positive
+        :rtype: float
+        :raises DeadlineExceeded: if the deadline has passed
+        """
+        remaining: float = self.expires - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f'{__package__} the deadline of {self.timeout}s exceeded'
+                                   + (f' before {step}' if step else ''))
+        return remaining
+
+    def cap(self, timeout: Optional[float], step: str = '') -> float:
+        """
+        Returns the timeout of a step limited by seconds left
+
+        :param timeout: the own timeout of the step, None means no own timeout
+        :type timeout: float, optional
+        :param step: a name of the step for the message of the exception
+        :type step: str
+        :rtype: float
+        :raises DeadlineExceeded: if the deadline has passed
+        """
+        remaining: float = self.check(step)
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def __repr__(self) -> str:
+        return f'Deadline(timeout={self.timeout}, remaining={self.remaining():.3f})'
+
+
+def as_deadline(value: Union[None, float, Deadline]) -> Optional[Deadline]:
+    """
+    Converts a timeout in seconds to a deadline starting now, a deadline and None are returned as is
+
+    :param value: seconds, a deadline or None (no deadline)
+    :type value: Union[None, float, Deadline]
+    :rtype: Deadline, optional
+    """
+    if value is None or isinstance(value, Deadline):
+        return value
+    return Deadline(value)
+
+
+def cap(deadline: Optional[Deadline], timeout: Optional[float], step: str = '') -> Optional[float]:
+    """
+    Returns the timeout of a step limited by the deadline if there is one
+
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    return timeout if deadline is None else deadline.cap(timeout, step)
@@ -9,11 +9,25 @@ REQUIREMENTS:
 __author__ = "shmakovpn <shmakovpn@yandex.ru>"
 __date__ = "2020-03-04"
 
-from typing import List, Optional, Pattern
+from typing import List, Optional, Pattern, Tuple, Iterator, Dict, Union
 import re
 import dns.resolver
+import dns.exception
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
 import socket
+import errno
+import time
+import ipaddress
+import selectors
+import threading
+import functools
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from .instrumentation import phase, PHASE_SRV, PHASE_RESOLVE, PHASE_PROBE, PHASE_LDAP_PROBE
+from .deadline import Deadline, DeadlineExceeded, as_deadline, cap
+from .shared_cache import SharedCache
 
 #: Pattern to match IPv4 addresses
 re_ip: Pattern = re.compile(
@@ -23,6 +37,305 @@ re_ip: Pattern = re.compile(
 #: this __package__ logger
 logger: logging.Logger = logging.getLogger(__package__)
 
+DEFAULT_PROBE_TIMEOUT: float = 1.0  #: default timeout of a TCP connection to a domain controller, seconds
+
+
+def is_ip_address(value: str) -> bool:
+    """
+    Checks that the value is an IPv4 or an IPv6 address
+
+    :param value: a hostname or an ip address
+    :type value: str
+    :return: True if the value is an ip address
+    :rtype: bool
+    """
+    try:
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
+        return False
+
+
+def dns_query(dns_resolver: dns.resolver.Resolver, qname: str, rdtype: str = 'A',
+              lifetime: Optional[float] = None) -> dns.resolver.Answer:
+    """
+    Performs a DNS query, works with both dnspython 1.x (query) and 2.x (resolve)
+
+    :param dns_resolver: a resolver
+    :type dns_resolver: dns.resolver.Resolver
+    :param qname: a name to query
+    :type qname: str
+    :param rdtype: a type of a record, defaults to **A**
+    :type rdtype: str
+    :param lifetime: seconds for the whole query including retries, defaults to **None** (the lifetime of the resolver)
+    :type lifetime: float, optional
+    :return: the answer
+    :rtype: dns.resolver.Answer
+    :raises dns.exception.DNSException: if the query failed
+    """
+    resolve = getattr(dns_resolver, 'resolve', None) or dns_resolver.query
+    return resolve(qname, rdtype, raise_on_no_answer=True, lifetime=lifetime)
+
+
+def _dns_deadline_error(e: dns.exception.DNSException, deadline: Optional[Deadline], qname: str) -> Exception:
+    """
+    Returns DeadlineExceeded instead of the DNS error if the query was cut off by the deadline
+    """
+    if deadline is not None and deadline.expired():
+        return DeadlineExceeded(f'{__package__} the deadline of {deadline.timeout}s exceeded: {str(e)}, qname={qname}')
+    return e
+
+
+class _DNSCacheEntry:
+    def __init__(self, answer: Optional[dns.resolver.Answer], error: Optional[dns.exception.DNSException],
+                 expires: float):
+        self.answer: Optional[dns.resolver.Answer] = answer
+        self.error: Optional[dns.exception.DNSException] = error  #: a cached negative answer
+        self.expires: float = expires
+
+
+class _SharedAnswer:
+    """
+    An answer read from the shared cache, it has records and the expiration time of dns.resolver.Answer
+    """
+
+    def __init__(self, rdtype: str, records: List[str], expiration: float):
+        self.rrset: List[dns.rdata.Rdata] = [
+            dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.from_text(rdtype), x) for x in records
+        ]
+        self.expiration: float = expiration
+
+    def __iter__(self):
+        return iter(self.rrset)
+
+    def __len__(self) -> int:
+        return len(self.rrset)
+
+
+class CachingResolver(dns.resolver.Resolver):
+    """
+    A resolver which keeps answers in memory as long as TTLs of their records allow.
+
+    Negative answers (NXDOMAIN, no records of the type) are cached for **negative_ttl** seconds.
+    A positive answer expired less than **stale_ttl** seconds ago is returned immediately
+    while it is refreshed in a background thread, and it is also returned if the refresh fails
+    (a timeout, no nameservers answered), so a DNS outage does not break discovery at once.
+
+    With a shared cache answers missing in the process are read from a Django cache, only one process
+    queries nameservers for an expired answer
+
+    :param negative_ttl: seconds to keep negative answers, defaults to **30**
+    :type negative_ttl: float
+    :param stale_ttl: seconds an expired answer can be used, defaults to **0** (stale answers are not used)
+    :type stale_ttl: float
+    :param configure: read the system configuration of nameservers, defaults to **True**
+    :type configure: bool
+    :param shared_cache: the second level shared by processes, defaults to **None**
+    :type shared_cache: SharedCache, optional
+    """
+
+    #: answers which are cached as negative ones
+    NEGATIVE_ERRORS: Tuple = (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)
+
+    def __init__(self, negative_ttl: float = 30.0, stale_ttl: float = 0.0, configure: bool = True,
+                 shared_cache: Optional[SharedCache] = None):
+        super().__init__(configure=configure)
+        self.negative_ttl: float = negative_ttl
+        self.stale_ttl: float = stale_ttl
+        self.shared_cache: Optional[SharedCache] = shared_cache
+        self._entries: Dict[Tuple[str, str], _DNSCacheEntry] = {}
+        self._refreshing: set = set()
+        self._entries_lock: threading.Lock = threading.Lock()
+
+    def _lookup(self, qname: str, rdtype: str, lifetime: Optional[float] = None) -> dns.resolver.Answer:
+        base = getattr(super(), 'resolve', None) or super().query
+        return base(qname, rdtype, raise_on_no_answer=True, lifetime=lifetime)
+
+    def _shared_lookup(self, key: Tuple[str, str], qname: str, rdtype: str,
+                       lifetime: Optional[float] = None) -> dns.resolver.Answer:
+        """
+        Returns the answer from the shared cache, or performs the query and stores its records there.
+        Negative answers are shared too
+        """
+        def query() -> Tuple[str, List[str], float]:
+            try:
+                answer: dns.resolver.Answer = self._lookup(qname, rdtype, lifetime=lifetime)
+            except self.NEGATIVE_ERRORS as e:
+                return type(e).__name__, [], time.time() + self.negative_ttl
+            return '', [x.to_text() for x in answer], answer.expiration
+
+        nameservers: str = ','.join(str(x) for x in self.nameservers)
+        error, records, expiration = self.shared_cache.get_or_refresh(
+            ('dns', nameservers, self.port) + key, query, ttl=lambda x: x[2] - time.time(),
+        )
+        if error:
+            raise getattr(dns.resolver, error)()
+        return _SharedAnswer(key[1], records, expiration)
+
+    def _fetch(self, key: Tuple[str, str], qname: str, rdtype: str,
+               lifetime: Optional[float] = None) -> dns.resolver.Answer:
+        lookup = self._lookup if self.shared_cache is None else functools.partial(self._shared_lookup, key)
+        try:
+            answer: dns.resolver.Answer = lookup(qname, rdtype, lifetime=lifetime)
+        except self.NEGATIVE_ERRORS as e:
+            with self._entries_lock:
+                self._entries[key] = _DNSCacheEntry(None, e, time.time() + self.negative_ttl)
+            raise
+        with self._entries_lock:
+            self._entries[key] = _DNSCacheEntry(answer, None, answer.expiration)
+        return answer
+
+    def _refresh(self, key: Tuple[str, str], qname: str, rdtype: str) -> None:
+        try:
+            self._fetch(key, qname, rdtype)
+        except dns.exception.DNSException as e:
+            logger.warning(f'{__package__} CachingResolver could not refresh {qname} {rdtype}: {str(e)}')
+        finally:
+            with self._entries_lock:
+                self._refreshing.discard(key)
+
+    def resolve(self, qname, rdtype='A', *args, **kwargs) -> dns.resolver.Answer:
+        """
+        Returns the cached answer or performs a DNS query, other arguments of a dns.resolver.Resolver query
+        except **lifetime** are ignored
+
+        :param qname: a name to query
+        :type qname: str
+        :param rdtype: a type of a record, defaults to **A**
+        :type rdtype: str
+        :return: the answer
+        :rtype: dns.resolver.Answer
+        :raises dns.exception.DNSException: if the query failed and there is no usable cached answer
+        """
+        key: Tuple[str, str] = (str(qname).lower().rstrip('.'), str(rdtype).upper())
+        now: float = time.time()
+        with self._entries_lock:
+            entry: Optional[_DNSCacheEntry] = self._entries.get(key)
+            stale: bool = entry is not None and entry.answer is not None and \
+                entry.expires <= now < entry.expires + self.stale_ttl
+            refresh: bool = stale and key not in self._refreshing
+            if refresh:
+                self._refreshing.add(key)
+        if entry is not None and now < entry.expires:
+            if entry.error is not None:
+                raise entry.error
+            return entry.answer
+        if stale:
+            if refresh:
+                threading.Thread(target=self._refresh, args=(key, qname, rdtype), daemon=True).start()
+            return entry.answer
+        return self._fetch(key, qname, rdtype, lifetime=kwargs.get('lifetime'))
+
+    query = resolve
+
+    def clear(self) -> None:
+        """
+        Removes all cached answers
+        """
+        with self._entries_lock:
+            self._entries.clear()
+
+
+def tcp_probe(targets: List[Tuple[str, int]], timeout: float) -> Iterator[Tuple[int, bool, float]]:
+    """
+    Connects to all targets at the same time, yields results in the order they come.
+    Connections are closed immediately, every target gets at most **timeout** seconds
+    (all targets together too, because they are probed concurrently).
+    Stopping the iteration early closes pending connections
+
+    :param targets: a list of (ip address, port), IPv4 and IPv6 addresses are supported
+    :type targets: List[Tuple[str, int]]
+    :param timeout: seconds to wait for connections
+    :type timeout: float
+    :return: an iterator of (index of the target, it is available, seconds spent for connection)
+    :rtype: Iterator[Tuple[int, bool, float]]
+    """
+    selector: selectors.BaseSelector = selectors.DefaultSelector()
+    started: float = time.monotonic()
+    pending: Dict[socket.socket, int] = {}
+    try:
+        for index, (ip, port) in enumerate(targets):
+            try:
+                family: int = socket.AF_INET6 if ':' in ip else socket.AF_INET
+                sock: socket.socket = socket.socket(family, socket.SOCK_STREAM)
+            except OSError:
+                yield index, False, 0.0
+                continue
+            sock.setblocking(False)
+            code: int = sock.connect_ex((ip, port))
+            if code == 0:
+                sock.close()
+                yield index, True, time.monotonic() - started
+            elif code in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                pending[sock] = index
+                selector.register(sock, selectors.EVENT_WRITE)
+            else:
+                sock.close()
+                yield index, False, time.monotonic() - started
+        while pending:
+            remaining: float = timeout - (time.monotonic() - started)
+            if remaining <= 0:
+                break
+            for key, _ in selector.select(remaining):
+                sock = key.fileobj
+                index = pending.pop(sock)
+                selector.unregister(sock)
+                ok: bool = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                sock.close()
+                yield index, ok, time.monotonic() - started
+        for sock, index in list(pending.items()):
+            del pending[sock]
+            selector.unregister(sock)
+            sock.close()
+            yield index, False, timeout
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+
+
+def local_ip_address(remote_ip: str) -> str:
+    """
+    Returns the local ip address used to reach a remote host, no packets are sent
+
+    :param remote_ip: an ip address of a remote host, e.g. a nameserver
+    :type remote_ip: str
+    :return: the local ip address or empty string if there is no route
+    :rtype: str
+    """
+    family: int = socket.AF_INET6 if ':' in remote_ip else socket.AF_INET
+    try:
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.connect((remote_ip, 53))
+            return sock.getsockname()[0]
+    except OSError:
+        return ''
+
+
+def site_by_subnet(ip: str, site_subnets: Dict[str, List[str]]) -> Optional[str]:
+    """
+    Finds the Active Directory site of an ip address, the most specific subnet wins like in AD Sites and Services
+
+    :param ip: an ip address
+    :type ip: str
+    :param site_subnets: site name -> subnets of the site, e.g. {'Moscow': ['10.1.0.0/16']}
+    :type site_subnets: Dict[str, List[str]]
+    :return: the name of the site, None if the ip address is not in any subnet
+    :rtype: str, optional
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    best: Optional[Tuple[int, str]] = None
+    for site, subnets in site_subnets.items():
+        for subnet in subnets:
+            network = ipaddress.ip_network(subnet, strict=False)
+            if address.version == network.version and address in network:
+                if best is None or network.prefixlen > best[0]:
+                    best = (network.prefixlen, site)
+    return best[1] if best else None
+
 
 class DCHostname:
     """
@@ -36,6 +349,8 @@ class DCHostname:
     :type dc_port: int
     :param dns_resolver:
     :type dns_resolver: dns.resolver.Resolver, optional
+    :param dc_weight: a weight from the SRV record, defaults to **0**
+    :type dc_weight: int
     """
 
     def __init__(self,
@@ -43,51 +358,174 @@ class DCHostname:
                  dc_priority: int,
                  dc_port: int,
                  dns_resolver: dns.resolver.Resolver,
+                 dc_weight: int = 0,
                  ):
         self.dc_hostname: str = dc_hostname
         self.dc_priority: int = dc_priority
         self.dc_port: int = dc_port
         self.dns_resolver: dns.resolver.Resolver = dns_resolver
+        self.dc_weight: int = dc_weight
         self.dc_ip: str = ''
+        self.dc_rtt: Optional[float] = None  #: the last measured round trip time, None if it is not available
 
-    def dc_ping(self) -> bool:
+    def resolve(self, deadline: Optional[Deadline] = None) -> List[str]:
         """
-        Checks that this domain controller host is available
+        Returns ip addresses of this domain controller host (A and AAAA records)
 
+        :param deadline: limits DNS queries by seconds left, defaults to **None**
+        :type deadline: Deadline, optional
+        :return: a list of ip addresses
+        :rtype: List[str]
+        :raises dns.exception.DNSException: if the hostname can not be resolved
+        :raises DeadlineExceeded: if the deadline has passed
+        """
+        if self.dc_ip:
+            return [self.dc_ip]
+        if is_ip_address(self.dc_hostname):
+            return [self.dc_hostname]
+        dc_ips: List[str] = []
+        error: Optional[dns.exception.DNSException] = None
+        with phase(PHASE_RESOLVE):
+            for rdtype in ('A', 'AAAA'):
+                lifetime: Optional[float] = cap(deadline, None, f'resolve {self.dc_hostname}')
+                try:
+                    dc_ips.extend(answer.address for answer in dns_query(self.dns_resolver, self.dc_hostname, rdtype,
+                                                                         lifetime=lifetime))
+                except dns.exception.DNSException as e:
+                    error = e
+            if not dc_ips:
+                raise _dns_deadline_error(dns.exception.DNSException(error), deadline, self.dc_hostname)
+        return dc_ips
+
+    def dc_ping(self, timeout: float = DEFAULT_PROBE_TIMEOUT, deadline: Union[None, float, Deadline] = None) -> bool:
+        """
+        Checks that this domain controller host is available, all its ip addresses are probed concurrently
+
+        :param timeout: seconds to wait for a TCP connection, defaults to **DEFAULT_PROBE_TIMEOUT**
+        :type timeout: float
+        :param deadline: the time budget of resolution and probes in seconds or a Deadline, defaults to **None**
+        :type deadline: Union[None, float, Deadline]
         :return: True if this domain controller host is available
         :rtype: bool
+        :raises DeadlineExceeded: if the budget is spent before the result is known
         """
-        if not self.dc_ip and re_ip.search(self.dc_hostname):
-            self.dc_ip = self.dc_hostname
-        if self.dc_ip:
-            dc_ips: List[str] = [self.dc_ip]  # ip addresses of Domain Controllers
-        else:
-            dc_ips: List[str] = []  # ip addresses of Domain controllers need to be resolved using self.dc_hostname
-        if not dc_ips:
-            # resolve hostname
-            try:
-                dns_answer: dns.resolver.Answer = self.dns_resolver.query(self.dc_hostname)
-                answers: List[dns.rdtypes.IN.A.A] = list(dns_answer)
-                dc_ips: List[str] = [answer.address for answer in answers]
-            except dns.exception.DNSException as e:
-                raise dns.exception.DNSException(e)
-        sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        for dc_ip in dc_ips:
-            try:
-                if sock.connect_ex((dc_ip, self.dc_port,)) == 0:
-                    self.dc_ip = dc_ip
-                    sock.close()
+        deadline = as_deadline(deadline)
+        dc_ips: List[str] = self.resolve(deadline=deadline)
+        with phase(PHASE_PROBE) as probe_phase:
+            probes = tcp_probe([(dc_ip, self.dc_port) for dc_ip in dc_ips], timeout=cap(deadline, timeout, 'probe'))
+            for index, ok, _ in probes:
+                if ok:
+                    probes.close()
+                    self.dc_ip = dc_ips[index]
                     return True
-            except socket.gaierror:
-                pass
-        sock.close()
+            if deadline is not None:
+                deadline.check('the end of probes')
+            probe_phase.outcome = 'unavailable'
         logger.error(f'{__package__} DCHostname.ping failed no available controllers in dc_ips={dc_ips}')
         return False
 
     def __str__(self):
         return f"DCHostname" + \
                f"(dc_hostname='{self.dc_hostname}', dc_priority='{self.dc_priority}', dc_port='{self.dc_port}'," + \
-               f"dc_ip={self.dc_ip if self.dc_ip else 'None'})"
+               f"dc_weight='{self.dc_weight}', dc_ip={self.dc_ip if self.dc_ip else 'None'}, dc_rtt={self.dc_rtt})"
+
+
+def ldap_rtt(dc_ip: str, dc_port: int, timeout: float) -> Optional[float]:
+    """
+    Measures the time of an anonymous read of the rootDSE of a domain controller
+
+    :param dc_ip: an ip address of a domain controller
+    :type dc_ip: str
+    :param dc_port: a LDAP port of the domain controller
+    :type dc_port: int
+    :param timeout: seconds to wait for the answer
+    :type timeout: float
+    :return: seconds spent, or None if the domain controller did not answer
+    :rtype: float, optional
+    """
+    from .ldap_compat import ldap
+    from .ldap_backends import initialize
+    host: str = '[%s]' % dc_ip if ':' in dc_ip else dc_ip
+    conn = initialize('ldap://%s:%s' % (host, dc_port))
+    conn.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+    conn.set_option(ldap.OPT_TIMEOUT, timeout)
+    started: float = time.monotonic()
+    with phase(PHASE_LDAP_PROBE) as probe_phase:
+        try:
+            conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['currentTime'])
+            return time.monotonic() - started
+        except ldap.LDAPError as e:
+            probe_phase.outcome = 'unavailable'
+            logger.warning(f'{__package__} ldap_rtt failed dc_ip={dc_ip}: {str(e)}')
+            return None
+        finally:
+            try:
+                conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+
+
+class DCRanker:
+    """
+    Keeps exponentially smoothed round trip times of domain controllers and ranks them.
+
+    Domain controllers are ordered by SRV priority first, then by a score: the smoothed round trip time divided
+    by (1 + weight / 100), so a heavier controller is preferred over a lighter one with a similar latency.
+    Controllers that did not answer the last probe are placed after healthy ones
+
+    :param alpha: a smoothing factor of a new measurement, from 0 to 1, defaults to **0.3**
+    :type alpha: float
+    """
+
+    def __init__(self, alpha: float = 0.3):
+        if not 0 < alpha <= 1:
+            raise ValueError(f'{__package__} DCRanker alpha must be in (0, 1], got {alpha}')
+        self.alpha: float = alpha
+        self.latency: Dict[str, float] = {}  #: ip address -> smoothed round trip time
+        self.healthy: Dict[str, bool] = {}  #: ip address -> the last probe was successful
+
+    def observe(self, dc_ip: str, rtt: Optional[float]) -> None:
+        """
+        Adds a measurement
+
+        :param dc_ip: an ip address of a domain controller
+        :type dc_ip: str
+        :param rtt: a measured round trip time in seconds, None if the domain controller did not answer
+        :type rtt: float, optional
+        """
+        if rtt is None:
+            self.healthy[dc_ip] = False
+            return
+        self.healthy[dc_ip] = True
+        previous: Optional[float] = self.latency.get(dc_ip)
+        self.latency[dc_ip] = rtt if previous is None else self.alpha * rtt + (1 - self.alpha) * previous
+
+    def score(self, dc_hostname: DCHostname) -> float:
+        """
+        Returns a score of the domain controller within its priority, less is better
+
+        :param dc_hostname: a domain controller with a resolved ip address
+        :type dc_hostname: DCHostname
+        :return: the score
+        :rtype: float
+        """
+        latency: float = self.latency.get(dc_hostname.dc_ip, float('inf'))
+        return latency / (1 + max(dc_hostname.dc_weight, 0) / 100.0)
+
+    def rank(self, dc_hostnames: List[DCHostname]) -> List[DCHostname]:
+        """
+        Returns domain controllers ordered from the best one
+
+        :param dc_hostnames: domain controllers with resolved ip addresses
+        :type dc_hostnames: List[DCHostname]
+        :return: ordered domain controllers
+        :rtype: List[DCHostname]
+        """
+        return sorted(dc_hostnames, key=lambda x: (
+            not (x.dc_ip and self.healthy.get(x.dc_ip, False)),
+            x.dc_priority,
+            self.score(x),
+        ))
 
 
 class DCList:
@@ -104,6 +542,23 @@ class DCList:
     :type nameservers: list of str
     :param port: A port number used in DNS requests, defaults to 53
     :type port: int
+    :param probe_timeout: seconds to wait for a TCP connection to a domain controller,
+        defaults to **DEFAULT_PROBE_TIMEOUT**
+    :type probe_timeout: float
+    :param ranker: keeps latency history of domain controllers between calls of get_ranked_dc_list,
+        defaults to a new DCRanker
+    :type ranker: DCRanker, optional
+    :param negative_ttl: seconds to keep negative DNS answers, defaults to **30**
+    :type negative_ttl: float
+    :param stale_ttl: seconds an expired DNS answer can be used while it is refreshed, defaults to **0**
+    :type stale_ttl: float
+    :param site: the Active Directory site of this host, its domain controllers are preferred, defaults to **None**
+    :type site: str, optional
+    :param site_subnets: site name -> subnets, finds the site by the local ip address if **site** is not set,
+        defaults to **None**
+    :type site_subnets: Dict[str, List[str]], optional
+    :param shared_cache: shares DNS answers between processes, defaults to **None**
+    :type shared_cache: SharedCache, optional
     """
 
     def __init__(
@@ -113,61 +568,267 @@ class DCList:
             record_type: str = 'SRV',
             nameservers: List[str] = None,
             port: int = 53,
+            probe_timeout: float = DEFAULT_PROBE_TIMEOUT,
+            ranker: Optional[DCRanker] = None,
+            negative_ttl: float = 30.0,
+            stale_ttl: float = 0.0,
+            site: Optional[str] = None,
+            site_subnets: Optional[Dict[str, List[str]]] = None,
+            shared_cache: Optional[SharedCache] = None,
     ):
         self.domain: str = domain
+        self.site: Optional[str] = site
+        self.site_subnets: Dict[str, List[str]] = site_subnets or {}
+        self.probe_timeout: float = probe_timeout
+        self.ranker: DCRanker = ranker if ranker is not None else DCRanker()
         self.role: str = role
         self.record_type: str = record_type
-        self.dns_resolver: dns.resolver.Resolver = dns.resolver.get_default_resolver()
+        # a resolver of this instance, the process-wide default resolver is not changed
+        self.dns_resolver: CachingResolver = CachingResolver(
+            negative_ttl=negative_ttl,
+            stale_ttl=stale_ttl,
+            configure=not nameservers,
+            shared_cache=shared_cache,
+        )
         if nameservers:
             logger.info(f'{__package__} DCList init nameservers is "{nameservers}"')
             self.dns_resolver.nameservers = nameservers
         self.dns_resolver.port = port
 
-    def get_dns_query_string(self) -> str:
+    def get_site(self) -> Optional[str]:
+        """
+        Returns the Active Directory site of this host: the configured one,
+        or the site which subnet contains the local ip address used to reach the nameserver
+
+        :return: the name of the site, None if it is unknown
+        :rtype: str, optional
+        """
+        if self.site:
+            return self.site
+        if not self.site_subnets or not self.dns_resolver.nameservers:
+            return None
+        nameserver: str = str(self.dns_resolver.nameservers[0])
+        return site_by_subnet(local_ip_address(nameserver), self.site_subnets)
+
+    def get_dns_query_string(self, site: Optional[str] = None) -> str:
         """
         Creates a dns query string to discover Domain Controllers
 
+        :param site: the Active Directory site, defaults to **None** (all domain controllers of the domain)
+        :type site: str, optional
         :return: dns query string
         :rtype: str
         """
+        if site:
+            return '_ldap._tcp.%s._sites.%s._msdcs.%s' % (site, self.role, self.domain,)
         return '_ldap._tcp.%s._msdcs.%s' % (self.role, self.domain,)
 
-    def get_dc_list(self) -> List[DCHostname]:
+    def _query_dc_list(self, qname: str, deadline: Optional[Deadline] = None) -> List[DCHostname]:
+        lifetime: Optional[float] = cap(deadline, None, f'query {qname}')
+        try:
+            with phase(PHASE_SRV):
+                dns_answer: dns.resolver.Answer = dns_query(self.dns_resolver, qname, self.record_type,
+                                                            lifetime=lifetime)
+        except dns.exception.DNSException as e:
+            raise _dns_deadline_error(dns.exception.DNSException(e), deadline, qname)
+        answers: List[dns.rdtypes.IN.SRV.SRV] = list(dns_answer)
+        answers.sort(key=lambda x: (x.priority, -x.weight))
+        return [DCHostname(
+            dc_hostname='.'.join([x.decode() for x in answer.target.labels[:-1]]),
+            dc_priority=answer.priority,
+            dc_port=answer.port,
+            dns_resolver=self.dns_resolver,
+            dc_weight=answer.weight,
+        ) for answer in answers]
+
+    def get_site_dc_list(self, deadline: Optional[Deadline] = None) -> List[DCHostname]:
+        """
+        Returns a list of domain controllers of the site of this host sorted by priority, then by weight
+
+        :param deadline: limits the DNS query by seconds left, defaults to **None**
+        :type deadline: Deadline, optional
+        :return: domain controllers of the site, empty list if the site is unknown or has no domain controllers
+        :rtype: list of DCHostname
+        :raises DeadlineExceeded: if the deadline has passed
+        """
+        site: Optional[str] = self.get_site()
+        if not site:
+            return []
+        try:
+            return self._query_dc_list(self.get_dns_query_string(site), deadline=deadline)
+        except dns.exception.DNSException as e:
+            logger.warning(f'{__package__} DCList no domain controllers in site={site}: {str(e)}')
+            return []
+
+    def get_dc_list(self, deadline: Optional[Deadline] = None) -> List[DCHostname]:
         """
-        Returns a list of domain controllers sorted by priority
+        Returns a list of domain controllers sorted by priority, then by weight (heavier first).
+        Domain controllers of the site of this host are returned if there are any,
+        otherwise all domain controllers of the domain
 
         Note: this function does not check either a domain controller is available or not
 
+        :param deadline: limits DNS queries by seconds left, defaults to **None**
+        :type deadline: Deadline, optional
         :return: a list of domain controllers' host names from DNS request sorted by priority
         :rtype: list of DCHostname
+        :raises DeadlineExceeded: if the deadline has passed
         """
+        return self.get_site_dc_list(deadline=deadline) or self.get_domain_dc_list(deadline=deadline)
+
+    def get_domain_dc_list(self, deadline: Optional[Deadline] = None) -> List[DCHostname]:
+        """
+        Returns a list of all domain controllers of the domain sorted by priority, then by weight
+
+        :param deadline: limits the DNS query by seconds left, defaults to **None**
+        :type deadline: Deadline, optional
+        :return: domain controllers of the domain
+        :rtype: list of DCHostname
+        :raises DeadlineExceeded: if the deadline has passed
+        """
+        return self._query_dc_list(self.get_dns_query_string(), deadline=deadline)
+
+    def _get_other_dc_list(self, dc_hostnames: List[DCHostname], deadline: Optional[Deadline] = None
+                           ) -> List[DCHostname]:
+        """
+        Returns domain controllers of the domain which are not in dc_hostnames if the site of this host is known
+        """
+        if not self.get_site():
+            return []
+        hostnames: List[str] = [x.dc_hostname.lower() for x in dc_hostnames]
         try:
-            dns_answer: dns.resolver.Answer = self.dns_resolver.query(
-                self.get_dns_query_string(),
-                self.record_type,
-                raise_on_no_answer=True,
-            )
+            return [x for x in self.get_domain_dc_list(deadline=deadline) if x.dc_hostname.lower() not in hostnames]
         except dns.exception.DNSException as e:
-            raise dns.exception.DNSException(e)
-        answers: List[dns.rdtypes.IN.SRV.SRV] = list(dns_answer)
-        answers.sort(key=lambda x: x.priority)
-        return [DCHostname(
-            dc_hostname='.'.join([x.decode() for x in answer.target.labels[:-1]]),
-            dc_priority=answer.priority,
-            dc_port=answer.port,
-            dns_resolver=self.dns_resolver
-        ) for answer in answers]
+            logger.warning(f'{__package__} DCList could not get domain controllers of the domain: {str(e)}')
+            return []
 
-    def get_available_dc_ip(self) -> str:
+    def _resolve_targets(self, dc_hostnames: List[DCHostname], deadline: Optional[Deadline] = None
+                         ) -> List[Tuple[DCHostname, str]]:
         """
-        Returns a hostname of an available domain controller or empty string
+        Resolves ip addresses of all domain controllers concurrently
+
+        :return: a list of (domain controller, ip address), unresolved domain controllers are skipped
+        :rtype: List[Tuple[DCHostname, str]]
+        :raises DeadlineExceeded: if the deadline has passed
+        """
+        targets: List[Tuple[DCHostname, str]] = []
+        with ThreadPoolExecutor(max_workers=max(1, len(dc_hostnames))) as executor:
+            futures = [executor.submit(dc_hostname.resolve, deadline) for dc_hostname in dc_hostnames]
+            for dc_hostname, future in zip(dc_hostnames, futures):
+                try:
+                    targets.extend((dc_hostname, dc_ip) for dc_ip in future.result())
+                except dns.exception.DNSException as e:
+                    logger.error(f'{__package__} DCList could not resolve {dc_hostname}: {e}')
+        return targets
+
+    def get_available_dc_ip(self, deadline: Union[None, float, Deadline] = None) -> str:
+        """
+        Returns an ip address of an available domain controller or empty string.
+
+        All domain controllers and all their ip addresses are probed concurrently,
+        the result is returned as soon as a controller with the best priority among available ones answers
 
-        :return: a hostname of an available domain controller or empty string
+        :param deadline: the time budget of DNS queries and probes in seconds or a Deadline,
+            defaults to **None** (every step is limited by its own timeout only)
+        :type deadline: Union[None, float, Deadline]
+        :return: an ip address of an available domain controller or empty string
         :rtype: str
+        :raises DeadlineExceeded: if the budget is spent before the result is known
         """
-        dc_hostnames: List[DCHostname] = self.get_dc_list()
-        for dc_hostname in dc_hostnames:
-            if dc_hostname.dc_ping():
-                return dc_hostname.dc_ip
+        deadline = as_deadline(deadline)
+        dc_hostnames: List[DCHostname] = self.get_dc_list(deadline=deadline)
+        dc_ip: str = self._get_available_dc_ip(dc_hostnames, deadline=deadline)
+        if dc_ip:
+            return dc_ip
+        other_dc_list: List[DCHostname] = self._get_other_dc_list(dc_hostnames, deadline=deadline)
+        if not other_dc_list:
+            return ''
+        logger.warning(f'{__package__} DCList no available domain controllers in the site, trying the domain')
+        return self._get_available_dc_ip(other_dc_list, deadline=deadline)
+
+    def _get_available_dc_ip(self, dc_hostnames: List[DCHostname], deadline: Optional[Deadline] = None) -> str:
+        targets: List[Tuple[DCHostname, str]] = self._resolve_targets(dc_hostnames, deadline=deadline)
+        pending: Dict[int, int] = {}  # priority -> number of probes without result
+        available: Dict[int, Tuple[DCHostname, str]] = {}  # priority -> the first available target
+        for dc_hostname, _ in targets:
+            pending[dc_hostname.dc_priority] = pending.get(dc_hostname.dc_priority, 0) + 1
+        probes = tcp_probe([(dc_ip, dc_hostname.dc_port) for dc_hostname, dc_ip in targets],
+                           cap(deadline, self.probe_timeout, 'probe'))
+        with phase(PHASE_PROBE) as probe_phase:
+            try:
+                for index, ok, rtt in probes:
+                    dc_hostname, dc_ip = targets[index]
+                    pending[dc_hostname.dc_priority] -= 1
+                    self.ranker.observe(dc_ip, rtt if ok else None)
+                    if ok:
+                        available.setdefault(dc_hostname.dc_priority, (dc_hostname, dc_ip))
+                    # priorities which may still give an available controller
+                    priorities: List[int] = [x for x in pending if pending[x] or x in available]
+                    if priorities and min(priorities) in available:
+                        dc_hostname, dc_ip = available[min(priorities)]
+                        dc_hostname.dc_ip = dc_ip
+                        dc_hostname.dc_rtt = self.ranker.latency.get(dc_ip)
+                        return dc_ip
+            finally:
+                probes.close()
+            if deadline is not None:
+                deadline.check('the end of probes')  # probes were cut off, domain controllers may be available
+            probe_phase.outcome = 'unavailable'
         logger.error(f'{__package__} DCList.get_available_dc_ip() no available dc_ip')
         return ''
+
+    def get_ranked_dc_list(self, ldap_probe: bool = False, deadline: Union[None, float, Deadline] = None
+                           ) -> List[DCHostname]:
+        """
+        Probes all domain controllers, returns them ordered from the best one (see DCRanker).
+        Every domain controller gets its fastest ip address, unavailable ones are at the end of the list.
+        Available domain controllers of the site of this host are placed before other ones of the domain
+
+        :param ldap_probe: measure an anonymous LDAP rootDSE read instead of a TCP connection
+            (requires python-ldap), defaults to **False**
+        :type ldap_probe: bool
+        :param deadline: the time budget of DNS queries and probes in seconds or a Deadline, probes are
+            limited by seconds left at their start, defaults to **None**
+        :type deadline: Union[None, float, Deadline]
+        :return: ordered domain controllers
+        :rtype: List[DCHostname]
+        :raises DeadlineExceeded: if the budget is spent before probes
+        """
+        deadline = as_deadline(deadline)
+        dc_hostnames: List[DCHostname] = self.get_dc_list(deadline=deadline)
+        other_dc_list: List[DCHostname] = self._get_other_dc_list(dc_hostnames, deadline=deadline)
+        ranked: List[DCHostname] = self._get_ranked_dc_list(dc_hostnames + other_dc_list, ldap_probe,
+                                                            deadline=deadline)
+        # domain controllers of the site are preferred over other available ones, unavailable ones are the last
+        return sorted(ranked, key=lambda x: (x.dc_rtt is None, x in other_dc_list))
+
+    def _get_ranked_dc_list(self, dc_hostnames: List[DCHostname], ldap_probe: bool,
+                            deadline: Optional[Deadline] = None) -> List[DCHostname]:
+        targets: List[Tuple[DCHostname, str]] = self._resolve_targets(dc_hostnames, deadline=deadline)
+        with phase(PHASE_PROBE) as probe_phase:
+            rtts: Dict[int, Optional[float]] = {
+                index: rtt if ok else None
+                for index, ok, rtt in tcp_probe([(dc_ip, dc_hostname.dc_port) for dc_hostname, dc_ip in targets],
+                                                cap(deadline, self.probe_timeout, 'probe'))
+            }
+            if not any(rtt is not None for rtt in rtts.values()):
+                probe_phase.outcome = 'unavailable'
+        if ldap_probe:
+            reachable: List[int] = [index for index, rtt in rtts.items() if rtt is not None]
+            timeout: float = cap(deadline, self.probe_timeout, 'ldap probe')
+            with ThreadPoolExecutor(max_workers=max(1, len(reachable))) as executor:
+                futures = {index: executor.submit(ldap_rtt, targets[index][1], targets[index][0].dc_port,
+                                                  timeout) for index in reachable}
+                for index, future in futures.items():
+                    rtts[index] = future.result()
+        for index, (dc_hostname, dc_ip) in enumerate(targets):
+            self.ranker.observe(dc_ip, rtts.get(index))
+        for dc_hostname in dc_hostnames:
+            dc_ips: List[str] = [dc_ip for target, dc_ip in targets if target is dc_hostname]
+            healthy_ips: List[str] = [dc_ip for dc_ip in dc_ips if self.ranker.healthy.get(dc_ip)]
+            if healthy_ips:
+                dc_hostname.dc_ip = min(healthy_ips, key=lambda x: self.ranker.latency[x])
+            elif dc_ips:
+                dc_hostname.dc_ip = dc_ips[0]
+            dc_hostname.dc_rtt = self.ranker.latency.get(dc_hostname.dc_ip) if healthy_ips else None
+        return self.ranker.rank(dc_hostnames)
@@ -0,0 +1,229 @@
+"""
+django_adtools/instrumentation.py
+
+Timing of phases of ad_login, async_ad_login and discovery of domain controllers: DNS queries, TCP probes,
+bind and searches.
+Every phase calls registered hooks with its name, duration and outcome. If no hook is registered
+a phase costs one check of an empty tuple.
+
+.. code-block:: python
+
+    def log_slow(phase: str, seconds: float, outcome: str) -> None:
+        if seconds > 1.0:
+            logger.warning(f'{phase} took {seconds:.3f}s, outcome={outcome}')
+
+    register_hook(log_slow)
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-11"
+
+import time
+import threading
+import logging
+# type hints
+from typing import Callable, Dict, List, Optional, Tuple
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+# phases of ad_login
+PHASE_LOGIN: str = 'login'  #: the whole ad_login, outcomes: ok, cached, denied, throttled
+PHASE_BIND: str = 'login.bind'  #: verification of the password, outcomes: ok, invalid_credentials
+PHASE_USER_DN: str = 'login.user_dn'  #: the search of the user DN, outcomes: ok, not_found
+PHASE_DN_GROUPS: str = 'login.dn_groups'  #: the search of groups of the user, outcomes: ok, not_found
+PHASE_USER_DN_GROUPS: str = 'login.user_dn_groups'  #: the search of the user with memberOf, outcomes: ok, not_found
+# phases of discovery
+PHASE_SRV: str = 'discovery.srv'  #: the DNS query of SRV records of domain controllers, outcome: ok
+PHASE_RESOLVE: str = 'discovery.resolve'  #: DNS queries of ip addresses of a domain controller, outcome: ok
+PHASE_PROBE: str = 'discovery.probe'  #: TCP probes of domain controllers, outcomes: ok, unavailable
+PHASE_LDAP_PROBE: str = 'discovery.ldap_probe'  #: an anonymous rootDSE read, outcomes: ok, unavailable
+
+OUTCOME_OK: str = 'ok'
+OUTCOME_ERROR: str = 'error'  #: the phase raised an exception
+
+Hook = Callable[[str, float, str], None]  #: a function of a phase name, seconds and an outcome
+
+#: registered hooks, the tuple is replaced on changes, so phases read it without the lock
+_hooks: Tuple[Hook, ...] = ()
+_hooks_lock: threading.Lock = threading.Lock()
+
+
+def register_hook(hook: Hook) -> None:
+    """
+    Registers a function which is called at the end of every phase with its name, duration in seconds and outcome.
+    Hooks are called in the thread of the phase, they must be fast and thread-safe, their exceptions are logged
+
+    :param hook: a function of a phase name, seconds and an outcome
+    :type hook: Hook
+    """
+    global _hooks
+    with _hooks_lock:
+        if hook not in _hooks:
+            _hooks = _hooks + (hook,)
+
+
+def unregister_hook(hook: Hook) -> None:
+    """
+    Removes a registered hook
+    """
+    global _hooks
+    with _hooks_lock:
+        _hooks = tuple(x for x in _hooks if x is not hook)
+
+
+class _Phase:
+    __slots__ = ('name', 'outcome', 'started')
+
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.outcome: str = OUTCOME_OK  #: the outcome of the phase, it can be changed inside the phase
+        self.started: float = 0.0
+
+    def __enter__(self) -> '_Phase':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        seconds: float = time.perf_counter() - self.started
+        # an exception can define its own outcome, e.g. DeadlineExceeded is a timeout
+        outcome: str = self.outcome if exc_type is None else getattr(exc_type, 'outcome', OUTCOME_ERROR)
+        for hook in _hooks:
+            try:
+                hook(self.name, seconds, outcome)
+            except Exception as e:
+                logger.error(f'{__package__} instrumentation hook {hook} failed: {str(e)}')
+
+
+class _NoPhase:
+    """
+    A phase which does nothing, it is used if no hook is registered
+    """
+    __slots__ = ('outcome',)
+
+    def __enter__(self) -> '_NoPhase':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        pass
+
+
+_NO_PHASE: _NoPhase = _NoPhase()
+
+
+def phase(name: str):
+    """
+    Returns a context manager which measures the phase. Its **outcome** attribute can be set inside the phase,
+    it is **ok** by default and **error** (or the **outcome** attribute of the exception) if the phase raised one
+
+    .. code-block:: python
+
+        with phase(PHASE_USER_DN) as p:
+            dn = user_dn(conn=conn, username=username, domain=domain)
+            if not dn:
+                p.outcome = 'not_found'
+
+    :param name: the name of the phase, e.g. **PHASE_BIND**
+    :type name: str
+    """
+    return _Phase(name) if _hooks else _NO_PHASE
+
+
+#: upper bounds of buckets of the histogram of durations, seconds
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class PhaseMetrics:
+    """
+    A hook which counts phases by name and outcome, accumulates their durations into histograms
+    and exports them in the Prometheus text format
+
+    :param buckets: upper bounds of buckets of the histogram in seconds, defaults to **DEFAULT_BUCKETS**
+    :type buckets: Tuple[float, ...]
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        self._lock: threading.Lock = threading.Lock()
+        # (phase, outcome) -> [counts of buckets..., count, sum of seconds]
+        self._series: Dict[Tuple[str, str], List[float]] = {}
+
+    def __call__(self, name: str, seconds: float, outcome: str) -> None:
+        with self._lock:
+            series: Optional[List[float]] = self._series.get((name, outcome))
+            if series is None:
+                series = self._series[(name, outcome)] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """
+        Returns counts and total durations of phases
+
+        :return: phase -> outcome -> a dict with keys: count, seconds
+        :rtype: Dict[str, Dict[str, Dict[str, float]]]
+        """
+        result: Dict[str, Dict[str, Dict[str, float]]] = {}
+        with self._lock:
+            for (name, outcome), series in self._series.items():
+                result.setdefault(name, {})[outcome] = {'count': int(series[-2]), 'seconds': series[-1]}
+        return result
+
+    def clear(self) -> None:
+        """
+        Resets all counters
+        """
+        with self._lock:
+            self._series.clear()
+
+    def prometheus(self, prefix: str = 'adtools') -> str:
+        """
+        Returns metrics in the Prometheus text exposition format, a histogram **<prefix>_phase_seconds**
+        with labels phase and outcome
+
+        :param prefix: a prefix of names of metrics, defaults to **adtools**
+        :type prefix: str
+        :rtype: str
+        """
+        name: str = f'{prefix}_phase_seconds'
+        lines: List[str] = [
+            f'# HELP {name} Duration of phases of ad_login and discovery of domain controllers',
+            f'# TYPE {name} histogram',
+        ]
+        with self._lock:
+            items: List[Tuple[Tuple[str, str], List[float]]] = sorted((k, list(v)) for k, v in self._series.items())
+        for (phase_name, outcome), series in items:
+            labels: str = f'phase="{phase_name}",outcome="{outcome}"'
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {int(count)}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {int(series[-2])}')
+            lines.append(f'{name}_sum{{{labels}}} {series[-1]:.6f}')
+            lines.append(f'{name}_count{{{labels}}} {int(series[-2])}')
+        return '\n'.join(lines) + '\n'
+
+
+_default_metrics: Optional[PhaseMetrics] = None  #: metrics of the process registered if ADTOOLS_METRICS is set
+_default_metrics_lock: threading.Lock = threading.Lock()
+
+
+def get_default_metrics() -> Optional[PhaseMetrics]:
+    """
+    Returns metrics of the process if ADTOOLS_METRICS is set in settings.py, they are registered as a hook
+    at the first call (the application does it at startup)
+
+    :return: metrics shared by the process or None if ADTOOLS_METRICS is not set
+    :rtype: PhaseMetrics, optional
+    """
+    global _default_metrics
+    if _default_metrics is None:
+        from django.conf import settings
+        if not getattr(settings, 'ADTOOLS_METRICS', False):
+            return None
+        with _default_metrics_lock:
+            if _default_metrics is None:
+                metrics: PhaseMetrics = PhaseMetrics()
+                register_hook(metrics)
+                _default_metrics = metrics
+    return _default_metrics
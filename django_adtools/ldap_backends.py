@@ -0,0 +1,58 @@
+"""
+django_adtools/ldap_backends.py
+
+Selection of the implementation of LDAP connections used by ad_tools, async_ad_tools, the pool and discovery:
+
+* **python-ldap** - ldap.initialize, the OpenLDAP C library (the default)
+* **pure** - PureLDAPObject, a pure-Python client, its async views wait for responses in the event loop
+* a dotted path of a callable which takes a LDAP URI and returns a connection with the python-ldap interface
+
+.. code-block:: python
+
+    ADTOOLS_LDAP_BACKEND: str = 'pure'
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-13"
+
+from .ldap_compat import ldap
+from .pure_ldap import PureLDAPObject
+# type hints
+from typing import Callable, Dict, Optional
+
+BACKEND_PYTHON_LDAP: str = 'python-ldap'  #: connections of python-ldap
+BACKEND_PURE: str = 'pure'  #: connections of the pure-Python client
+
+#: names of backends -> functions which create connections
+BACKENDS: Dict[str, Callable[[str], ldap.ldapobject.SimpleLDAPObject]] = {
+    BACKEND_PYTHON_LDAP: lambda uri: ldap.initialize(uri),
+    BACKEND_PURE: PureLDAPObject,
+}
+
+
+def get_backend() -> str:
+    """
+    Returns the backend configured by ADTOOLS_LDAP_BACKEND in settings.py, defaults to **python-ldap**
+    """
+    from django.conf import settings
+    return getattr(settings, 'ADTOOLS_LDAP_BACKEND', BACKEND_PYTHON_LDAP)
+
+
+def initialize(uri: str, backend: Optional[str] = None) -> ldap.ldapobject.SimpleLDAPObject:
+    """
+    Creates a connection to the LDAP server, the TCP connection is opened by the first operation
+
+    :param uri: a LDAP URI, e.g. **ldap://10.0.0.1**
+    :type uri: str
+    :param backend: a name of a backend or a dotted path of a function of the URI,
+        defaults to **None** (ADTOOLS_LDAP_BACKEND)
+    :type backend: str, optional
+    :return: a connection with the interface of ldap.ldapobject.SimpleLDAPObject
+    :rtype: ldap.ldapobject.SimpleLDAPObject
+    :raises ImportError: if the backend is unknown
+    """
+    name: str = backend or get_backend()
+    factory: Optional[Callable[[str], ldap.ldapobject.SimpleLDAPObject]] = BACKENDS.get(name)
+    if factory is None:
+        from django.utils.module_loading import import_string
+        factory = import_string(name)
+    return factory(uri)
@@ -0,0 +1,32 @@
+"""
+django_adtools/ldap_compat.py
+
+The python-ldap API of django_adtools: python-ldap if it is installed, ldap_fallback otherwise.
+Modules of the package import **ldap** from here, so exceptions, constants and controls are the same
+for both backends and python-ldap (with the OpenLDAP C library) is required only by the python-ldap backend:
+
+.. code-block:: python
+
+    from django_adtools.ldap_compat import ldap
+
+    try:
+        conn.simple_bind_s(username, password)
+    except ldap.INVALID_CREDENTIALS:
+        ...
+
+REQUIREMENTS:
+   pip install python-ldap  # optional, for ADTOOLS_LDAP_BACKEND = 'python-ldap' (the default)
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-18"
+
+try:
+    import ldap
+    import ldap.controls
+    import ldap.dn
+    import ldap.filter
+    import ldap.ldapobject
+    PYTHON_LDAP: bool = True  #: python-ldap is installed
+except ImportError:
+    from . import ldap_fallback as ldap
+    PYTHON_LDAP = False
@@ -0,0 +1,830 @@
+"""
+django_adtools/ldap_emulator.py
+
+An in-process emulator of an Active Directory domain controller for tests and benchmarks.
+It speaks LDAPv3 (RFC 4511) on a random free TCP port, like dnslib.DNSServer emulates a DNS server:
+
+.. code-block:: python
+
+    directory = LDAPDirectory('example.com')
+    directory.seed(users=100, groups=10)
+    with LDAPEmulator(directory, latency=0.002) as emulator:
+        ad_login(dc=emulator.dc, username='user1@example.com', password=DEFAULT_PASSWORD,
+                 domain='example.com', group='group1')
+
+Supported operations are simple bind (by a DN, **user@domain**, **DOMAIN\\user** or a username), search
+(all filters including the LDAP_MATCHING_RULE_IN_CHAIN rule, the paged results and the Show Deleted controls),
+abandon, unbind and the WhoAmI extended operation. Like Active Directory, the emulator refuses anonymous searches
+except reading the rootDSE and limits the number of entries of a search (MaxPageSize).
+With a server SSL context it supports StartTLS, or LDAPS if **ldaps** is set, and resumes TLS sessions.
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-10"
+
+import ssl
+import uuid
+import socket
+import socketserver
+import threading
+import logging
+from collections import Counter
+from .ber import (
+    BERDecodeError, decode, decode_elements, decode_integer, decode_boolean, element_length, encode,
+    encode_integer, encode_enumerated, encode_octet_string, encode_sequence, encode_set, application, context,
+    TAG_SEQUENCE,
+)
+# type hints
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+DEFAULT_PASSWORD: str = 'Passw0rd'  #: the password of seeded users
+
+LDAP_MATCHING_RULE_IN_CHAIN: str = '1.2.840.113556.1.4.1941'
+PAGED_RESULTS_OID: str = '1.2.840.113556.1.4.319'
+SHOW_DELETED_OID: str = '1.2.840.113556.1.4.417'
+WHOAMI_OID: str = '1.3.6.1.4.1.4203.1.11.3'
+STARTTLS_OID: str = '1.3.6.1.4.1.1466.20037'
+
+# result codes
+SUCCESS: int = 0
+OPERATIONS_ERROR: int = 1
+PROTOCOL_ERROR: int = 2
+SIZELIMIT_EXCEEDED: int = 4
+NO_SUCH_OBJECT: int = 32
+INVALID_CREDENTIALS: int = 49
+UNAVAILABLE: int = 52
+UNWILLING_TO_PERFORM: int = 53
+
+# protocol operations
+BIND_REQUEST: int = application(0)
+BIND_RESPONSE: int = application(1)
+UNBIND_REQUEST: int = application(2, constructed=False)
+SEARCH_REQUEST: int = application(3)
+SEARCH_RESULT_ENTRY: int = application(4)
+SEARCH_RESULT_DONE: int = application(5)
+ABANDON_REQUEST: int = application(16, constructed=False)
+EXTENDED_REQUEST: int = application(23)
+EXTENDED_RESPONSE: int = application(24)
+CONTROLS: int = context(0, constructed=True)
+
+SCOPE_BASE: int = 0
+SCOPE_ONELEVEL: int = 1
+SCOPE_SUBTREE: int = 2
+
+Attributes = Dict[str, List[bytes]]  #: attribute name -> values
+Filter = Tuple  #: a parsed search filter, e.g. ('eq', 'objectclass', b'user')
+Control = Tuple[str, bool, Optional[bytes]]  #: OID, criticality and value of a control
+
+_INVALID_CREDENTIALS_MESSAGE: str = ('80090308: LdapErr: DSID-0C09042A, comment: AcceptSecurityContext error,'
+                                     ' data 52e, v3839')
+_BIND_REQUIRED_MESSAGE: str = ('000004DC: LdapErr: DSID-0C090A5C, comment: In order to perform this operation'
+                               ' a successful bind must be completed on the connection., data 0, v3839')
+
+
+def normalize_dn(dn: str) -> str:
+    """
+    Returns the DN in lowercase without spaces around RDNs, e.g. **cn=user,dc=example,dc=com**
+    """
+    return ','.join('='.join(x.strip() for x in rdn.split('=', 1)) for rdn in dn.split(',')).lower()
+
+
+def _parent_dn(dn: str) -> str:
+    return dn.split(',', 1)[1] if ',' in dn else ''
+
+
+def _to_values(value: Any) -> List[bytes]:
+    """
+    Converts a value or a list of values of an attribute to a list of bytes
+    """
+    values: Iterable[Any] = value if isinstance(value, (list, tuple, set)) else [value]
+    return [x if isinstance(x, bytes) else str(x).encode('utf-8') for x in values]
+
+
+class _Entry:
+    """
+    An entry of the directory, attribute names are case insensitive
+    """
+    __slots__ = ('dn', 'attributes', 'password', 'deleted')
+
+    def __init__(self, dn: str, password: Optional[str] = None) -> None:
+        self.dn: str = dn
+        self.attributes: Dict[str, Tuple[str, List[bytes]]] = {}  # lowercase name -> (name, values)
+        self.password: Optional[str] = password
+        self.deleted: bool = False
+
+    def get(self, name: str) -> List[bytes]:
+        return self.attributes.get(name.lower(), ('', []))[1]
+
+    def set(self, name: str, values: List[bytes]) -> None:
+        if values:
+            self.attributes[name.lower()] = (name, values)
+        else:
+            self.attributes.pop(name.lower(), None)
+
+
+class LDAPDirectory:
+    """
+    Users, groups and other entries of an emulated domain. Every change increments the update sequence number
+    (highestCommittedUSN) and sets uSNChanged of the changed entry, deleted entries become tombstones
+    """
+
+    def __init__(self, domain: str) -> None:
+        """
+        :param domain: full name of the domain, e.g. **example.com**
+        :type domain: str
+        """
+        self.domain: str = domain
+        self.base: str = ','.join('DC=%s' % x for x in domain.split('.'))
+        self.netbios_name: str = domain.split('.')[0].upper()
+        self.usn: int = 0
+        self.lock: threading.RLock = threading.RLock()
+        self._entries: Dict[str, _Entry] = {}  # normalized DN -> entry
+        self.add(self.base, {'objectClass': ['top', 'domain', 'domainDNS'], 'dc': domain.split('.')[0]})
+        self.add(f'CN=Users,{self.base}', {'objectClass': ['top', 'container'], 'cn': 'Users'})
+
+    def _touch(self, entry: _Entry) -> None:
+        self.usn += 1
+        entry.set('uSNChanged', _to_values(self.usn))
+
+    def _entry(self, dn: str) -> _Entry:
+        entry: Optional[_Entry] = self._entries.get(normalize_dn(dn))
+        if entry is None or entry.deleted:
+            raise KeyError(dn)
+        return entry
+
+    def add(self, dn: str, attributes: Dict[str, Any], password: Optional[str] = None) -> str:
+        """
+        Adds an entry, objectGUID, uSNCreated and uSNChanged are generated
+
+        :param dn: a distinguished name of the entry
+        :type dn: str
+        :param attributes: attribute name -> a value or a list of values (str, int or bytes)
+        :type attributes: Dict[str, Any]
+        :param password: a password to bind with the DN of the entry, defaults to **None** (binding is not allowed)
+        :type password: str, optional
+        :return: the distinguished name
+        :rtype: str
+        """
+        with self.lock:
+            entry: _Entry = _Entry(dn, password=password)
+            entry.set('distinguishedName', _to_values(dn))
+            entry.set('objectGUID', [uuid.uuid5(uuid.NAMESPACE_X500, normalize_dn(dn)).bytes_le])
+            for name, value in attributes.items():
+                entry.set(name, _to_values(value))
+            self._touch(entry)
+            entry.set('uSNCreated', entry.get('uSNChanged'))
+            self._entries[normalize_dn(dn)] = entry
+        return dn
+
+    def modify(self, dn: str, attributes: Dict[str, Any]) -> None:
+        """
+        Replaces values of attributes of the entry, an empty list removes the attribute
+
+        :raises KeyError: if the entry does not exist
+        """
+        with self.lock:
+            entry: _Entry = self._entry(dn)
+            for name, value in attributes.items():
+                entry.set(name, _to_values(value))
+            self._touch(entry)
+
+    def delete(self, dn: str) -> None:
+        """
+        Turns the entry into a tombstone, it is found only by searches with the Show Deleted control
+
+        :raises KeyError: if the entry does not exist
+        """
+        with self.lock:
+            entry: _Entry = self._entry(dn)
+            for group_dn in entry.get('memberOf'):
+                self.remove_member(group_dn.decode('utf-8'), dn)
+            entry.attributes = {
+                key: value for key, value in entry.attributes.items() if key in ('objectguid', 'distinguishedname')
+            }
+            entry.set('isDeleted', [b'TRUE'])
+            entry.deleted = True
+            entry.password = None
+            self._touch(entry)
+
+    def get(self, dn: str) -> Attributes:
+        """
+        Returns a copy of attributes of the entry
+
+        :raises KeyError: if the entry does not exist
+        """
+        with self.lock:
+            return {name: list(values) for name, values in self._entry(dn).attributes.values()}
+
+    def _dn(self, name: str) -> str:
+        return name if '=' in name else f'CN={name},CN=Users,{self.base}'
+
+    def add_member(self, group: str, member: str) -> None:
+        """
+        Adds the member into the group, member and memberOf attributes are updated
+
+        :param group: a name or a DN of the group
+        :type group: str
+        :param member: a name or a DN of a user or a group
+        :type member: str
+        :raises KeyError: if an entry does not exist
+        """
+        with self.lock:
+            group_entry: _Entry = self._entry(self._dn(group))
+            member_entry: _Entry = self._entry(self._dn(member))
+            group_entry.set('member', group_entry.get('member') + _to_values(member_entry.dn))
+            member_entry.set('memberOf', member_entry.get('memberOf') + _to_values(group_entry.dn))
+            self._touch(group_entry)
+
+    def remove_member(self, group: str, member: str) -> None:
+        """
+        Removes the member from the group
+
+        :raises KeyError: if an entry does not exist
+        """
+        with self.lock:
+            group_entry: _Entry = self._entry(self._dn(group))
+            member_entry: _Entry = self._entry(self._dn(member))
+            group_entry.set('member', [x for x in group_entry.get('member')
+                                       if normalize_dn(x.decode('utf-8')) != normalize_dn(member_entry.dn)])
+            member_entry.set('memberOf', [x for x in member_entry.get('memberOf')
+                                          if normalize_dn(x.decode('utf-8')) != normalize_dn(group_entry.dn)])
+            self._touch(group_entry)
+
+    def add_group(self, name: str, groups: Iterable[str] = (), description: str = '') -> str:
+        """
+        Adds a group into CN=Users of the domain
+
+        :param name: the name of the group (cn and sAMAccountName)
+        :type name: str
+        :param groups: names of groups the group is a member of
+        :type groups: Iterable[str]
+        :param description: a description of the group
+        :type description: str
+        :return: the distinguished name of the group
+        :rtype: str
+        """
+        attributes: Dict[str, Any] = {
+            'objectClass': ['top', 'group'],
+            'objectCategory': f'CN=Group,CN=Schema,CN=Configuration,{self.base}',
+            'cn': name,
+            'sAMAccountName': name,
+            'groupType': -2147483646,
+        }
+        if description:
+            attributes['description'] = description
+        dn: str = self.add(self._dn(name), attributes)
+        for group in groups:
+            self.add_member(group, dn)
+        return dn
+
+    def add_user(self,
+                 username: str,
+                 password: str = DEFAULT_PASSWORD,
+                 groups: Iterable[str] = (),
+                 first_name: str = '',
+                 last_name: str = '',
+                 email: str = '',
+                 disabled: bool = False,
+                 ) -> str:
+        """
+        Adds a user into CN=Users of the domain
+
+        :param username: sAMAccountName of the user, its userPrincipalName is **username@domain**
+        :type username: str
+        :param password: the password of the user, defaults to **DEFAULT_PASSWORD**
+        :type password: str
+        :param groups: names of groups the user is a member of
+        :type groups: Iterable[str]
+        :param first_name: givenName
+        :type first_name: str
+        :param last_name: sn
+        :type last_name: str
+        :param email: mail
+        :type email: str
+        :param disabled: the account is disabled (userAccountControl)
+        :type disabled: bool
+        :return: the distinguished name of the user
+        :rtype: str
+        """
+        attributes: Dict[str, Any] = {
+            'objectClass': ['top', 'person', 'organizationalPerson', 'user'],
+            'objectCategory': f'CN=Person,CN=Schema,CN=Configuration,{self.base}',
+            'cn': username,
+            'sAMAccountName': username,
+            'userPrincipalName': f'{username}@{self.domain}',
+            'displayName': ' '.join(x for x in (first_name, last_name) if x) or username,
+            'userAccountControl': 0x202 if disabled else 0x200,
+        }
+        for name, value in (('givenName', first_name), ('sn', last_name), ('mail', email)):
+            if value:
+                attributes[name] = value
+        dn: str = self.add(self._dn(username), attributes, password=password)
+        for group in groups:
+            self.add_member(group, dn)
+        return dn
+
+    def seed(self, users: int = 100, groups: int = 10, password: str = DEFAULT_PASSWORD) -> List[str]:
+        """
+        Adds groups **group0** ... and users **user0** ..., the user N is a member of the group N % groups,
+        every group except **group0** is a member of **group0** (so all users are its nested members)
+
+        :param users: number of users
+        :type users: int
+        :param groups: number of groups
+        :type groups: int
+        :param password: the password of all users, defaults to **DEFAULT_PASSWORD**
+        :type password: str
+        :return: usernames
+        :rtype: List[str]
+        """
+        for index in range(groups):
+            self.add_group(f'group{index}', groups=['group0'] if index else [])
+        usernames: List[str] = [f'user{index}' for index in range(users)]
+        for index, username in enumerate(usernames):
+            self.add_user(username, password=password, groups=[f'group{index % groups}'] if groups else [],
+                          first_name='User', last_name=str(index), email=f'{username}@{self.domain}')
+        return usernames
+
+    def authenticate(self, name: str, password: str) -> Optional[str]:
+        """
+        Returns the DN of the entry if the password is valid,
+        the name is a DN, a userPrincipalName, **DOMAIN\\username** or a sAMAccountName
+        """
+        with self.lock:
+            if '=' in name:
+                entry: Optional[_Entry] = self._entries.get(normalize_dn(name))
+            else:
+                attribute, value = ('userPrincipalName', name) if '@' in name else \
+                    ('sAMAccountName', name.split('\\')[-1])
+                entry = next((x for x in self._entries.values()
+                              if not x.deleted and value.lower().encode('utf-8') in
+                              [v.lower() for v in x.get(attribute)]), None)
+            if entry is None or entry.deleted or entry.password is None or entry.password != password:
+                return None
+            return entry.dn
+
+    def root_dse(self) -> Attributes:
+        """
+        Returns attributes of the rootDSE
+        """
+        return {
+            'defaultNamingContext': _to_values(self.base),
+            'dnsHostName': _to_values(f'emulator.{self.domain}'),
+            'highestCommittedUSN': _to_values(self.usn),
+            'currentTime': _to_values('20201010000000.0Z'),
+            'supportedLDAPVersion': _to_values(['2', '3']),
+            'supportedControl': _to_values([PAGED_RESULTS_OID, SHOW_DELETED_OID]),
+            'supportedExtension': _to_values([WHOAMI_OID]),
+        }
+
+    def _closure(self, entry: _Entry, attribute: str, value: str) -> bool:
+        """
+        Returns true if the DN is reachable from the entry by links of the attribute (LDAP_MATCHING_RULE_IN_CHAIN)
+        """
+        target: str = normalize_dn(value)
+        seen: Set[str] = set()
+        queue: List[_Entry] = [entry]
+        while queue:
+            for linked in queue.pop().get(attribute):
+                dn: str = normalize_dn(linked.decode('utf-8'))
+                if dn == target:
+                    return True
+                if dn not in seen and dn in self._entries:
+                    seen.add(dn)
+                    queue.append(self._entries[dn])
+        return False
+
+    def search(self, base: str, scope: int, search_filter: Filter, show_deleted: bool = False) -> List[_Entry]:
+        """
+        Returns entries matching the filter in the scope of the base
+
+        :raises KeyError: if the base does not exist
+        """
+        with self.lock:
+            normalized: str = normalize_dn(base)
+            if normalized not in self._entries:
+                raise KeyError(base)
+            entries: List[_Entry] = []
+            for dn, entry in self._entries.items():
+                if entry.deleted and not show_deleted:
+                    continue
+                if scope == SCOPE_BASE:
+                    in_scope: bool = dn == normalized
+                elif scope == SCOPE_ONELEVEL:
+                    in_scope = _parent_dn(dn) == normalized
+                else:
+                    in_scope = dn == normalized or dn.endswith(',' + normalized)
+                if in_scope and self._match(entry, search_filter):
+                    entries.append(entry)
+            return entries
+
+    def _match(self, entry: _Entry, search_filter: Filter) -> bool:
+        kind: str = search_filter[0]
+        if kind == 'and':
+            return all(self._match(entry, x) for x in search_filter[1])
+        if kind == 'or':
+            return any(self._match(entry, x) for x in search_filter[1])
+        if kind == 'not':
+            return not self._match(entry, search_filter[1])
+        if kind == 'present':
+            return search_filter[1] == 'objectclass' or bool(entry.get(search_filter[1]))
+        if kind == 'ext':
+            _, rule, attribute, value = search_filter
+            if rule == LDAP_MATCHING_RULE_IN_CHAIN:
+                return self._closure(entry, attribute, value.decode('utf-8'))
+            return self._match(entry, ('eq', attribute, value))
+        attribute, value = search_filter[1], search_filter[2]
+        values: List[bytes] = entry.get(attribute)
+        if kind == 'sub':
+            initial, middle, final = value
+            return any(_match_substrings(x.lower(), initial, middle, final) for x in values)
+        if attribute == 'objectcategory' and b'=' not in value:
+            # objectCategory=person means CN=Person,CN=Schema,... like in Active Directory
+            values = [x.split(b',')[0].split(b'=')[-1] for x in values]
+        if kind in ('eq', 'approx'):
+            if attribute in ('member', 'memberof', 'distinguishedname', 'objectcategory'):
+                return normalize_dn(value.decode('utf-8')) in [normalize_dn(x.decode('utf-8')) for x in values]
+            return value.lower() in [x.lower() for x in values]
+        for x in values:
+            if x.lstrip(b'-').isdigit() and value.lstrip(b'-').isdigit():
+                left, right = int(x), int(value)
+            else:
+                left, right = x.lower(), value.lower()
+            if (kind == 'ge' and left >= right) or (kind == 'le' and left <= right):
+                return True
+        return False
+
+
+def _match_substrings(value: bytes, initial: bytes, middle: List[bytes], final: bytes) -> bool:
+    if not value.startswith(initial):
+        return False
+    position: int = len(initial)
+    for part in middle:
+        position = value.find(part, position)
+        if position < 0:
+            return False
+        position += len(part)
+    return value[position:].endswith(final)
+
+
+def parse_filter(tag: int, value: bytes) -> Filter:
+    """
+    Parses a BER encoded search filter (RFC 4511 section 4.5.1.7), attribute names are lowercased
+
+    :raises BERDecodeError: if the filter is not valid
+    """
+    number: int = tag & 0x1f
+    if number in (0, 1):
+        return ('and' if number == 0 else 'or', [parse_filter(*x) for x in decode_elements(value)])
+    if number == 2:
+        return 'not', parse_filter(*decode(value)[:2])
+    if number == 7:
+        return 'present', value.decode('utf-8').lower()
+    elements = decode_elements(value)
+    if number == 4:
+        initial, middle, final = b'', [], b''
+        for part_tag, part in decode_elements(elements[1][1]):
+            if part_tag & 0x1f == 0:
+                initial = part.lower()
+            elif part_tag & 0x1f == 1:
+                middle.append(part.lower())
+            else:
+                final = part.lower()
+        return 'sub', elements[0][1].decode('utf-8').lower(), (initial, middle, final)
+    if number == 9:
+        parts: Dict[int, bytes] = {part_tag & 0x1f: part for part_tag, part in elements}
+        return 'ext', parts.get(1, b'').decode('utf-8'), parts.get(2, b'').decode('utf-8').lower(), parts[3]
+    kinds: Dict[int, str] = {3: 'eq', 5: 'ge', 6: 'le', 8: 'approx'}
+    if number not in kinds:
+        raise BERDecodeError(f'unknown filter [{number}]')
+    return kinds[number], elements[0][1].decode('utf-8').lower(), elements[1][1]
+
+
+class _Connection:
+    """
+    A state of a client connection
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock: socket.socket = sock
+        self.bound_dn: Optional[str] = None  # None means anonymous
+        self.write_lock: threading.Lock = threading.Lock()
+        self.abandoned: Set[int] = set()
+        self.start_tls: bool = False  # the StartTLS response is being sent, then the handshake is performed
+        self.tls: bool = False
+
+    def send(self, msgid: int, data: bytes) -> None:
+        with self.write_lock:
+            if msgid in self.abandoned:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        emulator: 'LDAPEmulator' = self.server.emulator
+        connection: _Connection = _Connection(self.request)
+        emulator._connections.add(connection)
+        buffer: bytes = b''
+        try:
+            if emulator.ldaps:
+                emulator._handshake(connection)
+            while True:
+                data: bytes = connection.sock.recv(65536)
+                if not data:
+                    return
+                buffer += data
+                while True:
+                    length: Optional[int] = element_length(buffer)
+                    if length is None:
+                        break
+                    message, buffer = buffer[:length], buffer[length:]
+                    if not emulator._process(connection, message):
+                        return
+        except (OSError, BERDecodeError, IndexError, KeyError, ValueError) as e:
+            logger.debug(f'{__package__} LDAPEmulator connection closed: {str(e)}')
+        finally:
+            emulator._connections.discard(connection)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    block_on_close = False
+
+
+def _result(code: int, message: str = '', matched_dn: str = '') -> List[bytes]:
+    return [encode_enumerated(code), encode_octet_string(matched_dn), encode_octet_string(message)]
+
+
+def _message(msgid: int, operation: bytes, controls: Optional[List[bytes]] = None) -> bytes:
+    elements: List[bytes] = [encode_integer(msgid), operation]
+    if controls:
+        elements.append(encode_sequence(controls, tag=CONTROLS))
+    return encode_sequence(elements)
+
+
+class LDAPEmulator:
+    """
+    A LDAP server of the directory running in a separate thread on a random free port
+    """
+
+    def __init__(self,
+                 directory: LDAPDirectory,
+                 host: str = '127.0.0.1',
+                 port: int = 0,
+                 latency: float = 0.0,
+                 size_limit: int = 1000,
+                 ssl_context: Optional[ssl.SSLContext] = None,
+                 ldaps: bool = False,
+                 ) -> None:
+        """
+        :param directory: the emulated directory
+        :type directory: LDAPDirectory
+        :param host: an address to listen on, defaults to **127.0.0.1**
+        :type host: str
+        :param port: a TCP port, defaults to **0** (a random free port)
+        :type port: int
+        :param latency: seconds added before every response, e.g. a network round trip time, defaults to **0**
+        :type latency: float
+        :param size_limit: maximum number of entries of a search or a page, defaults to **1000** (MaxPageSize)
+        :type size_limit: int
+        :param ssl_context: a server context with a certificate, it enables StartTLS, defaults to **None**
+        :type ssl_context: ssl.SSLContext, optional
+        :param ldaps: perform the TLS handshake at the start of every connection, defaults to **False**
+        :type ldaps: bool
+        """
+        self.directory: LDAPDirectory = directory
+        self.host: str = host
+        self.port: int = port
+        self.latency: float = latency
+        self.size_limit: int = size_limit
+        if ldaps and ssl_context is None:
+            raise ValueError(f'{__package__} LDAPEmulator ldaps requires ssl_context')
+        self.ssl_context: Optional[ssl.SSLContext] = ssl_context
+        self.ldaps: bool = ldaps
+        #: number of requests by operation: bind, search, ...; tls - TLS handshakes, tls_resumed - resumed ones
+        self.operations: Counter = Counter()
+        self._connections: Set[_Connection] = set()
+        self._server: Optional[_Server] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def dc(self) -> str:
+        """
+        The address of the emulator for ad_tools functions, e.g. **127.0.0.1:38389**
+        """
+        return f'{self.host}:{self.port}'
+
+    @property
+    def uri(self) -> str:
+        """
+        The LDAP URI of the emulator, e.g. **ldap://127.0.0.1:38389** or **ldaps://127.0.0.1:38389**
+        """
+        return f'{"ldaps" if self.ldaps else "ldap"}://{self.dc}'
+
+    def start(self) -> 'LDAPEmulator':
+        """
+        Starts the server thread
+        """
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.emulator = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops the server and closes all client connections, clients get ldap.SERVER_DOWN
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        for connection in list(self._connections):
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._server = None
+
+    def __enter__(self) -> 'LDAPEmulator':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def _reply(self, connection: _Connection, msgid: int, responses: List[bytes]) -> None:
+        """
+        Sends responses of the message after the latency
+        """
+        data: bytes = b''.join(responses)
+        if self.latency > 0:
+            timer: threading.Timer = threading.Timer(self.latency, connection.send, args=(msgid, data))
+            timer.daemon = True
+            timer.start()
+        else:
+            connection.send(msgid, data)
+
+    def _process(self, connection: _Connection, message: bytes) -> bool:
+        """
+        Processes a LDAP message, returns false if the connection has to be closed
+        """
+        tag, content, _ = decode(message)
+        if tag != TAG_SEQUENCE:
+            raise BERDecodeError('LDAPMessage must be a SEQUENCE')
+        elements = decode_elements(content)
+        msgid: int = decode_integer(elements[0][1])
+        operation, value = elements[1]
+        controls: List[Control] = []
+        if len(elements) > 2 and elements[2][0] == CONTROLS:
+            for _, control in decode_elements(elements[2][1]):
+                parts = decode_elements(control)
+                oid: str = parts[0][1].decode('utf-8')
+                critical: bool = any(x[0] == 0x01 and decode_boolean(x[1]) for x in parts[1:])
+                controls.append((oid, critical, next((x[1] for x in parts[1:] if x[0] == 0x04), None)))
+        if operation == UNBIND_REQUEST:
+            self.operations['unbind'] += 1
+            return False
+        if operation == ABANDON_REQUEST:
+            self.operations['abandon'] += 1
+            connection.abandoned.add(decode_integer(value))
+            return True
+        if operation == BIND_REQUEST:
+            self.operations['bind'] += 1
+            self._reply(connection, msgid, [self._bind(connection, msgid, value)])
+        elif operation == SEARCH_REQUEST:
+            self.operations['search'] += 1
+            self._reply(connection, msgid, self._search(connection, msgid, value, controls))
+        elif operation == EXTENDED_REQUEST:
+            self.operations['extended'] += 1
+            response: bytes = self._extended(connection, msgid, value)
+            if connection.start_tls:
+                connection.send(msgid, response)  # without the latency, the handshake follows the response
+                self._handshake(connection)
+            else:
+                self._reply(connection, msgid, [response])
+        else:
+            self.operations['other'] += 1
+            self._reply(connection, msgid, [_message(msgid, encode_sequence(
+                _result(UNWILLING_TO_PERFORM, 'the operation is not supported by the emulator'),
+                tag=application((operation & 0x1f) + 1),
+            ))])
+        return True
+
+    def _bind(self, connection: _Connection, msgid: int, value: bytes) -> bytes:
+        elements = decode_elements(value)
+        name: str = elements[1][1].decode('utf-8')
+        auth_tag, password = elements[2]
+        if auth_tag != context(0):
+            code, message = UNWILLING_TO_PERFORM, 'only simple bind is supported by the emulator'
+        elif not password:
+            # an unauthenticated bind succeeds, but the connection stays anonymous
+            connection.bound_dn = None
+            code, message = SUCCESS, ''
+        else:
+            connection.bound_dn = self.directory.authenticate(name, password.decode('utf-8'))
+            code, message = (SUCCESS, '') if connection.bound_dn is not None else \
+                (INVALID_CREDENTIALS, _INVALID_CREDENTIALS_MESSAGE)
+        return _message(msgid, encode_sequence(_result(code, message), tag=BIND_RESPONSE))
+
+    def _handshake(self, connection: _Connection) -> None:
+        """
+        Performs the TLS handshake of the connection
+
+        :raises ssl.SSLError: if the handshake failed, e.g. the client does not trust the certificate
+        """
+        connection.sock = self.ssl_context.wrap_socket(connection.sock, server_side=True)
+        connection.start_tls = False
+        connection.tls = True
+        self.operations['tls'] += 1
+        if connection.sock.session_reused:
+            self.operations['tls_resumed'] += 1
+
+    def _extended(self, connection: _Connection, msgid: int, value: bytes) -> bytes:
+        parts: Dict[int, bytes] = {tag: part for tag, part in decode_elements(value)}
+        if parts.get(context(0), b'').decode('utf-8') == STARTTLS_OID:
+            if self.ssl_context is None or connection.tls:
+                return _message(msgid, encode_sequence(
+                    _result(UNAVAILABLE, 'TLS is not available' if self.ssl_context is None
+                            else 'TLS is already started') + [encode_octet_string(STARTTLS_OID, tag=context(10))],
+                    tag=EXTENDED_RESPONSE,
+                ))
+            connection.start_tls = True
+            return _message(msgid, encode_sequence(
+                _result(SUCCESS) + [encode_octet_string(STARTTLS_OID, tag=context(10))], tag=EXTENDED_RESPONSE,
+            ))
+        if parts.get(context(0), b'').decode('utf-8') != WHOAMI_OID:
+            return _message(msgid, encode_sequence(
+                _result(PROTOCOL_ERROR, 'the extended operation is not supported'), tag=EXTENDED_RESPONSE,
+            ))
+        authz_id: str = f'dn:{connection.bound_dn}' if connection.bound_dn else ''
+        return _message(msgid, encode_sequence(
+            _result(SUCCESS) + [encode_octet_string(authz_id, tag=context(11))], tag=EXTENDED_RESPONSE,
+        ))
+
+    def _search(self, connection: _Connection, msgid: int, value: bytes, controls: List[Control]) -> List[bytes]:
+        elements = decode_elements(value)
+        base: str = elements[0][1].decode('utf-8')
+        scope: int = decode_integer(elements[1][1])
+        size_limit: int = decode_integer(elements[3][1])
+        types_only: bool = decode_boolean(elements[5][1])
+        search_filter: Filter = parse_filter(*elements[6])
+        requested: List[str] = [x[1].decode('utf-8').lower() for x in decode_elements(elements[7][1])]
+
+        def done(code: int, message: str = '', response_controls: Optional[List[bytes]] = None) -> bytes:
+            return _message(msgid, encode_sequence(_result(code, message), tag=SEARCH_RESULT_DONE),
+                            response_controls)
+
+        if not base and scope == SCOPE_BASE:
+            entries: List[Tuple[str, Attributes]] = [('', self.directory.root_dse())]
+        elif connection.bound_dn is None:
+            return [done(OPERATIONS_ERROR, _BIND_REQUIRED_MESSAGE)]
+        else:
+            show_deleted: bool = any(oid == SHOW_DELETED_OID for oid, _, _ in controls)
+            try:
+                found: List[_Entry] = self.directory.search(base, scope, search_filter, show_deleted=show_deleted)
+            except KeyError:
+                return [done(NO_SUCH_OBJECT, f'0000208D: NameErr: DSID-03100241, problem 2001 (NO_OBJECT),'
+                                             f' data 0, best match of: \'{self.directory.base}\'')]
+            with self.directory.lock:
+                entries = [(x.dn, {name: list(values) for name, values in x.attributes.values()}) for x in found]
+        paged: Optional[bytes] = next((x[2] for x in controls if x[0] == PAGED_RESULTS_OID), None)
+        response_controls: Optional[List[bytes]] = None
+        code: int = SUCCESS
+        if paged is not None:
+            parts = decode_elements(decode(paged)[1])
+            page_size: int = min(decode_integer(parts[0][1]), self.size_limit)
+            offset: int = int(parts[1][1] or b'0')
+            total: int = len(entries)
+            # a page size of 0 abandons the paged search
+            entries = entries[offset:offset + page_size] if page_size else []
+            cookie: bytes = str(offset + page_size).encode() if page_size and offset + page_size < total else b''
+            response_controls = [encode_sequence([
+                encode_octet_string(PAGED_RESULTS_OID),
+                encode_octet_string(encode_sequence([encode_integer(0), encode_octet_string(cookie)])),
+            ])]
+        else:
+            limits: List[int] = [x for x in (size_limit, self.size_limit) if x > 0]
+            if limits and len(entries) > min(limits):
+                entries, code = entries[:min(limits)], SIZELIMIT_EXCEEDED
+        responses: List[bytes] = []
+        for dn, attributes in entries:
+            selected: List[bytes] = []
+            for name, values in attributes.items():
+                if not requested or '*' in requested or name.lower() in requested:
+                    selected.append(encode_sequence([
+                        encode_octet_string(name),
+                        encode_set([] if types_only else [encode_octet_string(x) for x in values]),
+                    ]))
+            responses.append(_message(msgid, encode_sequence(
+                [encode_octet_string(dn), encode_sequence(selected)], tag=SEARCH_RESULT_ENTRY,
+            )))
+        responses.append(done(code, 'Sizelimit exceeded' if code else '', response_controls))
+        return responses
@@ -0,0 +1,293 @@
+"""
+django_adtools/ldap_fallback.py
+
+The part of the python-ldap API used by django_adtools, defined with the same names and values:
+exceptions, constants, controls (ldap.controls), escaping of filters (ldap.filter) and parsing
+of distinguished names (ldap.dn). It is used instead of python-ldap if python-ldap is not installed
+(see ldap_compat), then connections are created only by the pure backend (ADTOOLS_LDAP_BACKEND = 'pure')
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-18"
+
+from types import SimpleNamespace
+from .ber import encode_sequence, encode_integer, encode_octet_string, decode, decode_elements, decode_integer
+# type hints
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+SCOPE_BASE: int = 0
+SCOPE_ONELEVEL: int = 1
+SCOPE_SUBTREE: int = 2
+
+RES_ANY: int = -1
+RES_BIND: int = 0x61
+RES_SEARCH_ENTRY: int = 0x64
+RES_SEARCH_RESULT: int = 0x65
+RES_SEARCH_REFERENCE: int = 0x73
+RES_EXTENDED: int = 0x78
+
+AUTH_SIMPLE: int = 0x80
+
+OPT_REFERRALS: int = 0x0008
+OPT_TIMEOUT: int = 0x5002
+OPT_NETWORK_TIMEOUT: int = 0x5005
+OPT_X_TLS_CACERTFILE: int = 0x6002
+OPT_X_TLS_REQUIRE_CERT: int = 0x6006
+OPT_X_TLS_NEVER: int = 0
+OPT_X_TLS_HARD: int = 1
+OPT_X_TLS_DEMAND: int = 2
+OPT_X_TLS_ALLOW: int = 3
+OPT_X_TLS_TRY: int = 4
+
+AVA_STRING: int = 0x0001  #: flags of values of str2dn
+
+
+class LDAPError(Exception):
+    """
+    The base of LDAP exceptions, its argument is a dict like the one of python-ldap exceptions:
+    desc, info, result, matched, msgid, ctrls
+    """
+    errnum: int = 0  #: the LDAP result code, negative codes are errors of the client
+
+
+#: names of exceptions -> result codes (RFC 4511) and codes of errors of the client (libldap)
+ERRORS: Dict[str, int] = {
+    'OPERATIONS_ERROR': 1,
+    'PROTOCOL_ERROR': 2,
+    'TIMELIMIT_EXCEEDED': 3,
+    'SIZELIMIT_EXCEEDED': 4,
+    'AUTH_METHOD_NOT_SUPPORTED': 7,
+    'STRONG_AUTH_REQUIRED': 8,
+    'REFERRAL': 10,
+    'ADMINLIMIT_EXCEEDED': 11,
+    'UNAVAILABLE_CRITICAL_EXTENSION': 12,
+    'CONFIDENTIALITY_REQUIRED': 13,
+    'NO_SUCH_ATTRIBUTE': 16,
+    'NO_SUCH_OBJECT': 32,
+    'INVALID_DN_SYNTAX': 34,
+    'INAPPROPRIATE_AUTH': 48,
+    'INVALID_CREDENTIALS': 49,
+    'INSUFFICIENT_ACCESS': 50,
+    'BUSY': 51,
+    'UNAVAILABLE': 52,
+    'UNWILLING_TO_PERFORM': 53,
+    'OTHER': 80,
+    'SERVER_DOWN': -1,
+    'LOCAL_ERROR': -2,
+    'DECODING_ERROR': -4,
+    'TIMEOUT': -5,
+    'FILTER_ERROR': -7,
+    'CONNECT_ERROR': -11,
+}
+
+for _name, _errnum in ERRORS.items():
+    globals()[_name] = type(_name, (LDAPError,), {'errnum': _errnum, '__module__': __name__})
+
+
+def initialize(uri: str, *args: Any, **kwargs: Any) -> Any:
+    """
+    Connections of the python-ldap backend can not be created without python-ldap
+
+    :raises ImportError: always
+    """
+    raise ImportError(f'{__package__} python-ldap is not installed, '
+                      f'install it or set ADTOOLS_LDAP_BACKEND = "pure", uri={uri}')
+
+
+class SimpleLDAPObject:
+    """
+    The interface of connections in type hints, connections are created by the pure backend (PureLDAPObject)
+    """
+
+
+# ldap.controls
+
+class RequestControl:
+    """
+    A control of a request, the value is encoded by encodeControlValue
+    """
+
+    def __init__(self, controlType: Optional[str] = None, criticality: bool = False,
+                 encodedControlValue: Optional[bytes] = None):
+        self.controlType: Optional[str] = controlType
+        self.criticality: bool = criticality
+        self.encodedControlValue: Optional[bytes] = encodedControlValue
+
+    def encodeControlValue(self) -> Optional[bytes]:
+        return self.encodedControlValue
+
+
+class ResponseControl:
+    """
+    A control of a response, the value is decoded by decodeControlValue
+    """
+
+    def __init__(self, controlType: Optional[str] = None, criticality: bool = False):
+        self.controlType: Optional[str] = controlType
+        self.criticality: bool = criticality
+
+    def decodeControlValue(self, encodedControlValue: Optional[bytes]) -> None:
+        self.encodedControlValue: Optional[bytes] = encodedControlValue
+
+
+class LDAPControl(RequestControl, ResponseControl):
+    """
+    A control with an already encoded value, e.g. LDAPControl('1.2.840.113556.1.4.417', True, None)
+    """
+
+    def __init__(self, controlType: Optional[str] = None, criticality: bool = False, controlValue: Any = None,
+                 encodedControlValue: Optional[bytes] = None):
+        RequestControl.__init__(self, controlType, criticality, encodedControlValue)
+        self.controlValue: Any = controlValue
+
+
+class SimplePagedResultsControl(LDAPControl):
+    """
+    The simple paged results control (RFC 2696)
+
+    :param criticality: defaults to **False**
+    :type criticality: bool
+    :param size: the size of a page in a request, an estimate of the number of entries in a response
+    :type size: int
+    :param cookie: empty in the first request, the cookie of the previous response in next ones
+    :type cookie: Union[str, bytes]
+    """
+    controlType: str = '1.2.840.113556.1.4.319'
+
+    def __init__(self, criticality: bool = False, size: int = 10, cookie: Union[str, bytes] = ''):
+        LDAPControl.__init__(self, self.controlType, criticality)
+        self.size: int = size
+        self.cookie: Union[str, bytes] = cookie
+
+    def encodeControlValue(self) -> bytes:
+        return encode_sequence([encode_integer(self.size), encode_octet_string(self.cookie or b'')])
+
+    def decodeControlValue(self, encodedControlValue: Optional[bytes]) -> None:
+        try:
+            elements = decode_elements(decode(encodedControlValue or b'')[1])
+            self.size, self.cookie = decode_integer(elements[0][1]), elements[1][1]
+        except (ValueError, IndexError) as e:
+            raise DECODING_ERROR({'desc': 'Decoding error', 'info': f'paged results control: {str(e)}'})  # noqa
+
+
+#: types of response controls -> classes which decode them
+KNOWN_RESPONSE_CONTROLS: Dict[str, Type[ResponseControl]] = {
+    SimplePagedResultsControl.controlType: SimplePagedResultsControl,
+}
+
+
+def DecodeControlTuples(ldapControlTuples: Optional[List[Tuple[str, bool, Optional[bytes]]]],
+                        knownLDAPControls: Optional[Dict[str, Type[ResponseControl]]] = None,
+                        ) -> List[ResponseControl]:
+    """
+    Decodes (type, criticality, value) of response controls, unknown non-critical controls are skipped
+
+    :raises UNAVAILABLE_CRITICAL_EXTENSION: if an unknown control is critical
+    """
+    known: Dict[str, Type[ResponseControl]] = KNOWN_RESPONSE_CONTROLS if knownLDAPControls is None \
+        else knownLDAPControls
+    result: List[ResponseControl] = []
+    for control_type, criticality, value in ldapControlTuples or []:
+        control_class: Optional[Type[ResponseControl]] = known.get(control_type)
+        if control_class is None:
+            if criticality:
+                raise UNAVAILABLE_CRITICAL_EXTENSION({  # noqa
+                    'desc': 'Unavailable critical extension', 'info': f'unknown response control {control_type}',
+                })
+            continue
+        control: ResponseControl = control_class.__new__(control_class)
+        control.controlType, control.criticality = control_type, criticality
+        control.decodeControlValue(value)
+        result.append(control)
+    return result
+
+
+# ldap.filter
+
+def escape_filter_chars(assertion_value: str, escape_mode: int = 0) -> str:
+    """
+    Escapes characters which have a meaning in search filters (RFC 4515): \\\\, \\*, (, ) and NUL
+
+    :raises ValueError: if escape_mode is not 0, other modes of python-ldap are not used by django_adtools
+    """
+    if escape_mode != 0:
+        raise ValueError(f'{__package__} escape_filter_chars supports only escape_mode=0')
+    return assertion_value.replace('\\', r'\5c').replace('*', r'\2a').replace('(', r'\28').replace(
+        ')', r'\29').replace('\x00', r'\00')
+
+
+# ldap.dn
+
+_HEX_DIGITS: bytes = b'0123456789abcdefABCDEF'
+
+
+def str2dn(dn: str, flags: int = 0) -> List[List[Tuple[str, str, int]]]:
+    """
+    Parses a distinguished name in the string representation (RFC 4514), e.g. **CN=Smith\\, John,DC=example,DC=com**
+
+    :param dn: the distinguished name
+    :type dn: str
+    :param flags: not used, the argument of python-ldap
+    :type flags: int
+    :return: RDNs, every RDN is a list of (attribute, value, AVA_STRING), escaped characters of values are decoded
+    :rtype: List[List[Tuple[str, str, int]]]
+    :raises DECODING_ERROR: if the distinguished name is not valid
+    """
+    data: bytes = dn.encode('utf-8')
+    rdns: List[List[Tuple[str, str, int]]] = []
+    rdn: List[Tuple[str, str, int]] = []
+    attribute: Optional[str] = None
+    token: bytearray = bytearray()
+    escaped: int = 0  # the length of the token up to its last escaped character, it is not stripped
+    position: int = 0
+
+    def ava() -> Tuple[str, str, int]:
+        value: bytes = bytes(token[:escaped]) + bytes(token[escaped:]).rstrip(b' ')
+        if not attribute:
+            raise DECODING_ERROR({'desc': 'Decoding error', 'info': f'an attribute expected, dn={dn}'})  # noqa
+        return attribute, value.decode('utf-8'), AVA_STRING
+
+    while position < len(data):
+        char: int = data[position]
+        position += 1
+        if char == 0x5c:  # a backslash
+            pair: bytes = data[position:position + 2]
+            if len(pair) == 2 and all(x in _HEX_DIGITS for x in pair):
+                token.append(int(pair, 16))
+                position += 2
+            elif pair:
+                token.append(pair[0])
+                position += 1
+            else:
+                raise DECODING_ERROR({'desc': 'Decoding error', 'info': f'a trailing backslash, dn={dn}'})  # noqa
+            escaped = len(token)
+        elif char == 0x3d and attribute is None:  # =
+            attribute = token.decode('utf-8').strip()
+            token, escaped = bytearray(), 0
+        elif char in (0x2c, 0x3b, 0x2b):  # , ; +
+            rdn.append(ava())
+            if char != 0x2b:
+                rdns.append(rdn)
+                rdn = []
+            attribute, token, escaped = None, bytearray(), 0
+        elif char == 0x20 and not token:
+            continue  # spaces before an attribute or a value
+        else:
+            token.append(char)
+    if attribute is not None or token or rdn:
+        rdn.append(ava())
+        rdns.append(rdn)
+    return rdns
+
+
+#: submodules of python-ldap used by django_adtools
+controls = SimpleNamespace(
+    RequestControl=RequestControl,
+    ResponseControl=ResponseControl,
+    LDAPControl=LDAPControl,
+    SimplePagedResultsControl=SimplePagedResultsControl,
+    KNOWN_RESPONSE_CONTROLS=KNOWN_RESPONSE_CONTROLS,
+    DecodeControlTuples=DecodeControlTuples,
+)
+filter = SimpleNamespace(escape_filter_chars=escape_filter_chars)
+dn = SimpleNamespace(str2dn=str2dn)
+ldapobject = SimpleNamespace(SimpleLDAPObject=SimpleLDAPObject)
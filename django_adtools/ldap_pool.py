@@ -0,0 +1,394 @@
+"""
+django_adtools/ldap_pool.py
+
+A bounded pool of reusable LDAP connections to domain controllers.
+
+Connections in the pool are bound with a service account, so they can be used for searches (user_dn, dn_groups).
+A user password is verified on a pooled connection too, the connection is rebound to the service account afterwards.
+
+REQUIREMENTS:
+   pip install python-ldap  # on linux, not required by ADTOOLS_LDAP_BACKEND = 'pure'
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-09-24"
+
+import os
+import time
+import threading
+import logging
+from contextlib import contextmanager
+from .ldap_compat import ldap
+from .deadline import Deadline, DeadlineExceeded, cap
+from .ldap_backends import initialize
+from .tls import apply_tls, get_tls_mode, TLS_LDAPS
+# type hints
+from typing import Dict, List, Tuple, Optional, Iterator
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+
+def ldap_uri(dc: str) -> str:
+    """
+    Returns a LDAP URI of the domain controller, IPv6 addresses are enclosed in brackets.
+    The scheme is **ldaps** if ADTOOLS_LDAP_TLS is **ldaps**
+
+    :param dc: an ip address or a hostname of a domain controller, may include a port
+    :type dc: str
+    :return: the LDAP URI, e.g. **ldap://10.0.0.1**, **ldap://[fe80::1]** or **ldaps://10.0.0.1**
+    :rtype: str
+    """
+    scheme: str = 'ldaps' if get_tls_mode() == TLS_LDAPS else 'ldap'
+    if dc.count(':') > 1 and not dc.startswith('['):
+        return '%s://[%s]' % (scheme, dc)
+    return '%s://%s' % (scheme, dc)
+
+
+def apply_deadline(conn: ldap.ldapobject.SimpleLDAPObject, deadline: Optional[Deadline], step: str = '') -> None:
+    """
+    Limits the time of the next synchronous operation of the connection (OPT_TIMEOUT) by seconds left,
+    does nothing if there is no deadline
+
+    :param conn: a connection
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :param deadline: the deadline of the whole operation
+    :type deadline: Deadline, optional
+    :param step: a name of the next step for the message of the exception
+    :type step: str
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    if deadline is not None:
+        conn.set_option(ldap.OPT_TIMEOUT, deadline.check(step))
+
+
+def _clear_timeout(conn: ldap.ldapobject.SimpleLDAPObject) -> None:
+    """
+    Removes the limit set by apply_deadline before the connection is returned into the pool
+    """
+    try:
+        conn.set_option(ldap.OPT_TIMEOUT, -1)
+    except ldap.LDAPError:
+        pass
+
+
+class LDAPPoolExhausted(Exception):
+    """
+    Raised when there is no free connection in the pool during the acquire timeout
+    """
+    pass
+
+
+class LDAPConnectionPool:
+    """
+    A bounded, per domain controller pool of LDAP connections bound with a service account
+
+    The pool is fork-safe: connections inherited from a parent process (e.g. a gunicorn pre-fork master)
+    are never used nor unbound in a child process, the child opens its own connections.
+
+    :param bind_username: a username of the service account, e.g. **svc-django@example.com**
+    :type bind_username: str
+    :param bind_password: a password of the service account
+    :type bind_password: str
+    :param max_size: maximum number of connections to each domain controller, defaults to **10**
+    :type max_size: int
+    :param idle_timeout: seconds after which an unused connection is closed, defaults to **300**
+    :type idle_timeout: float
+    :param health_check_interval: an idle connection is checked (whoami) before reuse
+        if it was not checked during this number of seconds, defaults to **30**
+    :type health_check_interval: float
+    :param network_timeout: a timeout of a TCP connection to a domain controller in seconds, defaults to **5**
+    :type network_timeout: float
+    """
+
+    def __init__(self,
+                 bind_username: str,
+                 bind_password: str,
+                 max_size: int = 10,
+                 idle_timeout: float = 300.0,
+                 health_check_interval: float = 30.0,
+                 network_timeout: float = 5.0,
+                 ):
+        if max_size < 1:
+            raise ValueError(f'{__package__} LDAPConnectionPool max_size must be positive, got {max_size}')
+        self.bind_username: str = bind_username
+        self.bind_password: str = bind_password
+        self.max_size: int = max_size
+        self.idle_timeout: float = idle_timeout
+        self.health_check_interval: float = health_check_interval
+        self.network_timeout: float = network_timeout
+        self._lock: threading.Condition = threading.Condition()
+        self._pid: int = os.getpid()
+        # dc -> list of (last_used, last_checked, connection), the most recently used connection is the last one
+        self._idle: Dict[str, List[Tuple[float, float, ldap.ldapobject.SimpleLDAPObject]]] = {}
+        self._size: Dict[str, int] = {}  # dc -> number of open connections (idle and in use)
+        # connections inherited from a parent process, they are kept referenced to prevent unbinding on garbage
+        # collection, because the socket is shared with the parent process
+        self._orphans: List[ldap.ldapobject.SimpleLDAPObject] = []
+
+    def _check_fork(self) -> None:
+        """
+        Forgets connections inherited from a parent process. Must be called holding the lock
+        """
+        pid: int = os.getpid()
+        if pid != self._pid:
+            for idle in self._idle.values():
+                self._orphans.extend(item[2] for item in idle)
+            self._idle = {}
+            self._size = {}
+            self._pid = pid
+
+    def _open(self, dc: str, deadline: Optional[Deadline] = None) -> ldap.ldapobject.SimpleLDAPObject:
+        """
+        Opens a new connection to the domain controller and binds it with the service account
+
+        :param dc: an ip address or a hostname of a domain controller
+        :type dc: str
+        :param deadline: limits the time of the connection and the bind, defaults to **None**
+        :type deadline: Deadline, optional
+        :return: a bound connection
+        :rtype: ldap.ldapobject.SimpleLDAPObject
+        """
+        conn: ldap.ldapobject.SimpleLDAPObject = initialize(ldap_uri(dc))
+        conn.set_option(ldap.OPT_REFERRALS, 0)
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, cap(deadline, self.network_timeout, 'connect'))
+        try:
+            apply_tls(conn)
+            apply_deadline(conn, deadline, 'bind')
+            conn.simple_bind_s(self.bind_username, self.bind_password)
+        except BaseException:
+            self._close(conn)
+            raise
+        if deadline is not None:
+            _clear_timeout(conn)
+        return conn
+
+    @staticmethod
+    def _close(conn: ldap.ldapobject.SimpleLDAPObject) -> None:
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _is_healthy(self, conn: ldap.ldapobject.SimpleLDAPObject) -> bool:
+        try:
+            conn.whoami_s()
+            return True
+        except ldap.LDAPError as e:
+            logger.warning(f'{__package__} LDAPConnectionPool health check failed: {str(e)}')
+            return False
+
+    def acquire(self, dc: str, timeout: Optional[float] = None, deadline: Optional[Deadline] = None
+                ) -> ldap.ldapobject.SimpleLDAPObject:
+        """
+        Takes a connection to the domain controller from the pool, opens a new one if the pool is not full
+
+        :param dc: an ip address or a hostname of a domain controller
+        :type dc: str
+        :param timeout: seconds to wait for a free connection, **None** means wait forever
+        :type timeout: float, optional
+        :param deadline: limits the wait, the health check and opening of a new connection, defaults to **None**
+        :type deadline: Deadline, optional
+        :return: a connection bound with the service account
+        :rtype: ldap.ldapobject.SimpleLDAPObject
+        :raises LDAPPoolExhausted: if there is no free connection during the timeout
+        :raises DeadlineExceeded: if the deadline has passed
+        :raises ldap.LDAPError: if a new connection can not be opened
+        """
+        timeout = cap(deadline, timeout, 'acquire')
+        wait_until: Optional[float] = None if timeout is None else time.monotonic() + timeout
+        while True:
+            expired: List[ldap.ldapobject.SimpleLDAPObject] = []
+            candidate: Optional[Tuple[float, float, ldap.ldapobject.SimpleLDAPObject]] = None
+            open_new: bool = False
+            with self._lock:
+                self._check_fork()
+                now: float = time.monotonic()
+                idle = self._idle.setdefault(dc, [])
+                while idle and now - idle[0][0] > self.idle_timeout:
+                    expired.append(idle.pop(0)[2])
+                    self._size[dc] -= 1
+                if idle:
+                    candidate = idle.pop()
+                elif self._size.get(dc, 0) < self.max_size:
+                    self._size[dc] = self._size.get(dc, 0) + 1
+                    open_new = True
+                else:
+                    remaining: Optional[float] = None if wait_until is None else wait_until - now
+                    if remaining is not None and remaining <= 0:
+                        if deadline is not None:
+                            deadline.check('acquire')
+                        raise LDAPPoolExhausted(f'{__package__} LDAPConnectionPool no free connection to dc={dc}')
+                    self._lock.wait(remaining)
+                    continue
+            for conn in expired:
+                self._close(conn)
+            if candidate is not None:
+                _, last_checked, conn = candidate
+                if time.monotonic() - last_checked <= self.health_check_interval:
+                    return conn
+                try:
+                    apply_deadline(conn, deadline, 'health check')
+                except BaseException:
+                    self.release(dc, conn, discard=True)  # returned unchecked it would pass as a healthy one
+                    raise
+                healthy: bool = self._is_healthy(conn)
+                if deadline is not None:
+                    _clear_timeout(conn)
+                if healthy:
+                    return conn
+                self.release(dc, conn, discard=True)
+                continue
+            if open_new:
+                try:
+                    return self._open(dc, deadline=deadline)
+                except BaseException:
+                    with self._lock:
+                        self._size[dc] -= 1
+                        self._lock.notify()
+                    raise
+
+    def release(self, dc: str, conn: ldap.ldapobject.SimpleLDAPObject, discard: bool = False) -> None:
+        """
+        Returns the connection into the pool
+
+        :param dc: an ip address or a hostname of a domain controller the connection was acquired for
+        :type dc: str
+        :param conn: the connection
+        :type conn: ldap.ldapobject.SimpleLDAPObject
+        :param discard: close the connection instead of returning it (e.g. after ldap.SERVER_DOWN)
+        :type discard: bool
+        """
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._orphans.append(conn)  # the connection belongs to the parent process
+                return
+            if discard:
+                self._size[dc] = self._size.get(dc, 1) - 1
+            else:
+                now: float = time.monotonic()
+                self._idle.setdefault(dc, []).append((now, now, conn))
+            self._lock.notify()
+        if discard:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self, dc: str, timeout: Optional[float] = None, deadline: Optional[Deadline] = None
+                   ) -> Iterator[ldap.ldapobject.SimpleLDAPObject]:
+        """
+        Context manager, acquires a connection and returns it into the pool on exit.
+        The connection is discarded if ldap.SERVER_DOWN or ldap.TIMEOUT is raised inside the block
+
+        :param dc: an ip address or a hostname of a domain controller
+        :type dc: str
+        :param timeout: seconds to wait for a free connection
+        :type timeout: float, optional
+        :param deadline: limits the wait for a free connection, operations of the block are limited
+            by seconds left at the start of the block (see apply_deadline), defaults to **None**
+        :type deadline: Deadline, optional
+        """
+        conn: ldap.ldapobject.SimpleLDAPObject = self.acquire(dc, timeout=timeout, deadline=deadline)
+        try:
+            apply_deadline(conn, deadline)
+            yield conn
+        except (ldap.SERVER_DOWN, ldap.TIMEOUT):
+            self.release(dc, conn, discard=True)
+            raise
+        except BaseException:
+            if deadline is not None:
+                _clear_timeout(conn)
+            self.release(dc, conn)
+            raise
+        else:
+            if deadline is not None:
+                _clear_timeout(conn)
+            self.release(dc, conn)
+
+    def verify_credentials(self, dc: str, username: str, password: str, deadline: Optional[Deadline] = None) -> bool:
+        """
+        Checks the username and the password by binding a pooled connection,
+        then rebinds the connection with the service account
+
+        :param dc: an ip address or a hostname of a domain controller
+        :type dc: str
+        :param username: an active directory username
+        :type username: str
+        :param password: an active directory user password
+        :type password: str
+        :param deadline: limits the wait for a connection and both binds, defaults to **None**
+        :type deadline: Deadline, optional
+        :return: True if the user was bound successfully
+        :rtype: bool
+        :raises DeadlineExceeded: if the deadline has passed
+        """
+        if not password:
+            # an empty password means an unauthenticated bind, that always succeeds
+            logger.warning(f'{__package__} LDAPConnectionPool verify_credentials failed, empty password '
+                           f'dc={dc}, username={username}')
+            return False
+        conn: ldap.ldapobject.SimpleLDAPObject = self.acquire(dc, deadline=deadline)
+        discard: bool = False
+        try:
+            try:
+                apply_deadline(conn, deadline, 'bind')
+                conn.simple_bind_s(username, password)
+                return True
+            except ldap.INVALID_CREDENTIALS:
+                logger.warning(f'{__package__} LDAPConnectionPool verify_credentials failed, ldap.INVALID_CREDENTIALS '
+                               f'dc={dc}, username={username}')
+                return False
+            finally:
+                try:
+                    # the service account is bound within seconds left, otherwise the connection may stay bound
+                    # with the user credentials, so it is not returned into the pool
+                    apply_deadline(conn, deadline, 'rebind')
+                    conn.simple_bind_s(self.bind_username, self.bind_password)
+                except (ldap.LDAPError, DeadlineExceeded) as e:
+                    logger.error(f'{__package__} LDAPConnectionPool rebind failed: {str(e)}, dc={dc}')
+                    discard = True
+        finally:
+            if deadline is not None and not discard:
+                _clear_timeout(conn)
+            self.release(dc, conn, discard=discard)
+
+    def clear(self) -> None:
+        """
+        Closes all idle connections
+        """
+        with self._lock:
+            self._check_fork()
+            idle = self._idle
+            self._idle = {}
+            for dc, items in idle.items():
+                self._size[dc] -= len(items)
+        for items in idle.values():
+            for item in items:
+                self._close(item[2])
+
+
+_default_pool: Optional[LDAPConnectionPool] = None  #: the pool configured in settings.py
+_default_pool_lock: threading.Lock = threading.Lock()
+
+
+def get_default_pool() -> Optional[LDAPConnectionPool]:
+    """
+    Returns the pool configured by ADTOOLS_BIND_USERNAME, ADTOOLS_BIND_PASSWORD, ADTOOLS_POOL_SIZE,
+    ADTOOLS_POOL_IDLE_TIMEOUT settings, or None if the service account is not configured
+
+    :return: the pool shared by the process
+    :rtype: LDAPConnectionPool, optional
+    """
+    global _default_pool
+    if _default_pool is None:
+        from django.conf import settings
+        bind_username: str = getattr(settings, 'ADTOOLS_BIND_USERNAME', '')
+        if not bind_username:
+            return None
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = LDAPConnectionPool(
+                    bind_username=bind_username,
+                    bind_password=getattr(settings, 'ADTOOLS_BIND_PASSWORD', ''),
+                    max_size=getattr(settings, 'ADTOOLS_POOL_SIZE', 10),
+                    idle_timeout=getattr(settings, 'ADTOOLS_POOL_IDLE_TIMEOUT', 300.0),
+                )
+    return _default_pool
@@ -0,0 +1,66 @@
+"""
+django_adtools/management/commands/adbenchmark.py
+Benchmarks ad_login, user_dn, dn_groups and discovery against the LDAP emulator
+"""
+__author__ = 'shmakovpn <shmakovpn@yandex.ru>'
+__date__ = '2020-10-10'
+
+from django.core.management.base import BaseCommand, CommandError
+from django_adtools.benchmark import run_suite, save, load, compare, SCENARIOS
+from typing import Any, Dict, List
+
+
+class Command(BaseCommand):
+    """
+    Runs benchmarks against the in-process LDAP emulator, prints throughput and latency percentiles,
+    saves results as JSON and compares them with a baseline
+    """
+    help = """Benchmarks ad_login, user_dn, dn_groups and discovery against the LDAP emulator"""
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--benchmark', action='append', default=None, choices=SCENARIOS,
+                            help='A benchmark to run, defaults to all of them')
+        parser.add_argument('--users', type=int, default=1000, help='Number of users in the emulated directory')
+        parser.add_argument('--groups', type=int, default=10, help='Number of groups in the emulated directory')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Seconds added by the emulator before every response')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='Numbers of threads')
+        parser.add_argument('--iterations', type=int, default=200,
+                            help='Number of calls of a benchmark at a concurrency level')
+        parser.add_argument('--backend', default=None,
+                            help='The LDAP backend: python-ldap or pure, defaults to ADTOOLS_LDAP_BACKEND')
+        parser.add_argument('--output', default=None, help='Save results into this JSON file')
+        parser.add_argument('--compare', default=None, help='Compare results with a baseline JSON file')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='A relative change of a metric which is a regression, defaults to 0.1')
+
+    def handle(self, *args, **kwargs) -> None:
+        """
+        Run the benchmarks
+        """
+        results: Dict[str, Any] = run_suite(
+            users=kwargs['users'],
+            groups=kwargs['groups'],
+            latency=kwargs['latency'],
+            concurrency=kwargs['concurrency'],
+            iterations=kwargs['iterations'],
+            scenarios=kwargs['benchmark'],
+            backend=kwargs['backend'],
+        )
+        self.stdout.write(f'{"benchmark":<14}{"threads":>8}{"requests":>10}{"errors":>8}'
+                          f'{"req/s":>11}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+        for name, levels in results['results'].items():
+            for level in levels:
+                self.stdout.write(f'{name:<14}{level["concurrency"]:>8}{level["requests"]:>10}{level["errors"]:>8}'
+                                  f'{level["throughput"]:>11.1f}{level["p50"]:>10.2f}{level["p95"]:>10.2f}'
+                                  f'{level["p99"]:>10.2f}')
+        if kwargs['output']:
+            save(results, kwargs['output'])
+        if kwargs['compare']:
+            regressions: List[Dict[str, Any]] = compare(results, load(kwargs['compare']),
+                                                        threshold=kwargs['threshold'])
+            for x in regressions:
+                self.stderr.write(f'{x["benchmark"]} threads={x["concurrency"]} {x["metric"]}:'
+                                  f' {x["baseline"]} -> {x["current"]} ({x["change"]:+.1%})')
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions compared with {kwargs["compare"]}')
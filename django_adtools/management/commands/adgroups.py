@@ -0,0 +1,67 @@
+"""
+django_adtools/management/commands/adgroups.py
+Prints groups of many users, e.g. for access reviews
+"""
+__author__ = 'shmakovpn <shmakovpn@yandex.ru>'
+__date__ = '2020-10-09'
+
+import sys
+import json
+from django_adtools.ldap_compat import ldap
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django_adtools.models import DomainController
+from django_adtools.ad_tools import batch_user_groups, FAILOVER_ERRORS
+from django_adtools.ldap_pool import LDAPConnectionPool, LDAPPoolExhausted, get_default_pool
+from typing import Dict, List, Optional, Tuple
+
+
+class Command(BaseCommand):
+    """
+    Requests DNs and groups of users over one pooled connection with pipelined searches, prints them as JSON
+    """
+    help = """Requests DNs and groups of users over one pooled connection, prints them as JSON"""
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('usernames', nargs='*', help='Usernames')
+        parser.add_argument('--file', default=None,
+                            help='A file with one username per line, "-" reads usernames from stdin')
+        parser.add_argument('--nested', action='store_true', help='Include nested groups')
+        parser.add_argument('--depth', type=int, default=32, help='Maximum number of outstanding searches')
+        parser.add_argument('--dc', action='append', default=None,
+                            help='A domain controller, defaults to available ones from DomainController model')
+
+    def handle(self, *args, **kwargs) -> None:
+        """
+        Perform the searches
+        """
+        pool: Optional[LDAPConnectionPool] = get_default_pool()
+        if pool is None:
+            raise CommandError("'ADTOOLS_BIND_USERNAME' does not present in settings.py")
+        usernames: List[str] = list(kwargs['usernames'])
+        if kwargs['file']:
+            stream = sys.stdin if kwargs['file'] == '-' else open(kwargs['file'])
+            with stream:
+                usernames.extend(line.strip() for line in stream if line.strip())
+        dcs: List[str] = kwargs['dc'] or DomainController.get_list()
+        results: Optional[Dict[str, Tuple[str, List[str]]]] = None
+        for dc in dcs:
+            try:
+                with pool.connection(dc) as conn:
+                    results = batch_user_groups(
+                        conn=conn,
+                        usernames=usernames,
+                        domain=getattr(settings, 'ADTOOLS_DOMAIN'),
+                        nested=kwargs['nested'],
+                        depth=kwargs['depth'],
+                    )
+                break
+            except (FAILOVER_ERRORS + (LDAPPoolExhausted,)) as e:
+                self.stderr.write(f'Domain controller {dc} is not available: {str(e)}')
+            except ldap.LDAPError as e:
+                raise CommandError(f'Searches failed dc={dc}: {str(e)}')
+        if results is None:
+            raise CommandError(f'No available domain controllers {dcs}')
+        self.stdout.write(json.dumps(
+            {username: {'dn': dn, 'groups': groups} for username, (dn, groups) in results.items()}, indent=2,
+        ))
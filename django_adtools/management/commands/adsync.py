@@ -0,0 +1,60 @@
+"""
+django_adtools/management/commands/adsync.py
+Mirrors users, groups and members of groups of Active Directory
+"""
+__author__ = 'shmakovpn <shmakovpn@yandex.ru>'
+__date__ = '2020-10-08'
+
+from django_adtools.ldap_compat import ldap
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django_adtools.models import DomainController
+from django_adtools.ad_tools import _unbind
+from django_adtools.ad_sync import sync, service_connection
+from typing import Dict, List
+
+
+class Command(BaseCommand):
+    """
+    Reads users and groups of the domain page by page, saves them into ADUser and ADGroup models,
+    members of groups into ADMembership model.
+    Only entries changed since the last sync with the same domain controller are read, unless --full is set
+    """
+    help = """Reads users and groups of the domain changed since the last sync into ADUser and ADGroup models"""
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--dc', action='append', default=None,
+                            help='A domain controller, defaults to available ones from DomainController model')
+        parser.add_argument('--page-size', type=int, default=getattr(settings, 'ADTOOLS_SYNC_PAGE_SIZE', 1000),
+                            help='Number of entries requested from a domain controller at once')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'ADTOOLS_SYNC_BATCH_SIZE', 1000),
+                            help='Number of rows written to the database at once')
+        parser.add_argument('--full', action='store_true',
+                            help='Read all users and groups, delete rows of entries which were not found')
+
+    def handle(self, *args, **kwargs) -> None:
+        """
+        Perform the sync
+        """
+        if not getattr(settings, 'ADTOOLS_BIND_USERNAME', ''):
+            raise CommandError("'ADTOOLS_BIND_USERNAME' does not present in settings.py")
+        dcs: List[str] = kwargs['dc'] or DomainController.get_list()
+        try:
+            dc, conn = service_connection(dcs)
+        except ldap.LDAPError as e:
+            raise CommandError(f'Could not connect to domain controllers {dcs}: {str(e)}')
+        try:
+            result: Dict[str, Dict[str, int]] = sync(
+                conn=conn,
+                dc=dc,
+                domain=getattr(settings, 'ADTOOLS_DOMAIN'),
+                page_size=kwargs['page_size'],
+                batch_size=kwargs['batch_size'],
+                full=kwargs['full'],
+            )
+        except ldap.LDAPError as e:
+            raise CommandError(f'Sync failed dc={dc}: {str(e)}')
+        finally:
+            _unbind(conn)
+        for model_name, counts in result.items():
+            self.stdout.write(f'{model_name}: ' + ', '.join(f'{name}={count}' for name, count in counts.items()))
@@ -5,29 +5,42 @@ Discovers Domain Controllers
 __author__ = 'shmakovpn <shmakovpn@yandex.ru>'
 __date__ = '2020-06-05'
 
-import os
 from django.core.management.base import BaseCommand
 from django_adtools.models import DomainController
-from django_adtools.discover_dc import DCList
+from django_adtools.discover_dc import DCHostname
+from django_adtools.dc_watcher import DCWatcher, settings_dc_list
 from django.conf import settings
 from typing import List
 
-role: str = getattr(settings, 'ADTOOLS_ROLE', 'dc')  #: domain controller server role
-domain: str = getattr(settings, 'ADTOOLS_DOMAIN')  #: ad realm
-name_servers: List[str] = getattr(settings, 'ADTOOLS_NAMESERVERS', None)  #: list of ip of dns servers
-if os.name == 'nt' and not name_servers:
-    raise RuntimeError("'ADTOOLS_NAMESERVERS' does not present in settings.py on Windows")
-
 
 class Command(BaseCommand):
     """
-    Discovers Domain Controllers, saves found controller into DomainController model
+    Discovers Domain Controllers, saves found controllers ranked by latency into DomainController model
     """
-    help = """Discovers Domain Controllers, saves found controller into DomainController model"""
+    help = """Discovers Domain Controllers, saves found controllers ranked by latency into DomainController model"""
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep running, re-discover Domain Controllers periodically')
+        parser.add_argument('--interval', type=float, default=getattr(settings, 'ADTOOLS_DISCOVER_INTERVAL', 60.0),
+                            help='Seconds between rounds of discovery in the watch mode')
+        parser.add_argument('--jitter', type=float, default=getattr(settings, 'ADTOOLS_DISCOVER_JITTER', 0.1),
+                            help='A random part of the interval, from 0 to 1')
 
     def handle(self, *args, **kwargs) -> None:
         """
         Perform dns requests
         """
-        ip: str = DCList(domain=domain, role=role, nameservers=name_servers).get_available_dc_ip()
-        DomainController.set(ip)
+        if kwargs['watch']:
+            watcher: DCWatcher = DCWatcher(
+                dc_list=settings_dc_list(),
+                interval=kwargs['interval'],
+                jitter=kwargs['jitter'],
+            )
+            try:
+                watcher.run()  # in the current thread
+            except KeyboardInterrupt:
+                watcher.stop()
+            return
+        dc_hostnames: List[DCHostname] = settings_dc_list().get_ranked_dc_list()
+        DomainController.set_list(dc_hostnames)
@@ -0,0 +1,321 @@
+"""
+django_adtools/membership.py
+
+An index of members of groups kept in memory of the process, it is loaded lazily from ADUser, ADGroup and
+ADMembership models (written by *python manage.py adsync*), so checks of groups do not send requests
+to domain controllers:
+
+.. code-block:: python
+
+    index = get_default_membership_index()
+    if index.has_group('user1', 'Admins', nested=True):
+        ...
+    admins = index.users_in_group('Admins')
+
+The index is refreshed incrementally: only rows of groups and users written by syncs since the last refresh
+are read again. Only active users are members of the index
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-16"
+
+import time
+import datetime
+import threading
+import logging
+from . import ad_tools
+from .models import ADUser, ADGroup, ADMembership
+# type hints
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+
+class _Snapshot:
+    """
+    Maps of the index derived from rows of the models, a snapshot is never changed after it was built
+    (except memoized closures of nested groups), so readers do not need locks
+    """
+
+    def __init__(self,
+                 users: Dict[int, Tuple[str, str]],
+                 groups: Dict[int, Tuple[str, str]],
+                 members: Dict[int, FrozenSet[str]],
+                 ):
+        usernames: Dict[str, str] = {dn: username for username, dn in users.values()}
+        group_names: Dict[str, str] = {dn: name.lower() for name, dn in groups.values()}
+        self.names: Dict[str, str] = {name.lower(): name for name, dn in groups.values()}  #: lowercase -> name
+        user_groups: Dict[str, Set[str]] = {}
+        group_users: Dict[str, Set[str]] = {}
+        parents: Dict[str, Set[str]] = {}
+        children: Dict[str, Set[str]] = {}
+        for group_id, dns in members.items():
+            if group_id not in groups:
+                continue
+            group: str = groups[group_id][0].lower()
+            for dn in dns:
+                if dn in usernames:
+                    user_groups.setdefault(usernames[dn].lower(), set()).add(group)
+                    group_users.setdefault(group, set()).add(usernames[dn])
+                elif dn in group_names:
+                    parents.setdefault(group_names[dn], set()).add(group)
+                    children.setdefault(group, set()).add(group_names[dn])
+        self.user_groups: Dict[str, FrozenSet[str]] = {k: frozenset(v) for k, v in user_groups.items()}
+        self.group_users: Dict[str, FrozenSet[str]] = {k: frozenset(v) for k, v in group_users.items()}
+        self.parents: Dict[str, FrozenSet[str]] = {k: frozenset(v) for k, v in parents.items()}
+        self.children: Dict[str, FrozenSet[str]] = {k: frozenset(v) for k, v in children.items()}
+        self.ancestors: Dict[str, FrozenSet[str]] = {}  #: a group -> groups containing it, memoized
+        self.descendants: Dict[str, FrozenSet[str]] = {}  #: a group -> groups contained in it, memoized
+
+    @staticmethod
+    def _closure(group: str, edges: Dict[str, FrozenSet[str]], memo: Dict[str, FrozenSet[str]]) -> FrozenSet[str]:
+        """
+        Returns the group and all groups reachable by edges, cycles of nested groups are allowed
+        """
+        result: Optional[FrozenSet[str]] = memo.get(group)
+        if result is None:
+            seen: Set[str] = {group}
+            stack: List[str] = [group]
+            while stack:
+                for x in edges.get(stack.pop(), ()):
+                    if x not in seen:
+                        seen.add(x)
+                        stack.append(x)
+            result = memo[group] = frozenset(seen)
+        return result
+
+    def groups_of(self, username: str, nested: bool) -> FrozenSet[str]:
+        direct: FrozenSet[str] = self.user_groups.get(username, frozenset())
+        if not nested:
+            return direct
+        return frozenset().union(*(self._closure(x, self.parents, self.ancestors) for x in direct))
+
+    def users_of(self, group: str, nested: bool) -> FrozenSet[str]:
+        if not nested:
+            return self.group_users.get(group, frozenset())
+        return frozenset().union(*(self.group_users.get(x, frozenset())
+                                   for x in self._closure(group, self.children, self.descendants)))
+
+
+class MembershipIndex:
+    """
+    Answers which groups a user is a member of and which users are members of a group
+    from memory of the process, without requests to domain controllers or the database.
+    Direct memberships are looked up in O(1), nested ones in O(number of groups of the user).
+    Usernames and names of groups are compared case-insensitively
+
+    :param max_age: seconds after which the next lookup refreshes the index, defaults to **60**,
+        0 disables automatic refreshes (refresh is called explicitly, e.g. after a sync)
+    :type max_age: float
+    """
+
+    def __init__(self, max_age: float = 60.0):
+        self.max_age: float = max_age
+        self._lock: threading.Lock = threading.Lock()
+        self._snapshot: Optional[_Snapshot] = None
+        self._refreshed: float = 0.0  #: time.monotonic() of the last refresh
+        self._watermark: Optional[datetime.datetime] = None  #: the latest synced time of rows read
+        self._users: Dict[int, Tuple[str, str]] = {}  #: pk -> username and lowercase DN of active users
+        self._groups: Dict[int, Tuple[str, str]] = {}  #: pk -> name and lowercase DN of groups
+        self._members: Dict[int, FrozenSet[str]] = {}  #: pk of a group -> lowercase DNs of its members
+        self.loads: int = 0  #: number of full loads of the index
+        self.refreshes: int = 0  #: number of incremental refreshes of the index
+
+    @property
+    def loaded(self) -> bool:
+        """
+        True if the index has been loaded
+        """
+        return self._snapshot is not None
+
+    def _get(self) -> _Snapshot:
+        """
+        Returns the current snapshot, loads the index on the first call, refreshes it when it is older than max_age.
+        Only one thread refreshes the index, others use the previous snapshot meanwhile
+        """
+        snapshot: Optional[_Snapshot] = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._load()
+                return self._snapshot
+        if self.max_age and time.monotonic() - self._refreshed > self.max_age and self._lock.acquire(blocking=False):
+            try:
+                self._refresh()
+            except Exception as e:
+                # the previous snapshot is used until the next attempt
+                self._refreshed = time.monotonic()
+                logger.error(f'{__package__} MembershipIndex could not be refreshed: {str(e)}')
+            finally:
+                self._lock.release()
+            return self._snapshot
+        return snapshot
+
+    def _load(self) -> None:
+        """
+        Reads all rows of the models
+        """
+        started: float = time.perf_counter()
+        self._refreshed = time.monotonic()
+        self._watermark = None
+        self._users, self._groups, self._members = {}, {}, {}
+        self._read(ADUser.objects.all(), ADGroup.objects.all(), ADMembership.objects.all())
+        self._snapshot = _Snapshot(self._users, self._groups, self._members)
+        self.loads += 1
+        logger.debug(f'{__package__} MembershipIndex loaded users={len(self._users)} groups={len(self._groups)} '
+                     f'in {time.perf_counter() - started:.3f}s')
+
+    def _read(self, users, groups, memberships) -> None:
+        """
+        Merges rows of querysets into raw maps of the index, advances the watermark
+        """
+        latest: List[datetime.datetime] = [self._watermark] if self._watermark else []
+        for pk, username, dn, is_active, synced in users.values_list('pk', 'username', 'dn', 'is_active', 'synced'):
+            if is_active:
+                self._users[pk] = (username, dn.lower())
+            else:
+                self._users.pop(pk, None)
+            latest.append(synced)
+        read: Dict[int, Set[str]] = {}
+        for pk, name, dn, synced in groups.values_list('pk', 'name', 'dn', 'synced'):
+            self._groups[pk] = (name, dn.lower())
+            read[pk] = set()
+            latest.append(synced)
+        for group_id, dn in memberships.values_list('group_id', 'member_dn'):
+            read.setdefault(group_id, set()).add(dn)
+        self._members.update((k, frozenset(v)) for k, v in read.items())
+        self._watermark = max(latest, default=None)
+
+    def _refresh(self) -> None:
+        """
+        Reads rows written by syncs since the last refresh, drops rows which were deleted
+        """
+        if self._watermark is None:
+            self._load()
+            return
+        since: datetime.datetime = self._watermark
+        self._refreshed = time.monotonic()
+        # rows written by the sync which was running at the last refresh have the same synced time,
+        # so they are read again (>=) in case they were written after it
+        self._read(
+            ADUser.objects.filter(synced__gte=since),
+            ADGroup.objects.filter(synced__gte=since),
+            ADMembership.objects.filter(group__synced__gte=since),
+        )
+        self._drop(self._users, ADUser.objects.values_list('pk', flat=True))
+        self._drop(self._groups, ADGroup.objects.values_list('pk', flat=True))
+        self._drop(self._members, self._groups)
+        self._snapshot = _Snapshot(self._users, self._groups, self._members)
+        self.refreshes += 1
+
+    @staticmethod
+    def _drop(rows: dict, existing: Iterable[int]) -> None:
+        """
+        Removes rows which do not exist any more
+        """
+        for pk in set(rows).difference(existing):
+            del rows[pk]
+
+    def refresh(self) -> None:
+        """
+        Reads changes of the models since the last refresh, loads the index if it has not been loaded
+        """
+        with self._lock:
+            self._refresh()
+
+    def clear(self) -> None:
+        """
+        Drops the index, the next lookup loads it again
+        """
+        with self._lock:
+            self._snapshot = None
+            self._watermark = None
+            self._users, self._groups, self._members = {}, {}, {}
+
+    @staticmethod
+    def _username(username: str) -> str:
+        return ad_tools.ad_clear_username(username).lower()
+
+    def has_group(self, username: str, group: str, nested: bool = False) -> bool:
+        """
+        Checks that the user is a member of the group
+
+        :param username: a username, e.g. **user**, **user@domain.local** or **DOMAIN\\user**
+        :type username: str
+        :param group: a name of the group (sAMAccountName)
+        :type group: str
+        :param nested: check members of nested groups too, defaults to **False**
+        :type nested: bool
+        :rtype: bool
+        """
+        return group.lower() in self._get().groups_of(self._username(username), nested)
+
+    def user_groups(self, username: str, nested: bool = False) -> List[str]:
+        """
+        Returns sorted names of groups the user is a member of
+
+        :param username: a username, e.g. **user**, **user@domain.local** or **DOMAIN\\user**
+        :type username: str
+        :param nested: include groups containing groups of the user, defaults to **False**
+        :type nested: bool
+        :rtype: List[str]
+        """
+        snapshot: _Snapshot = self._get()
+        return sorted(snapshot.names[x] for x in snapshot.groups_of(self._username(username), nested))
+
+    def users_in_group(self, group: str, nested: bool = False) -> List[str]:
+        """
+        Returns sorted usernames of active members of the group
+
+        :param group: a name of the group (sAMAccountName)
+        :type group: str
+        :param nested: include members of nested groups, defaults to **False**
+        :type nested: bool
+        :rtype: List[str]
+        """
+        return sorted(self._get().users_of(group.lower(), nested))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters of the index
+
+        :return: a dict with keys: users, groups, loads, refreshes
+        :rtype: Dict[str, int]
+        """
+        return {'users': len(self._users), 'groups': len(self._groups), 'loads': self.loads,
+                'refreshes': self.refreshes}
+
+
+_default_membership_index: Optional[MembershipIndex] = None  #: the index configured in settings.py
+_default_membership_index_lock: threading.Lock = threading.Lock()
+
+
+def get_default_membership_index() -> MembershipIndex:
+    """
+    Returns the index of the process refreshed every ADTOOLS_MEMBERSHIP_MAX_AGE seconds (defaults to **60**)
+
+    :rtype: MembershipIndex
+    """
+    global _default_membership_index
+    if _default_membership_index is None:
+        from django.conf import settings
+        with _default_membership_index_lock:
+            if _default_membership_index is None:
+                _default_membership_index = MembershipIndex(
+                    max_age=getattr(settings, 'ADTOOLS_MEMBERSHIP_MAX_AGE', 60.0),
+                )
+    return _default_membership_index
+
+
+def has_group(username: str, group: str, nested: bool = False) -> bool:
+    """
+    Checks that the user is a member of the group using the default index, see MembershipIndex.has_group
+    """
+    return get_default_membership_index().has_group(username, group, nested=nested)
+
+
+def users_in_group(group: str, nested: bool = False) -> List[str]:
+    """
+    Returns usernames of members of the group using the default index, see MembershipIndex.users_in_group
+    """
+    return get_default_membership_index().users_in_group(group, nested=nested)
@@ -4,15 +4,69 @@ django_adtools/models.py
 __author__ = 'shmakovpn <shmakovpn@yandex.ru>'
 __date__ = '2020-06-05'
 
-from django.db import models
+import time
+import threading
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from .discover_dc import DCHostname
+from .shared_cache import get_default_shared_cache
+from typing import List, Optional, Tuple
 
 
 # Create your models here.
 class DomainController(models.Model):
     """
-    Model for storing the ip address of an available domain controller
+    Model for storing discovered domain controllers, the best available one has the least rank.
+
+    The ip addresses of available domain controllers are cached in the process
+    during ADTOOLS_DC_CACHE_TTL seconds (defaults to 10), so get() does not query the database on every login.
+    If ADTOOLS_SHARED_CACHE is set, they are also kept in the shared cache, so one process of all
+    queries the database
     """
-    ip = models.CharField(max_length=15, null=False)
+    ip = models.CharField(max_length=45, null=False)  #: an IPv4 or an IPv6 address
+    hostname = models.CharField(max_length=255, blank=True, default='')
+    port = models.PositiveIntegerField(default=389)
+    priority = models.IntegerField(default=0)  #: a priority from the SRV record
+    weight = models.IntegerField(default=0)  #: a weight from the SRV record
+    latency = models.FloatField(null=True, blank=True)  #: a smoothed round trip time, seconds
+    last_check = models.DateTimeField(null=True, blank=True)
+    healthy = models.BooleanField(default=True)
+    rank = models.PositiveIntegerField(default=0)  #: the order of selection, less is better
+
+    class Meta:
+        ordering = ['rank']
+
+    _cache_lock: threading.Lock = threading.Lock()
+    _cache_expires: float = 0.0
+    _cache_ips: List[str] = []
+    SHARED_KEY: Tuple[str, str] = ('dc', 'list')  #: the key of ip addresses in the shared cache
+
+    @classmethod
+    def get_list(cls) -> List[str]:
+        """
+        Returns ip addresses of available domain controllers, the best one is the first
+
+        :return: a list of ip addresses
+        :rtype: List[str]
+        """
+        now: float = time.monotonic()
+        if now < cls._cache_expires:
+            return list(cls._cache_ips)
+        with cls._cache_lock:
+            if now >= cls._cache_expires:
+                ttl: float = getattr(settings, 'ADTOOLS_DC_CACHE_TTL', 10.0)
+                shared_cache = get_default_shared_cache()
+                if shared_cache is None:
+                    cls._cache_ips = cls._query_ips()
+                else:
+                    cls._cache_ips = shared_cache.get_or_refresh(cls.SHARED_KEY, cls._query_ips, ttl=ttl)
+                cls._cache_expires = time.monotonic() + ttl
+            return list(cls._cache_ips)
+
+    @classmethod
+    def _query_ips(cls) -> List[str]:
+        return list(cls.objects.filter(healthy=True).values_list('ip', flat=True))
 
     @classmethod
     def get(cls) -> str:
@@ -21,12 +75,20 @@ class DomainController(models.Model):
         :return: an ip address of Domain Controller
         :rtype: str
         """
-        try:
-            return cls.objects.all()[0].ip
-        except DomainController.DoesNotExist:
-            return ''
-        except IndexError:
-            return ''
+        ips: List[str] = cls.get_list()
+        return ips[0] if ips else ''
+
+    @classmethod
+    def invalidate_cache(cls) -> None:
+        """
+        Makes the next get() read domain controllers from the database,
+        other processes read them after their ADTOOLS_DC_CACHE_TTL
+        """
+        with cls._cache_lock:
+            cls._cache_expires = 0.0
+        shared_cache = get_default_shared_cache()
+        if shared_cache is not None:
+            shared_cache.delete(cls.SHARED_KEY)
 
     @classmethod
     def set(cls, ip: str) -> None:
@@ -35,7 +97,94 @@ class DomainController(models.Model):
         :param ip: an ip address of domain controller
         :return: None
         """
-        cls.objects.all().delete()
-        dc: DomainController = cls()
-        dc.ip = ip
-        dc.save()
+        dc_hostname: DCHostname = DCHostname(dc_hostname=ip, dc_priority=0, dc_port=389, dns_resolver=None)
+        dc_hostname.dc_ip = ip
+        cls.set_list([dc_hostname], healthy=[True])
+
+    @classmethod
+    def set_list(cls, dc_hostnames: List[DCHostname], healthy: Optional[List[bool]] = None) -> None:
+        """
+        Replaces stored domain controllers in one transaction, so get() never sees an empty table
+
+        :param dc_hostnames: domain controllers ordered from the best one, e.g. from DCList.get_ranked_dc_list()
+        :type dc_hostnames: List[DCHostname]
+        :param healthy: health of each domain controller, defaults to: it has a measured round trip time
+        :type healthy: List[bool], optional
+        """
+        if healthy is None:
+            healthy = [x.dc_rtt is not None for x in dc_hostnames]
+        now = timezone.now()
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create([cls(
+                ip=dc_hostname.dc_ip,
+                hostname=dc_hostname.dc_hostname,
+                port=dc_hostname.dc_port,
+                priority=dc_hostname.dc_priority,
+                weight=dc_hostname.dc_weight,
+                latency=dc_hostname.dc_rtt,
+                last_check=now,
+                healthy=is_healthy,
+                rank=rank,
+            ) for rank, (dc_hostname, is_healthy) in enumerate(zip(dc_hostnames, healthy)) if dc_hostname.dc_ip])
+        cls.invalidate_cache()
+
+
+class ADGroup(models.Model):
+    """
+    A group mirrored from Active Directory by *python manage.py adsync*
+    """
+    object_guid = models.CharField(max_length=36, unique=True)  #: objectGUID of the group
+    dn = models.TextField()  #: a distinguished name
+    name = models.CharField(max_length=256, db_index=True)  #: sAMAccountName
+    description = models.TextField(blank=True, default='')
+    usn_changed = models.BigIntegerField(default=0)  #: uSNChanged, the update sequence number of the last change
+    synced = models.DateTimeField()  #: the start time of the last sync which has read the group
+
+    def __str__(self):
+        return self.name
+
+
+class ADUser(models.Model):
+    """
+    A user mirrored from Active Directory by *python manage.py adsync*
+    """
+    object_guid = models.CharField(max_length=36, unique=True)  #: objectGUID of the user
+    dn = models.TextField()  #: a distinguished name
+    username = models.CharField(max_length=256, db_index=True)  #: sAMAccountName
+    user_principal_name = models.CharField(max_length=256, blank=True, default='')
+    first_name = models.CharField(max_length=256, blank=True, default='')  #: givenName
+    last_name = models.CharField(max_length=256, blank=True, default='')  #: sn
+    display_name = models.CharField(max_length=256, blank=True, default='')
+    email = models.CharField(max_length=256, blank=True, default='')  #: mail
+    is_active = models.BooleanField(default=True)  #: the account is not disabled
+    usn_changed = models.BigIntegerField(default=0)  #: uSNChanged, the update sequence number of the last change
+    synced = models.DateTimeField()  #: the start time of the last sync which has read the user
+
+    def __str__(self):
+        return self.username
+
+
+class ADMembership(models.Model):
+    """
+    A member of a group mirrored from the member attribute of the group by *python manage.py adsync*,
+    the member is a user or a group
+    """
+    group = models.ForeignKey(ADGroup, on_delete=models.CASCADE, related_name='memberships')
+    member_dn = models.TextField()  #: a distinguished name of the member in lowercase
+
+    def __str__(self):
+        return f'{self.group_id}: {self.member_dn}'
+
+
+class SyncState(models.Model):
+    """
+    The high-water mark of the incremental sync of a domain controller.
+    Update sequence numbers are local to a domain controller, so every controller has its own mark
+    """
+    dc = models.CharField(max_length=255, unique=True)  #: a hostname or an ip address of the domain controller
+    highest_usn = models.BigIntegerField(default=0)  #: highestCommittedUSN read before the last successful sync
+    synced = models.DateTimeField()  #: the start time of the last successful sync
+
+    def __str__(self):
+        return f'{self.dc}: {self.highest_usn}'
@@ -0,0 +1,876 @@
+"""
+django_adtools/pure_ldap.py
+
+A pure-Python LDAP client (RFC 4511) with the interface of python-ldap connections used by django_adtools:
+simple binds, searches with controls, the WhoAmI and StartTLS extended operations, abandon and unbind.
+Messages are encoded by django_adtools.ber. LDAPS (ldaps:// URIs) and StartTLS are encrypted by ssl memory BIOs,
+so the socket stays non-blocking, and TLS sessions are resumed by next connections to the same server.
+
+Requests are written to a non-blocking socket. Synchronous methods (simple_bind_s, search_s, result3, ...)
+wait for responses using selectors, coroutines (async_connect, async_result) wait for them in the event loop,
+so async views do not poll and do not need an executor. Errors are raised as exceptions of ldap_compat
+(ldap.INVALID_CREDENTIALS, ldap.SERVER_DOWN, ldap.TIMEOUT, ...) and response controls are decoded by it,
+so callers handle both backends the same way. python-ldap is not required.
+
+.. code-block:: python
+
+    conn = PureLDAPObject('ldap://10.0.0.1')
+    conn.set_option(ldap.OPT_NETWORK_TIMEOUT, 3.0)
+    conn.simple_bind_s('user@example.com', 'password')
+    entries = conn.search_s('DC=example,DC=com', ldap.SCOPE_SUBTREE, '(sAMAccountName=user)', ['memberOf'])
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-13"
+
+import time
+import ssl
+import socket
+import asyncio
+import selectors
+import threading
+import logging
+from urllib.parse import urlsplit
+from .ldap_compat import ldap
+from .ber import (
+    TAG_BOOLEAN, TAG_OCTET_STRING, BERDecodeError, application, context,
+    encode, encode_integer, encode_enumerated, encode_boolean, encode_octet_string, encode_sequence,
+    element_length, decode, decode_elements, decode_integer, decode_boolean,
+)
+from .tls import STARTTLS_OID, LDAPS_PORT, client_context, tls_sessions
+# type hints
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+DEFAULT_PORT: int = 389  #: the port of ldap:// URIs without a port
+TLS_REQUIRE_CERT: Tuple[int, ...] = (ldap.OPT_X_TLS_DEMAND, ldap.OPT_X_TLS_HARD)  #: values which verify certificates
+PROTOCOL_VERSION: int = 3
+RECEIVE_SIZE: int = 65536  #: bytes read from the socket at once
+
+# protocol operations (RFC 4511 section 4.2 - 4.12)
+BIND_REQUEST: int = application(0)
+BIND_RESPONSE: int = application(1)
+UNBIND_REQUEST: int = application(2, constructed=False)
+SEARCH_REQUEST: int = application(3)
+SEARCH_RESULT_ENTRY: int = application(4)
+SEARCH_RESULT_DONE: int = application(5)
+SEARCH_RESULT_REFERENCE: int = application(19)
+ABANDON_REQUEST: int = application(16, constructed=False)
+EXTENDED_REQUEST: int = application(23)
+EXTENDED_RESPONSE: int = application(24)
+CONTROLS: int = context(0, constructed=True)
+
+WHOAMI_OID: str = '1.3.6.1.4.1.4203.1.11.3'  #: the "Who am I?" extended operation (RFC 4532)
+RES_EXTENDED: int = 0x78  #: the type of a result of an extended operation (ldap.RES_EXTENDED)
+
+#: responses which complete an operation -> types of results of python-ldap
+FINAL_RESPONSES: Dict[int, int] = {
+    BIND_RESPONSE: ldap.RES_BIND,
+    SEARCH_RESULT_DONE: ldap.RES_SEARCH_RESULT,
+    EXTENDED_RESPONSE: RES_EXTENDED,
+}
+
+#: LDAP result codes -> names of python-ldap exceptions
+ERRORS: Dict[int, str] = {
+    1: 'OPERATIONS_ERROR',
+    2: 'PROTOCOL_ERROR',
+    3: 'TIMELIMIT_EXCEEDED',
+    4: 'SIZELIMIT_EXCEEDED',
+    7: 'AUTH_METHOD_NOT_SUPPORTED',
+    8: 'STRONG_AUTH_REQUIRED',
+    10: 'REFERRAL',
+    11: 'ADMINLIMIT_EXCEEDED',
+    12: 'UNAVAILABLE_CRITICAL_EXTENSION',
+    13: 'CONFIDENTIALITY_REQUIRED',
+    16: 'NO_SUCH_ATTRIBUTE',
+    32: 'NO_SUCH_OBJECT',
+    34: 'INVALID_DN_SYNTAX',
+    48: 'INAPPROPRIATE_AUTH',
+    49: 'INVALID_CREDENTIALS',
+    50: 'INSUFFICIENT_ACCESS',
+    51: 'BUSY',
+    52: 'UNAVAILABLE',
+    53: 'UNWILLING_TO_PERFORM',
+    80: 'OTHER',
+}
+
+Message = Tuple[int, bytes, List[Tuple[str, bool, Optional[bytes]]]]  #: an operation tag, its content, controls
+Result = Tuple[Optional[int], Any, Optional[int], Optional[List[ldap.controls.ResponseControl]]]  #: like result3
+
+
+def ldap_error(name: str, info: str = '', **kwargs: Any) -> ldap.LDAPError:
+    """
+    Returns a python-ldap exception by its name (e.g. **INVALID_CREDENTIALS**),
+    ldap.LDAPError if the python-ldap version has no such exception
+
+    :param name: the name of the exception
+    :type name: str
+    :param info: a diagnostic message of the server
+    :type info: str
+    :param kwargs: other items of the dict of the exception: result, matched, msgid, ctrls
+    :rtype: ldap.LDAPError
+    """
+    desc: str = "Can't contact LDAP server" if name == 'SERVER_DOWN' else name.replace('_', ' ').capitalize()
+    return getattr(ldap, name, ldap.LDAPError)({'desc': desc, 'info': info, **kwargs})
+
+
+def _unescape(value: str) -> bytes:
+    """
+    Decodes a value of a search filter, \\XX sequences are hexadecimal octets (RFC 4515)
+    """
+    data: bytes = value.encode('utf-8')
+    if b'\\' not in data:
+        return data
+    result: bytearray = bytearray()
+    position: int = 0
+    while position < len(data):
+        if data[position] == 0x5c:  # a backslash
+            result.append(int(data[position + 1:position + 3], 16))
+            position += 3
+        else:
+            result.append(data[position])
+            position += 1
+    return bytes(result)
+
+
+def _encode_item(item: str) -> bytes:
+    """
+    Encodes a simple filter: equality, substrings, greater or equal, less or equal, presence, approximate
+    or extensible match
+    """
+    position: int = item.index('=')
+    operator: str = item[position - 1] if position else ''
+    value: str = item[position + 1:]
+    if operator == ':':
+        parts: List[str] = item[:position - 1].split(':')
+        attribute: str = parts[0]
+        dn_attributes: bool = 'dn' in [x.lower() for x in parts[1:]]
+        rules: List[str] = [x for x in parts[1:] if x.lower() != 'dn']
+        elements: List[bytes] = []
+        if rules:
+            elements.append(encode_octet_string(rules[0], tag=context(1)))
+        if attribute:
+            elements.append(encode_octet_string(attribute, tag=context(2)))
+        elements.append(encode_octet_string(_unescape(value), tag=context(3)))
+        if dn_attributes:
+            elements.append(encode_boolean(True, tag=context(4)))
+        return encode_sequence(elements, tag=context(9, constructed=True))
+    tags: Dict[str, int] = {'>': 5, '<': 6, '~': 8}
+    if operator in tags:
+        return encode_sequence([encode_octet_string(item[:position - 1]), encode_octet_string(_unescape(value))],
+                               tag=context(tags[operator], constructed=True))
+    attribute = item[:position]
+    if not attribute:
+        raise ValueError(f'an attribute expected in "{item}"')
+    if value == '*':
+        return encode_octet_string(attribute, tag=context(7))
+    if '*' in value:
+        pieces: List[str] = value.split('*')
+        substrings: List[bytes] = [encode_octet_string(_unescape(pieces[0]), tag=context(0))] if pieces[0] else []
+        substrings.extend(encode_octet_string(_unescape(x), tag=context(1)) for x in pieces[1:-1] if x)
+        if pieces[-1]:
+            substrings.append(encode_octet_string(_unescape(pieces[-1]), tag=context(2)))
+        return encode_sequence([encode_octet_string(attribute), encode_sequence(substrings)],
+                               tag=context(4, constructed=True))
+    return encode_sequence([encode_octet_string(attribute), encode_octet_string(_unescape(value))],
+                           tag=context(3, constructed=True))
+
+
+def _parse_filter(text: str, position: int) -> Tuple[bytes, int]:
+    """
+    Encodes the filter which starts at the position, returns it and the position after it
+    """
+    if text[position] != '(':
+        raise ValueError(f'"(" expected at {position}')
+    position += 1
+    kind: str = text[position]
+    if kind in '&|':
+        position += 1
+        elements: List[bytes] = []
+        while text[position] == '(':
+            element, position = _parse_filter(text, position)
+            elements.append(element)
+        encoded: bytes = encode_sequence(elements, tag=context(0 if kind == '&' else 1, constructed=True))
+    elif kind == '!':
+        element, position = _parse_filter(text, position + 1)
+        encoded = encode_sequence([element], tag=context(2, constructed=True))
+    else:
+        end: int = text.index(')', position)  # a closing parenthesis of a value is always escaped
+        encoded = _encode_item(text[position:end])
+        position = end
+    if text[position] != ')':
+        raise ValueError(f'")" expected at {position}')
+    return encoded, position + 1
+
+
+def encode_filter(search_filter: str) -> bytes:
+    """
+    Encodes a search filter in the string representation (RFC 4515), e.g. **(&(objectClass=user)(cn=a*))**
+
+    :param search_filter: the filter, enclosing parentheses can be omitted
+    :type search_filter: str
+    :return: the BER encoded filter
+    :rtype: bytes
+    :raises ldap.FILTER_ERROR: if the filter is not valid
+    """
+    text: str = search_filter.strip()
+    if not text.startswith('('):
+        text = f'({text})'
+    try:
+        encoded, position = _parse_filter(text, 0)
+        if position != len(text):
+            raise ValueError(f'unexpected "{text[position:]}"')
+    except (ValueError, IndexError) as e:
+        raise ldap_error('FILTER_ERROR', f'{str(e)}, filter={search_filter}')
+    return encoded
+
+
+def _encode_controls(serverctrls: Optional[List[ldap.controls.RequestControl]]) -> Optional[bytes]:
+    if not serverctrls:
+        return None
+    controls: List[bytes] = []
+    for control in serverctrls:
+        elements: List[bytes] = [encode_octet_string(control.controlType)]
+        if control.criticality:
+            elements.append(encode_boolean(True))
+        value: Optional[bytes] = control.encodeControlValue()
+        if value is not None:
+            elements.append(encode_octet_string(value))
+        controls.append(encode_sequence(elements))
+    return encode_sequence(controls, tag=CONTROLS)
+
+
+class PureLDAPObject:
+    """
+    A connection to a LDAP server, a replacement of ldap.ldapobject.SimpleLDAPObject.
+    The TCP connection is opened by the first operation (or by async_connect).
+    Like python-ldap connections, it has to be used by one thread or one coroutine at a time
+
+    TLS is configured by python-ldap options: OPT_X_TLS_CACERTFILE (defaults to CAs of the system) and
+    OPT_X_TLS_REQUIRE_CERT (OPT_X_TLS_DEMAND by default, the certificate and the name of the server are verified)
+
+    :param uri: a LDAP URI, e.g. **ldap://10.0.0.1**, **ldap://[fe80::1]:389** or **ldaps://10.0.0.1**
+    :type uri: str
+    """
+
+    def __init__(self, uri: str):
+        parts = urlsplit(uri)
+        if parts.scheme.lower() not in ('ldap', 'ldaps'):
+            raise ldap_error('PROTOCOL_ERROR', f'unsupported URI scheme {parts.scheme}')
+        self.uri: str = uri
+        self.ldaps: bool = parts.scheme.lower() == 'ldaps'
+        self.host: str = parts.hostname or 'localhost'
+        self.port: int = parts.port or (LDAPS_PORT if self.ldaps else DEFAULT_PORT)
+        self.timeout: float = -1  #: the timeout of synchronous operations, -1 means OPT_TIMEOUT
+        self._options: Dict[int, Any] = {}
+        self._sock: Optional[socket.socket] = None
+        self._selector: Optional[selectors.BaseSelector] = None
+        self._closed: bool = False
+        self._buffer: bytearray = bytearray()
+        self._last_msgid: int = 0
+        self._responses: Dict[int, List[Message]] = {}  # received responses which are not returned yet
+        self._pending: Set[int] = set()  # message ids of operations waiting for the final response
+        self._lock: threading.RLock = threading.RLock()
+        self._tls: Optional[ssl.SSLObject] = None
+        self._tls_incoming: Optional[ssl.MemoryBIO] = None
+        self._tls_outgoing: Optional[ssl.MemoryBIO] = None
+        self._tls_key: Optional[Tuple[Any, ...]] = None  #: the key of TLS sessions of the server
+        self._tls_saved: bool = False  #: the TLS session has been saved for next connections
+
+    def set_option(self, option: int, value: Any) -> None:
+        """
+        Sets an option, OPT_NETWORK_TIMEOUT and OPT_TIMEOUT are used, other ones are kept only
+        """
+        self._options[option] = value
+
+    def get_option(self, option: int) -> Any:
+        return self._options.get(option)
+
+    def _timeout_option(self, option: int) -> Optional[float]:
+        value: Optional[float] = self._options.get(option)
+        return None if value is None or value < 0 else value
+
+    # connection
+
+    def _connect(self) -> None:
+        if self._closed:
+            raise ldap_error('SERVER_DOWN', 'the connection is unbound')
+        try:
+            sock: socket.socket = socket.create_connection(
+                (self.host, self.port), timeout=self._timeout_option(ldap.OPT_NETWORK_TIMEOUT),
+            )
+        except OSError as e:
+            raise ldap_error('SERVER_DOWN', str(e))
+        self._opened(sock)
+        if self.ldaps:
+            self._handshake('SERVER_DOWN')
+
+    async def async_connect(self) -> None:
+        """
+        Opens the TCP connection in the event loop if it is not opened yet (and performs the TLS handshake of LDAPS),
+        the hostname is resolved in the default executor of the loop
+
+        :raises ldap.SERVER_DOWN: if the server is not available
+        """
+        if self._sock is not None:
+            return
+        if self._closed:
+            raise ldap_error('SERVER_DOWN', 'the connection is unbound')
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        error: Optional[BaseException] = None
+        try:
+            addresses = await loop.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        except OSError as e:
+            raise ldap_error('SERVER_DOWN', str(e))
+        for family, kind, proto, _, address in addresses:
+            sock: socket.socket = socket.socket(family, kind, proto)
+            sock.setblocking(False)
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, address),
+                                       self._timeout_option(ldap.OPT_NETWORK_TIMEOUT))
+            except (OSError, asyncio.TimeoutError) as e:
+                sock.close()
+                error = e
+                continue
+            except BaseException:
+                sock.close()
+                raise
+            self._opened(sock)
+            if self.ldaps:
+                await self._async_handshake('SERVER_DOWN')
+            return
+        raise ldap_error('SERVER_DOWN', str(error) or 'timed out')
+
+    def _opened(self, sock: socket.socket) -> None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(sock, selectors.EVENT_READ)
+        self._sock = sock
+
+    def _close(self) -> None:
+        if self._sock is not None:
+            self._selector.close()
+            self._sock.close()
+            self._sock = None
+            self._tls = None
+            self._pending.clear()  # responses will not be received any more
+
+    # TLS
+
+    def _wrap(self) -> None:
+        """
+        Starts TLS on the opened socket, the session of a previous connection to the server is resumed if it exists
+        """
+        ca_file: Optional[str] = self._options.get(ldap.OPT_X_TLS_CACERTFILE)
+        require_cert: bool = self._options.get(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_DEMAND) in TLS_REQUIRE_CERT
+        try:
+            context: ssl.SSLContext = client_context(ca_file, require_cert)
+        except OSError as e:
+            raise self._server_down(f'could not load CA certificates {ca_file}: {str(e)}')
+        self._tls_key = (ca_file, require_cert, self.host, self.port)
+        self._tls_incoming, self._tls_outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+        self._tls = context.wrap_bio(self._tls_incoming, self._tls_outgoing, server_hostname=self.host,
+                                     session=tls_sessions.get(self._tls_key))
+        self._tls_saved = False
+
+    def _handshake_step(self, error: str) -> bool:
+        """
+        Continues the TLS handshake, returns true when it is completed, false if more data is needed
+        """
+        try:
+            self._tls.do_handshake()
+        except ssl.SSLWantReadError:
+            self._write_raw(self._tls_outgoing.read())
+            return False
+        except ssl.SSLError as e:
+            tls_sessions.invalidate(self._tls_key)
+            self._close()
+            raise ldap_error(error, f'TLS handshake failed: {str(e)}')
+        self._write_raw(self._tls_outgoing.read())
+        tls_sessions.record(self._tls.session_reused)
+        return True
+
+    def _handshake(self, error: str) -> None:
+        """
+        Performs the TLS handshake waiting for data during OPT_NETWORK_TIMEOUT
+
+        :param error: a name of the exception raised if the handshake failed
+        """
+        self._wrap()
+        timeout: Optional[float] = self._timeout_option(ldap.OPT_NETWORK_TIMEOUT)
+        deadline: Optional[float] = None if timeout is None else time.monotonic() + timeout
+        while not self._handshake_step(error):
+            remaining: Optional[float] = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if remaining == 0 or not self._selector.select(remaining):
+                raise self._server_down('timed out during the TLS handshake')
+            try:
+                data: bytes = self._sock.recv(RECEIVE_SIZE)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                raise self._server_down(str(e))
+            if not data:
+                raise self._server_down('the connection is closed by the server during the TLS handshake')
+            self._tls_incoming.write(data)
+
+    async def _async_handshake(self, error: str) -> None:
+        """
+        Performs the TLS handshake in the event loop
+        """
+        self._wrap()
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        while not self._handshake_step(error):
+            try:
+                data: bytes = await asyncio.wait_for(loop.sock_recv(self._sock, RECEIVE_SIZE),
+                                                     self._timeout_option(ldap.OPT_NETWORK_TIMEOUT))
+            except asyncio.TimeoutError:
+                raise self._server_down('timed out during the TLS handshake')
+            except OSError as e:
+                raise self._server_down(str(e))
+            if not data:
+                raise self._server_down('the connection is closed by the server during the TLS handshake')
+            self._tls_incoming.write(data)
+
+    def _decrypt(self, data: bytes) -> bytes:
+        """
+        Returns decrypted data received from the socket, the first data saves the TLS session
+        (sessions of TLS 1.3 are sent by the server after the handshake)
+        """
+        if not data:
+            return data
+        self._tls_incoming.write(data)
+        chunks: List[bytes] = []
+        while True:
+            try:
+                chunk: bytes = self._tls.read(RECEIVE_SIZE)
+            except ssl.SSLWantReadError:
+                break
+            except ssl.SSLZeroReturnError:
+                raise self._server_down('the TLS connection is closed by the server')
+            except ssl.SSLError as e:
+                raise self._server_down(f'TLS error: {str(e)}')
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if self._tls_outgoing.pending:
+            self._write_raw(self._tls_outgoing.read())
+        if chunks and not self._tls_saved and self._tls.session is not None:
+            tls_sessions.set(self._tls_key, self._tls.session)
+            self._tls_saved = True
+        return b''.join(chunks)
+
+    def _incoming(self, data: bytes) -> None:
+        """
+        Parses data received from the socket
+        """
+        if self._tls is None or not data:
+            self._feed(data)
+        else:
+            decrypted: bytes = self._decrypt(data)
+            if decrypted:
+                self._feed(decrypted)
+
+    @property
+    def tls_session_reused(self) -> Optional[bool]:
+        """
+        True if the TLS handshake has resumed a session of a previous connection, None without TLS
+        """
+        return None if self._tls is None else self._tls.session_reused
+
+    def _start_tls_request(self) -> int:
+        if self._tls is not None:
+            raise ldap_error('LOCAL_ERROR', 'TLS is already started')
+        return self._send(encode_sequence([encode_octet_string(STARTTLS_OID, tag=context(0))],
+                                          tag=EXTENDED_REQUEST))
+
+    def start_tls_s(self) -> None:
+        """
+        Performs the StartTLS extended operation and the TLS handshake, next operations are encrypted
+
+        :raises ldap.CONNECT_ERROR: if the TLS handshake failed, e.g. the certificate is not trusted
+        :raises ldap.LDAPError: if the server has rejected StartTLS
+        """
+        with self._lock:
+            self.result3(self._start_tls_request(), all=1, timeout=self.timeout)
+            self._handshake('CONNECT_ERROR')
+
+    async def async_start_tls(self) -> None:
+        """
+        Asyncio variant of start_tls_s
+        """
+        await self.async_connect()
+        await self.async_result(self._start_tls_request())
+        await self._async_handshake('CONNECT_ERROR')
+
+    def _server_down(self, info: str) -> ldap.LDAPError:
+        self._close()
+        return ldap_error('SERVER_DOWN', info)
+
+    # messages
+
+    def _send(self,
+              operation: bytes,
+              serverctrls: Optional[List[ldap.controls.RequestControl]] = None,
+              response: bool = True,
+              ) -> int:
+        """
+        Sends the operation, returns its message id. Responses are received only for operations sent with
+        **response** (abandon and unbind requests have no responses)
+        """
+        with self._lock:
+            if self._sock is None:
+                self._connect()
+            self._last_msgid += 1
+            msgid: int = self._last_msgid
+            elements: List[bytes] = [encode_integer(msgid), operation]
+            controls: Optional[bytes] = _encode_controls(serverctrls)
+            if controls is not None:
+                elements.append(controls)
+            self._write(encode_sequence(elements))
+            if response:
+                self._pending.add(msgid)
+            return msgid
+
+    def _write(self, data: bytes) -> None:
+        if self._tls is not None:
+            try:
+                self._tls.write(data)
+            except ssl.SSLError as e:
+                raise self._server_down(f'TLS error: {str(e)}')
+            data = self._tls_outgoing.read()
+        self._write_raw(data)
+
+    def _write_raw(self, data: bytes) -> None:
+        view: memoryview = memoryview(data)
+        while view:
+            try:
+                sent: int = self._sock.send(view)
+            except BlockingIOError:
+                # requests are small, the send buffer is full only if the server does not read them
+                self._selector.modify(self._sock, selectors.EVENT_WRITE)
+                ready = self._selector.select(self._timeout_option(ldap.OPT_NETWORK_TIMEOUT))
+                self._selector.modify(self._sock, selectors.EVENT_READ)
+                if not ready:
+                    raise self._server_down('timed out sending a request')
+                continue
+            except OSError as e:
+                raise self._server_down(str(e))
+            view = view[sent:]
+
+    def _feed(self, data: bytes) -> None:
+        """
+        Parses received data, complete messages are stored by message id
+        """
+        if not data:
+            raise self._server_down('the connection is closed by the server')
+        self._buffer += data
+        while True:
+            try:
+                length: Optional[int] = element_length(self._buffer)
+                if length is None:
+                    return
+                _, content, _ = decode(bytes(self._buffer[:length]))  # values are bytes as in python-ldap
+                del self._buffer[:length]
+                elements = decode_elements(content)
+                msgid: int = decode_integer(elements[0][1])
+                tag, value = elements[1]
+                controls: List[Tuple[str, bool, Optional[bytes]]] = []
+                if len(elements) > 2 and elements[2][0] == CONTROLS:
+                    for _, control in decode_elements(elements[2][1]):
+                        parts = decode_elements(control)
+                        controls.append((
+                            parts[0][1].decode('utf-8'),
+                            any(x[0] == TAG_BOOLEAN and decode_boolean(x[1]) for x in parts[1:]),
+                            next((x[1] for x in parts[1:] if x[0] == TAG_OCTET_STRING), None),
+                        ))
+            except (BERDecodeError, IndexError) as e:
+                raise self._server_down(f'a malformed message: {str(e)}')
+            if msgid == 0:
+                # an unsolicited notification, e.g. the notice of disconnection
+                raise self._server_down(f'an unsolicited notification: {str(value)}')
+            if msgid not in self._pending:
+                # a response of an abandoned operation, the server may send it or not
+                continue
+            if tag in FINAL_RESPONSES:
+                self._pending.discard(msgid)
+            self._responses.setdefault(msgid, []).append((tag, value, controls))
+
+    def _receive(self, timeout: Optional[float]) -> bool:
+        """
+        Waits for data during the timeout (None means forever), returns false if the timeout expired
+        """
+        if self._sock is None:
+            raise ldap_error('SERVER_DOWN', 'the connection is not opened')
+        if not self._selector.select(timeout):
+            return False
+        try:
+            data: bytes = self._sock.recv(RECEIVE_SIZE)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            raise self._server_down(str(e))
+        self._incoming(data)
+        return True
+
+    def _take(self, msgid: int, all: int) -> Optional[Result]:
+        """
+        Returns the result of the operation if it is received: one response (all=0) or the whole result (all=1).
+        RES_ANY takes the first operation which has a response (all=0) or which is completed (all=1)
+        """
+        if msgid == ldap.RES_ANY:
+            msgid = next((x for x, responses in self._responses.items()
+                          if responses and (not all or responses[-1][0] in FINAL_RESPONSES)), None)
+            if msgid is None:
+                return None
+        responses: Optional[List[Message]] = self._responses.get(msgid)
+        if not responses:
+            return None
+        if not all:
+            tag, value, controls = responses.pop(0)
+            if tag == SEARCH_RESULT_ENTRY:
+                return ldap.RES_SEARCH_ENTRY, [self._entry(value)], msgid, []
+            if tag == SEARCH_RESULT_REFERENCE:
+                return ldap.RES_SEARCH_REFERENCE, [self._reference(value)], msgid, []
+            del self._responses[msgid]
+            return self._final(msgid, tag, value, controls, [])
+        if responses[-1][0] not in FINAL_RESPONSES:
+            return None
+        del self._responses[msgid]
+        data: List[Tuple[Optional[str], Any]] = [
+            self._entry(value) if tag == SEARCH_RESULT_ENTRY else self._reference(value)
+            for tag, value, _ in responses[:-1]
+        ]
+        return self._final(msgid, *responses[-1], data)
+
+    @staticmethod
+    def _entry(value: bytes) -> Tuple[str, Dict[str, List[bytes]]]:
+        elements = decode_elements(value)
+        attributes: Dict[str, List[bytes]] = {}
+        for _, attribute in decode_elements(elements[1][1]):
+            parts = decode_elements(attribute)
+            attributes[parts[0][1].decode('utf-8')] = [x[1] for x in decode_elements(parts[1][1])]
+        return elements[0][1].decode('utf-8'), attributes
+
+    @staticmethod
+    def _reference(value: bytes) -> Tuple[None, List[str]]:
+        return None, [x[1].decode('utf-8') for x in decode_elements(value)]
+
+    @staticmethod
+    def _final(msgid: int,
+               tag: int,
+               value: bytes,
+               controls: List[Tuple[str, bool, Optional[bytes]]],
+               data: Any,
+               ) -> Result:
+        elements = decode_elements(value)
+        code: int = decode_integer(elements[0][1])
+        response_controls: List[ldap.controls.ResponseControl] = ldap.controls.DecodeControlTuples(controls) \
+            if controls else []
+        if code != 0:
+            raise ldap_error(ERRORS.get(code, 'LDAPError'), elements[2][1].decode('utf-8', 'replace'),
+                             result=code, matched=elements[1][1].decode('utf-8', 'replace'), msgid=msgid,
+                             ctrls=response_controls)
+        if tag == EXTENDED_RESPONSE:
+            data = next((x[1] for x in elements[3:] if x[0] == context(11)), None)
+        return FINAL_RESPONSES[tag], data, msgid, response_controls
+
+    def result3(self, msgid: int = ldap.RES_ANY, all: int = 1, timeout: Optional[float] = None) -> Result:
+        """
+        Waits for the result of the operation like python-ldap does
+
+        :param msgid: the message id of the operation, defaults to **ldap.RES_ANY**
+        :type msgid: int
+        :param all: 1 - return the whole result, 0 - return entries of a search one by one
+        :type all: int
+        :param timeout: seconds to wait, 0 - do not wait, -1 - wait OPT_TIMEOUT seconds (or forever if it is not
+            set), defaults to **None** (the timeout attribute)
+        :type timeout: float, optional
+        :return: a type of the result, its data, the message id and response controls,
+            (None, None, None, None) if the timeout is 0 and the result is not received yet
+        :rtype: Result
+        :raises ldap.TIMEOUT: if the result was not received during the timeout
+        :raises ldap.LDAPError: if the operation failed
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None or timeout < 0:
+            timeout = self._timeout_option(ldap.OPT_TIMEOUT)
+        deadline: Optional[float] = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                result: Optional[Result] = self._take(msgid, all)
+                if result is not None:
+                    return result
+                if timeout == 0:
+                    if self._sock is not None and self._receive(0):
+                        continue
+                    return None, None, None, None
+                remaining: Optional[float] = None if deadline is None else max(0.0, deadline - time.monotonic())
+                if remaining == 0 or not self._receive(remaining):
+                    raise ldap_error('TIMEOUT', f'timeout={timeout}', msgid=msgid)
+
+    async def async_result(self, msgid: int, all: int = 1) -> Result:
+        """
+        Waits for the result of the operation in the event loop, the same as result3 otherwise.
+        Limit the waiting by asyncio.wait_for if it is needed
+
+        :rtype: Result
+        :raises ldap.LDAPError: if the operation failed
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        while True:
+            result: Optional[Result] = self._take(msgid, all)
+            if result is not None:
+                return result
+            if self._sock is None:
+                raise ldap_error('SERVER_DOWN', 'the connection is not opened')
+            try:
+                data: bytes = await loop.sock_recv(self._sock, RECEIVE_SIZE)
+            except OSError as e:
+                raise self._server_down(str(e))
+            self._incoming(data)
+
+    # operations
+
+    def simple_bind(self, who: Optional[str] = '', cred: Optional[str] = '',
+                    serverctrls: Optional[List[ldap.controls.RequestControl]] = None,
+                    clientctrls: Optional[List[ldap.controls.RequestControl]] = None) -> int:
+        """
+        Sends a simple bind request, returns its message id
+        """
+        return self._send(encode_sequence([
+            encode_integer(PROTOCOL_VERSION),
+            encode_octet_string(who or ''),
+            encode_octet_string(cred or '', tag=context(0)),
+        ], tag=BIND_REQUEST), serverctrls)
+
+    def simple_bind_s(self, who: Optional[str] = '', cred: Optional[str] = '',
+                      serverctrls: Optional[List[ldap.controls.RequestControl]] = None,
+                      clientctrls: Optional[List[ldap.controls.RequestControl]] = None) -> Result:
+        """
+        Binds with the distinguished name (or a user principal name) and the password
+
+        :raises ldap.INVALID_CREDENTIALS: if the password is wrong
+        :raises ldap.SERVER_DOWN: if the server is not available
+        """
+        return self.result3(self.simple_bind(who, cred, serverctrls), all=1, timeout=self.timeout)
+
+    def bind_s(self, who: Optional[str], cred: Optional[str], method: int = 0x80) -> Result:
+        """
+        Binds with the simple authentication method, other methods are not supported
+        """
+        if method != 0x80:
+            raise ldap_error('AUTH_METHOD_NOT_SUPPORTED', f'method={method}')
+        return self.simple_bind_s(who, cred)
+
+    def search_ext(self,
+                   base: str,
+                   scope: int,
+                   filterstr: str = '(objectClass=*)',
+                   attrlist: Optional[List[str]] = None,
+                   attrsonly: int = 0,
+                   serverctrls: Optional[List[ldap.controls.RequestControl]] = None,
+                   clientctrls: Optional[List[ldap.controls.RequestControl]] = None,
+                   timeout: float = -1,
+                   sizelimit: int = 0,
+                   ) -> int:
+        """
+        Sends a search request, returns its message id. A positive **timeout** is sent as the time limit
+        of the search in whole seconds
+
+        :raises ldap.FILTER_ERROR: if the filter is not valid
+        """
+        return self._send(encode_sequence([
+            encode_octet_string(base),
+            encode_enumerated(scope),
+            encode_enumerated(0),  # derefAliases: neverDerefAliases
+            encode_integer(sizelimit),
+            encode_integer(max(0, int(timeout))),
+            encode_boolean(bool(attrsonly)),
+            encode_filter(filterstr),
+            encode_sequence([encode_octet_string(x) for x in attrlist or []]),
+        ], tag=SEARCH_REQUEST), serverctrls)
+
+    search = search_ext
+
+    def search_ext_s(self,
+                     base: str,
+                     scope: int,
+                     filterstr: str = '(objectClass=*)',
+                     attrlist: Optional[List[str]] = None,
+                     attrsonly: int = 0,
+                     serverctrls: Optional[List[ldap.controls.RequestControl]] = None,
+                     clientctrls: Optional[List[ldap.controls.RequestControl]] = None,
+                     timeout: float = -1,
+                     sizelimit: int = 0,
+                     ) -> List[Tuple[Optional[str], Any]]:
+        """
+        Searches and returns entries (and referrals as (None, [URIs]))
+
+        :raises ldap.LDAPError: if the search failed
+        """
+        msgid: int = self.search_ext(base, scope, filterstr, attrlist, attrsonly, serverctrls,
+                                     timeout=timeout, sizelimit=sizelimit)
+        return self.result3(msgid, all=1, timeout=timeout)[1]
+
+    def search_s(self,
+                 base: str,
+                 scope: int,
+                 filterstr: str = '(objectClass=*)',
+                 attrlist: Optional[List[str]] = None,
+                 attrsonly: int = 0,
+                 ) -> List[Tuple[Optional[str], Any]]:
+        """
+        Searches and returns entries, the same as search_ext_s without controls
+        """
+        return self.search_ext_s(base, scope, filterstr, attrlist, attrsonly, timeout=self.timeout)
+
+    def abandon_ext(self, msgid: int,
+                    serverctrls: Optional[List[ldap.controls.RequestControl]] = None,
+                    clientctrls: Optional[List[ldap.controls.RequestControl]] = None) -> None:
+        """
+        Abandons the operation, its received and future responses are dropped
+        """
+        with self._lock:
+            self._responses.pop(msgid, None)
+            if msgid not in self._pending:
+                return  # the operation is completed already
+            self._pending.discard(msgid)
+            if self._sock is not None:
+                self._send(encode_integer(msgid, tag=ABANDON_REQUEST), serverctrls, response=False)
+
+    def abandon(self, msgid: int) -> None:
+        self.abandon_ext(msgid)
+
+    def whoami_s(self) -> str:
+        """
+        Returns the authorization identity of the connection, e.g. **u:EXAMPLE\\user**, empty for anonymous
+        """
+        msgid: int = self._send(encode_sequence([encode_octet_string(WHOAMI_OID, tag=context(0))],
+                                                tag=EXTENDED_REQUEST))
+        value: Optional[bytes] = self.result3(msgid, all=1, timeout=self.timeout)[1]
+        return (value or b'').decode('utf-8')
+
+    def unbind_ext(self,
+                   serverctrls: Optional[List[ldap.controls.RequestControl]] = None,
+                   clientctrls: Optional[List[ldap.controls.RequestControl]] = None) -> None:
+        """
+        Sends the unbind request and closes the connection, the object can not be used anymore
+        """
+        with self._lock:
+            try:
+                if self._sock is not None:
+                    self._send(encode(UNBIND_REQUEST, b''), serverctrls, response=False)
+            finally:
+                self._close()
+                self._closed = True
+
+    def unbind_s(self) -> None:
+        self.unbind_ext()
+
+    unbind = unbind_s
+
+    def __repr__(self) -> str:
+        return f'PureLDAPObject(uri={self.uri!r})'
@@ -0,0 +1,261 @@
+"""
+django_adtools/shared_cache.py
+
+A second level of caches of the process kept in a Django cache (Redis, memcached, locmem, file, ...),
+so worker processes share discovered domain controllers, DNS answers and groups of users instead of
+rebuilding them one by one.
+
+Keys are versioned: KEY_VERSION changes with the format of cached values and **version** of the cache
+(ADTOOLS_SHARED_CACHE_VERSION) drops all entries at once. An expired value is refreshed by one process
+(single flight), other ones return the stale value while it is allowed or wait for the new one:
+
+.. code-block:: python
+
+    shared = SharedCache('default')
+    ips = shared.get_or_refresh(('dc', 'list'), lambda: query_database(), ttl=10.0)
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-15"
+
+import os
+import math
+import time
+import hashlib
+import threading
+import logging
+# type hints
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+KEY_VERSION: int = 1  #: the version of the format of cached values, it is a part of every key
+MAX_KEY_LENGTH: int = 200  #: longer keys are replaced by their hash, memcached accepts at most 250 characters
+
+Key = Tuple[Any, ...]  #: parts of a key, e.g. ('dns', 'example.com', 'SRV')
+Entry = Tuple[float, Any]  #: the unix time when the value expires and the value
+
+
+class SharedCache:
+    """
+    A namespace in a Django cache with TTLs and single-flight refresh of expired values.
+    Values must be picklable and must not be None
+
+    :param alias: an alias of a cache from CACHES of settings.py, defaults to **default**
+    :type alias: str
+    :param version: a version of keys, changing it drops all cached values, defaults to **1**
+    :type version: int
+    :param stale_ttl: seconds an expired value is returned while one process refreshes it, defaults to **0**
+    :type stale_ttl: float
+    :param lock_timeout: seconds a refresh may take, other processes wait for it at most this time,
+        then they compute the value themselves, defaults to **10**
+    :type lock_timeout: float
+    :param poll_interval: seconds between checks of a value being refreshed by another process,
+        defaults to **0.01**
+    :type poll_interval: float
+    """
+
+    def __init__(self,
+                 alias: str = 'default',
+                 version: int = 1,
+                 stale_ttl: float = 0.0,
+                 lock_timeout: float = 10.0,
+                 poll_interval: float = 0.01,
+                 ):
+        self.alias: str = alias
+        self.version: int = version
+        self.stale_ttl: float = stale_ttl
+        self.lock_timeout: float = lock_timeout
+        self.poll_interval: float = poll_interval
+        self._prefix: str = f'{__package__}:{KEY_VERSION}.{version}:'
+        self.hits: int = 0  #: number of values read from the cache
+        self.misses: int = 0  #: number of values which were missing or expired
+        self.refreshes: int = 0  #: number of values computed by this process
+        self.waits: int = 0  #: number of values refreshed by another process while this one was waiting
+
+    @property
+    def cache(self):
+        """
+        The Django cache, connections of Django caches are per thread
+        """
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def key(self, key: Key) -> str:
+        """
+        Returns the key of the Django cache, long keys and keys with spaces or control characters are hashed
+
+        :param key: parts of the key
+        :type key: Key
+        :rtype: str
+        """
+        text: str = ':'.join(str(x) for x in key)
+        if len(text) > MAX_KEY_LENGTH or any(ord(x) <= 32 or ord(x) == 127 for x in text):
+            text = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return self._prefix + text
+
+    def _read(self, key: str) -> Optional[Entry]:
+        try:
+            return self.cache.get(key)
+        except Exception as e:
+            # an unavailable cache server must not break logins, values are computed without it
+            logger.error(f'{__package__} SharedCache could not read {key}: {str(e)}')
+            return None
+
+    def get(self, key: Key) -> Optional[Any]:
+        """
+        Returns a value which has not expired or None
+
+        :param key: parts of the key
+        :type key: Key
+        """
+        entry: Optional[Entry] = self._read(self.key(key))
+        if entry is None or entry[0] <= time.time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Key, value: Any, ttl: float) -> None:
+        """
+        Stores the value for **ttl** seconds (plus **stale_ttl** seconds it can be returned as a stale one),
+        a zero ttl removes the cached value
+
+        :param key: parts of the key
+        :type key: Key
+        :param value: a picklable value, not None
+        :param ttl: seconds the value is valid for
+        :type ttl: float
+        """
+        if ttl <= 0:
+            self.delete(key)
+            return
+        try:
+            self.cache.set(self.key(key), (time.time() + ttl, value), timeout=math.ceil(ttl + self.stale_ttl))
+        except Exception as e:
+            logger.error(f'{__package__} SharedCache could not write {self.key(key)}: {str(e)}')
+
+    def delete(self, key: Key) -> None:
+        """
+        Removes the value, e.g. after its source was changed
+
+        :param key: parts of the key
+        :type key: Key
+        """
+        try:
+            self.cache.delete(self.key(key))
+        except Exception as e:
+            logger.error(f'{__package__} SharedCache could not delete {self.key(key)}: {str(e)}')
+
+    def _lock(self, key: str) -> Optional[str]:
+        """
+        Returns a token if this process has got the right to refresh the value
+        """
+        token: str = f'{os.getpid()}.{threading.get_ident()}.{time.time()}'
+        try:
+            if self.cache.add(f'{key}:lock', token, timeout=math.ceil(self.lock_timeout)):
+                return token
+        except Exception as e:
+            logger.error(f'{__package__} SharedCache could not lock {key}: {str(e)}')
+            return token  # without the cache every process refreshes its own value
+        return None
+
+    def _unlock(self, key: str, token: str) -> None:
+        try:
+            if self.cache.get(f'{key}:lock') == token:
+                self.cache.delete(f'{key}:lock')
+        except Exception as e:
+            logger.error(f'{__package__} SharedCache could not unlock {key}: {str(e)}')
+
+    def get_or_refresh(self,
+                       key: Key,
+                       compute: Callable[[], Any],
+                       ttl: Union[float, Callable[[Any], float]],
+                       ) -> Any:
+        """
+        Returns the cached value, or computes and stores it. Only one process computes an expired value,
+        others return the stale value if there is one, or wait for the new one at most **lock_timeout** seconds
+
+        :param key: parts of the key
+        :type key: Key
+        :param compute: a function which returns the value, its exceptions are raised
+        :type compute: Callable[[], Any]
+        :param ttl: seconds the value is valid for, or a function of the value which returns them,
+            values with a zero ttl are returned but not stored
+        :type ttl: Union[float, Callable[[Any], float]]
+        :return: the value
+        """
+        cache_key: str = self.key(key)
+        waiting_until: float = time.monotonic() + self.lock_timeout
+        waited: bool = False
+        while True:
+            entry: Optional[Entry] = self._read(cache_key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                if waited:
+                    self.waits += 1
+                return entry[1]
+            token: Optional[str] = self._lock(cache_key)
+            if token is not None:
+                self.misses += 1
+                try:
+                    return self._refresh(key, compute, ttl)
+                finally:
+                    self._unlock(cache_key, token)
+            if entry is not None:
+                self.hits += 1
+                return entry[1]  # a stale value, another process is refreshing it
+            if time.monotonic() >= waiting_until:
+                logger.warning(f'{__package__} SharedCache the refresh of {cache_key} by another process '
+                               f'has not finished in {self.lock_timeout}s')
+                self.misses += 1
+                return self._refresh(key, compute, ttl)
+            waited = True
+            time.sleep(self.poll_interval)
+
+    def _refresh(self, key: Key, compute: Callable[[], Any], ttl: Union[float, Callable[[Any], float]]) -> Any:
+        value: Any = compute()
+        self.refreshes += 1
+        seconds: float = ttl(value) if callable(ttl) else ttl
+        if seconds > 0:
+            self.set(key, value, seconds)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters of the cache
+
+        :return: a dict with keys: hits, misses, refreshes, waits
+        :rtype: Dict[str, int]
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes, 'waits': self.waits}
+
+
+_default_shared_cache: Optional[SharedCache] = None  #: the shared cache configured in settings.py
+_default_shared_cache_lock: threading.Lock = threading.Lock()
+
+
+def get_default_shared_cache() -> Optional[SharedCache]:
+    """
+    Returns the shared cache configured by ADTOOLS_SHARED_CACHE (an alias of a Django cache),
+    ADTOOLS_SHARED_CACHE_VERSION, ADTOOLS_SHARED_CACHE_STALE_TTL and ADTOOLS_SHARED_CACHE_LOCK_TIMEOUT settings,
+    or None if ADTOOLS_SHARED_CACHE is not set
+
+    :return: the shared cache of the process
+    :rtype: SharedCache, optional
+    """
+    global _default_shared_cache
+    if _default_shared_cache is None:
+        from django.conf import settings
+        alias: Optional[str] = getattr(settings, 'ADTOOLS_SHARED_CACHE', None)
+        if not alias:
+            return None
+        with _default_shared_cache_lock:
+            if _default_shared_cache is None:
+                _default_shared_cache = SharedCache(
+                    alias=alias,
+                    version=getattr(settings, 'ADTOOLS_SHARED_CACHE_VERSION', 1),
+                    stale_ttl=getattr(settings, 'ADTOOLS_SHARED_CACHE_STALE_TTL', 0.0),
+                    lock_timeout=getattr(settings, 'ADTOOLS_SHARED_CACHE_LOCK_TIMEOUT', 10.0),
+                )
+    return _default_shared_cache
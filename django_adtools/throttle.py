@@ -0,0 +1,349 @@
+"""
+django_adtools/throttle.py
+
+Throttling of failed logins in front of ad_login. Every rejected password costs a bind on a domain controller
+and brings the account closer to the lockout, so during a credential-stuffing burst repeated failures are rejected
+locally without a request to the domain controller:
+
+* a token bucket of every username and of every source (e.g. an ip address of a client),
+  a failed login takes a token, logins are rejected while a bucket is empty, tokens are refilled with time
+* a negative cache of recently failed pairs of a username and a password, stored as HMAC hashes
+
+Successful logins do not take tokens. State is kept in the process or in a Django cache shared by processes,
+a bucket in a Django cache is approximated by counters of failures updated atomically (cache.add and cache.incr),
+the throttle allows logins if the Django cache is not available.
+
+.. code-block:: python
+
+    throttle = LoginThrottle(username_burst=5, username_rate=1 / 60)
+    ad_login(dc=dc, username=username, password=password, domain=domain, group=group,
+             throttle=throttle, source=request.META.get('REMOTE_ADDR'))
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-14"
+
+import os
+import math
+import time
+import hmac
+import hashlib
+import threading
+import logging
+from . import ad_tools
+from .caches import TTLCache
+# type hints
+from typing import Dict, Optional, Tuple, Union
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+Bucket = Tuple[float, float]  #: tokens left and the unix time when they were counted
+
+
+class _LocalStore:
+    """
+    Keeps token buckets and failed pairs in the process, a bucket is read and updated under the lock
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self._cache: TTLCache = TTLCache(ttl=ttl, max_size=max_size)
+        self._lock: threading.Lock = threading.Lock()
+
+    def _tokens(self, key: str, burst: float, rate: float, now: float) -> float:
+        bucket: Optional[Bucket] = self._cache.get(key)
+        if bucket is None:
+            return burst
+        tokens, counted = bucket
+        return min(burst, tokens + max(0.0, now - counted) * rate)
+
+    def tokens(self, key: str, burst: float, rate: float, now: float) -> float:
+        """
+        Returns tokens of the bucket now, a missing bucket is full
+        """
+        with self._lock:
+            return self._tokens(key, burst, rate, now)
+
+    def take(self, key: str, burst: float, rate: float, now: float) -> None:
+        """
+        Takes a token of the bucket
+        """
+        with self._lock:
+            tokens: float = max(0.0, self._tokens(key, burst, rate, now) - 1)
+            # the bucket is full again after this time, then it is not needed any more
+            self._cache.set(key, (tokens, now), (burst - tokens) / rate)
+
+    def refill(self, key: str, burst: float, rate: float) -> None:
+        self._cache.invalidate(key)
+
+    def remember(self, key: str, ttl: float) -> None:
+        self._cache.set(key, True, ttl)
+
+    def seen(self, key: str) -> bool:
+        return self._cache.get(key) is not None
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+class _DjangoCacheStore:
+    """
+    Stores state of the throttle in a Django cache, so it is shared by processes. A bucket is approximated
+    by counters of failures in windows of burst / rate seconds (the time to refill the whole bucket):
+    failures of the current window and a part of failures of the previous one, which is not refilled yet.
+    Counters are updated by atomic cache.add and cache.incr, so processes do not lose failures of each other.
+    Errors of the cache are logged, then a bucket is full and a pair is not found (logins are allowed)
+    """
+
+    def __init__(self, alias: str):
+        self.alias: str = alias
+        self.prefix: str = f'{__package__}:throttle:'
+
+    @property
+    def cache(self):
+        """
+        The Django cache, connections of Django caches are per thread
+        """
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def _counters(self, key: str, burst: float, rate: float, now: float) -> Tuple[str, str, float, float]:
+        """
+        Returns keys of counters of the previous and the current windows, the part of the current window passed
+        and the length of a window
+        """
+        length: float = burst / rate
+        position: float = now / length
+        window: int = int(position)
+        return f'{self.prefix}{key}:{window - 1}', f'{self.prefix}{key}:{window}', position - window, length
+
+    def tokens(self, key: str, burst: float, rate: float, now: float) -> float:
+        previous, current, passed, _ = self._counters(key, burst, rate, now)
+        try:
+            counts: Dict[str, int] = self.cache.get_many([previous, current])
+        except Exception as e:
+            logger.error(f'{__package__} LoginThrottle could not read {current}: {str(e)}')
+            return burst
+        return burst - counts.get(previous, 0) * (1 - passed) - counts.get(current, 0)
+
+    def take(self, key: str, burst: float, rate: float, now: float) -> None:
+        _, current, _, length = self._counters(key, burst, rate, now)
+        timeout: int = math.ceil(2 * length) + 1  # the counter is read during the next window too
+        try:
+            if not self.cache.add(current, 1, timeout=timeout):
+                try:
+                    self.cache.incr(current)
+                except ValueError:  # the counter has expired after add
+                    self.cache.add(current, 1, timeout=timeout)
+        except Exception as e:
+            logger.error(f'{__package__} LoginThrottle could not count a failure {current}: {str(e)}')
+
+    def refill(self, key: str, burst: float, rate: float) -> None:
+        previous, current, _, _ = self._counters(key, burst, rate, time.time())
+        try:
+            self.cache.delete_many([previous, current])
+        except Exception as e:
+            logger.error(f'{__package__} LoginThrottle could not delete {current}: {str(e)}')
+
+    def remember(self, key: str, ttl: float) -> None:
+        try:
+            self.cache.set(self.prefix + key, True, timeout=max(1, math.ceil(ttl)))
+        except Exception as e:
+            logger.error(f'{__package__} LoginThrottle could not write {self.prefix + key}: {str(e)}')
+
+    def seen(self, key: str) -> bool:
+        try:
+            return self.cache.get(self.prefix + key) is not None
+        except Exception as e:
+            logger.error(f'{__package__} LoginThrottle could not read {self.prefix + key}: {str(e)}')
+            return False
+
+    def clear(self) -> None:
+        # other keys of the cache must survive, entries of the throttle expire by themselves
+        pass
+
+
+class LoginThrottle:
+    """
+    Rejects logins of a username or from a source after too many recent failures,
+    and repeated logins with a password that has just failed
+
+    :param username_burst: failures of a username allowed at once, defaults to **5**
+    :type username_burst: float
+    :param username_rate: tokens of a username refilled per second, defaults to **1/60** (one failure a minute)
+    :type username_rate: float
+    :param source_burst: failures from a source allowed at once, defaults to **50**
+    :type source_burst: float
+    :param source_rate: tokens of a source refilled per second, defaults to **1**
+    :type source_rate: float
+    :param negative_ttl: seconds a failed pair of a username and a password is rejected for, defaults to **60**,
+        0 disables the negative cache
+    :type negative_ttl: float
+    :param max_size: maximum number of buckets and failed pairs kept in the process, defaults to **10000**
+    :type max_size: int
+    :param cache: an alias of a Django cache (e.g. **default**) to share the state between processes,
+        defaults to **None** (the state is kept in the process)
+    :type cache: str, optional
+    :param secret: a key of HMAC hashes of usernames, sources and passwords, it must be the same in all processes
+        sharing a Django cache, defaults to **None** (a random key of the process)
+    :type secret: bytes, optional
+    """
+
+    def __init__(self,
+                 username_burst: float = 5,
+                 username_rate: float = 1 / 60,
+                 source_burst: float = 50,
+                 source_rate: float = 1.0,
+                 negative_ttl: float = 60.0,
+                 max_size: int = 10000,
+                 cache: Optional[str] = None,
+                 secret: Optional[bytes] = None,
+                 ):
+        if username_rate <= 0 or source_rate <= 0:
+            raise ValueError(f'{__package__} {type(self).__name__} rates must be positive, '
+                             f'got username_rate={username_rate}, source_rate={source_rate}')
+        self.username_burst: float = username_burst
+        self.username_rate: float = username_rate
+        self.source_burst: float = source_burst
+        self.source_rate: float = source_rate
+        self.negative_ttl: float = negative_ttl
+        self._secret: bytes = secret or os.urandom(32)
+        self._store: Union[_LocalStore, _DjangoCacheStore] = _LocalStore(ttl=negative_ttl, max_size=max_size) \
+            if cache is None else _DjangoCacheStore(cache)
+        self._lock: threading.Lock = threading.Lock()  #: guards counters of the throttle
+        self.rejected: int = 0  #: number of logins rejected by the throttle
+        self.failures: int = 0  #: number of recorded failures
+
+    def _key(self, kind: str, *parts: str) -> str:
+        message: bytes = '\0'.join((kind,) + parts).encode('utf-8')
+        return f'{kind}:{hmac.new(self._secret, message, hashlib.sha256).hexdigest()}'
+
+    @staticmethod
+    def _username(username: str) -> str:
+        return ad_tools.ad_clear_username(username).lower()
+
+    def _buckets(self, username: str, source: Optional[str]) -> Dict[str, Tuple[float, float]]:
+        """
+        Returns keys of buckets of the username and the source -> their bursts and rates
+        """
+        buckets: Dict[str, Tuple[float, float]] = {
+            self._key('u', self._username(username)): (self.username_burst, self.username_rate),
+        }
+        if source:
+            buckets[self._key('s', source)] = (self.source_burst, self.source_rate)
+        return buckets
+
+    def allow(self, username: str, password: str, source: Optional[str] = None) -> bool:
+        """
+        Checks that the login can be sent to a domain controller, it does not take a token
+
+        :param username: an active directory username
+        :type username: str
+        :param password: an active directory user password
+        :type password: str
+        :param source: a source of the login, e.g. an ip address of the client, defaults to **None**
+        :type source: str, optional
+        :return: False if the pair has failed recently or a bucket of the username or the source is empty
+        :rtype: bool
+        """
+        now: float = time.time()
+        username = self._username(username)
+        if self.negative_ttl and self._store.seen(self._key('p', username, password)):
+            reason: str = 'the password has failed recently'
+        else:
+            empty = [key for key, (burst, rate) in self._buckets(username, source).items()
+                     if self._store.tokens(key, burst, rate, now) < 1]
+            if not empty:
+                return True
+            reason = 'too many failures of the username' if empty[0].startswith('u:') \
+                else 'too many failures from the source'
+        with self._lock:
+            self.rejected += 1
+        logger.warning(f'{__package__} LoginThrottle rejected the login, {reason}, username={username}, '
+                       f'source={source}')
+        return False
+
+    def record_failure(self, username: str, password: str, source: Optional[str] = None) -> None:
+        """
+        Records credentials rejected by a domain controller: takes a token of the username and of the source,
+        remembers the pair for negative_ttl seconds.
+        Failures caused by unavailable domain controllers must not be recorded
+
+        :param username: an active directory username
+        :type username: str
+        :param password: the rejected password
+        :type password: str
+        :param source: a source of the login, e.g. an ip address of the client, defaults to **None**
+        :type source: str, optional
+        """
+        now: float = time.time()
+        username = self._username(username)
+        with self._lock:
+            self.failures += 1
+        if self.negative_ttl:
+            self._store.remember(self._key('p', username, password), self.negative_ttl)
+        for key, (burst, rate) in self._buckets(username, source).items():
+            self._store.take(key, burst, rate, now)
+
+    def reset(self, username: Optional[str] = None, source: Optional[str] = None) -> None:
+        """
+        Refills buckets of the username and the source, e.g. after the password of the user was reset.
+        Failed pairs of the username expire by themselves
+
+        :param username: an active directory username, defaults to **None**
+        :type username: str, optional
+        :param source: a source of logins, defaults to **None**
+        :type source: str, optional
+        """
+        if username:
+            self._store.refill(self._key('u', self._username(username)), self.username_burst, self.username_rate)
+        if source:
+            self._store.refill(self._key('s', source), self.source_burst, self.source_rate)
+
+    def clear(self) -> None:
+        """
+        Removes all buckets and failed pairs kept in the process
+        """
+        self._store.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters of the throttle
+
+        :return: a dict with keys: rejected, failures
+        :rtype: Dict[str, int]
+        """
+        return {'rejected': self.rejected, 'failures': self.failures}
+
+
+_default_throttle: Optional[LoginThrottle] = None  #: the throttle configured in settings.py
+_default_throttle_lock: threading.Lock = threading.Lock()
+
+
+def get_default_throttle() -> Optional[LoginThrottle]:
+    """
+    Returns the throttle configured by ADTOOLS_THROTTLE_* settings, or None if ADTOOLS_THROTTLE is not set.
+    With ADTOOLS_THROTTLE_CACHE hashes are keyed by SECRET_KEY, so all processes share buckets
+
+    :return: the throttle shared by the process
+    :rtype: LoginThrottle, optional
+    """
+    global _default_throttle
+    if _default_throttle is None:
+        from django.conf import settings
+        if not getattr(settings, 'ADTOOLS_THROTTLE', False):
+            return None
+        with _default_throttle_lock:
+            if _default_throttle is None:
+                cache: Optional[str] = getattr(settings, 'ADTOOLS_THROTTLE_CACHE', None)
+                _default_throttle = LoginThrottle(
+                    username_burst=getattr(settings, 'ADTOOLS_THROTTLE_USERNAME_BURST', 5),
+                    username_rate=getattr(settings, 'ADTOOLS_THROTTLE_USERNAME_RATE', 1 / 60),
+                    source_burst=getattr(settings, 'ADTOOLS_THROTTLE_SOURCE_BURST', 50),
+                    source_rate=getattr(settings, 'ADTOOLS_THROTTLE_SOURCE_RATE', 1.0),
+                    negative_ttl=getattr(settings, 'ADTOOLS_THROTTLE_NEGATIVE_TTL', 60.0),
+                    max_size=getattr(settings, 'ADTOOLS_THROTTLE_SIZE', 10000),
+                    cache=cache,
+                    secret=hashlib.sha256(f'{__package__}.throttle{settings.SECRET_KEY}'.encode()).digest()
+                    if cache else None,
+                )
+    return _default_throttle
@@ -0,0 +1,187 @@
+"""
+django_adtools/tls.py
+
+Encrypted connections to domain controllers: LDAPS (ldaps://, port 636) or StartTLS on the LDAP port,
+configured in settings.py:
+
+.. code-block:: python
+
+    ADTOOLS_LDAP_TLS: str = 'starttls'  # 'none' (the default), 'ldaps' or 'starttls'
+    ADTOOLS_LDAP_TLS_CA_FILE: str = '/etc/ssl/certs/corp-ca.pem'  # defaults to CAs of the system
+    ADTOOLS_LDAP_TLS_REQUIRE_CERT: bool = True  # verify the certificate and the name of the domain controller
+
+A full TLS handshake costs extra round trips for every new connection. Connections of the pure backend share
+one SSL context per configuration and resume TLS sessions of previous connections to the same domain controller
+(abbreviated handshakes). python-ldap connections share the global TLS context of libldap.
+"""
+__author__ = "shmakovpn <shmakovpn@yandex.ru>"
+__date__ = "2020-10-17"
+
+import ssl
+import threading
+import logging
+from collections import OrderedDict
+from .ldap_compat import ldap, PYTHON_LDAP
+# type hints
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+#: logger for this __package__
+logger = logging.getLogger(__package__)
+
+TLS_NONE: str = 'none'  #: plain LDAP
+TLS_LDAPS: str = 'ldaps'  #: TLS from the start of the connection, ldaps:// URIs
+TLS_STARTTLS: str = 'starttls'  #: the StartTLS extended operation on a plain LDAP connection
+TLS_MODES: Tuple[str, ...] = (TLS_NONE, TLS_LDAPS, TLS_STARTTLS)
+STARTTLS_OID: str = '1.3.6.1.4.1.1466.20037'  #: the StartTLS extended operation (RFC 4511 section 4.14)
+LDAPS_PORT: int = 636  #: the port of ldaps:// URIs without a port
+
+_contexts: Dict[Tuple[Optional[str], bool], ssl.SSLContext] = {}
+_contexts_lock: threading.Lock = threading.Lock()
+_python_ldap_options: Optional[Dict[int, Any]] = None  #: global options of libldap set by apply_tls
+
+
+def client_context(ca_file: Optional[str] = None, require_cert: bool = True) -> ssl.SSLContext:
+    """
+    Returns the SSL context of client connections, contexts are shared by connections with the same configuration
+    because a TLS session can be resumed only by the context which has created it
+
+    :param ca_file: a PEM file of trusted certificates, defaults to **None** (CAs of the system)
+    :type ca_file: str, optional
+    :param require_cert: verify the certificate of the server and its name, defaults to **True**
+    :type require_cert: bool
+    :rtype: ssl.SSLContext
+    :raises OSError: if the CA file can not be read
+    """
+    key: Tuple[Optional[str], bool] = (ca_file, require_cert)
+    with _contexts_lock:
+        context: Optional[ssl.SSLContext] = _contexts.get(key)
+        if context is None:
+            context = ssl.create_default_context(cafile=ca_file)
+            if not require_cert:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            _contexts[key] = context
+        return context
+
+
+class TLSSessionCache:
+    """
+    The last TLS session of every domain controller, a new connection resumes it instead of the full handshake
+
+    :param max_size: maximum number of kept sessions, the least recently used ones are dropped, defaults to **1000**
+    :type max_size: int
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size: int = max_size
+        self._sessions: 'OrderedDict[Hashable, ssl.SSLSession]' = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self.handshakes: int = 0  #: number of completed handshakes
+        self.resumed: int = 0  #: number of handshakes which have resumed a session
+
+    def get(self, key: Hashable) -> Optional[ssl.SSLSession]:
+        with self._lock:
+            session: Optional[ssl.SSLSession] = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+            return session
+
+    def set(self, key: Hashable, session: ssl.SSLSession) -> None:
+        with self._lock:
+            self._sessions[key] = session
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+
+    def record(self, resumed: bool) -> None:
+        """
+        Counts a completed handshake
+        """
+        with self._lock:
+            self.handshakes += 1
+            self.resumed += int(resumed)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters of the cache
+
+        :return: a dict with keys: sessions, handshakes, resumed
+        :rtype: Dict[str, int]
+        """
+        return {'sessions': len(self._sessions), 'handshakes': self.handshakes, 'resumed': self.resumed}
+
+
+tls_sessions: TLSSessionCache = TLSSessionCache()  #: TLS sessions of connections of the process
+
+
+def get_tls_mode() -> str:
+    """
+    Returns the mode configured by ADTOOLS_LDAP_TLS in settings.py, defaults to **none**
+
+    :rtype: str
+    :raises ValueError: if the mode is unknown
+    """
+    from django.conf import settings
+    mode: str = (getattr(settings, 'ADTOOLS_LDAP_TLS', None) or TLS_NONE).lower()
+    if mode not in TLS_MODES:
+        raise ValueError(f'{__package__} unknown ADTOOLS_LDAP_TLS={mode}, available {TLS_MODES}')
+    return mode
+
+
+def tls_options() -> Dict[int, Any]:
+    """
+    Returns python-ldap options of TLS configured by ADTOOLS_LDAP_TLS_CA_FILE and ADTOOLS_LDAP_TLS_REQUIRE_CERT
+
+    :rtype: Dict[int, Any]
+    """
+    from django.conf import settings
+    options: Dict[int, Any] = {
+        ldap.OPT_X_TLS_REQUIRE_CERT: ldap.OPT_X_TLS_DEMAND if getattr(settings, 'ADTOOLS_LDAP_TLS_REQUIRE_CERT', True)
+        else ldap.OPT_X_TLS_NEVER,
+    }
+    ca_file: Optional[str] = getattr(settings, 'ADTOOLS_LDAP_TLS_CA_FILE', None)
+    if ca_file:
+        options[ldap.OPT_X_TLS_CACERTFILE] = ca_file
+    return options
+
+
+def apply_tls(conn: ldap.ldapobject.SimpleLDAPObject) -> None:
+    """
+    Sets TLS options of settings.py on a new connection, performs StartTLS if it is configured.
+    Must be called before the bind. LDAPS needs no call of the connection, its URI is **ldaps://** (see ldap_uri)
+
+    :param conn: a new connection
+    :type conn: ldap.ldapobject.SimpleLDAPObject
+    :raises ldap.LDAPError: if StartTLS failed, e.g. ldap.CONNECT_ERROR if the certificate is not trusted
+    """
+    mode: str = get_tls_mode()
+    if mode == TLS_NONE:
+        return
+    set_tls_options(conn)
+    if mode == TLS_STARTTLS:
+        conn.start_tls_s()
+
+
+def set_tls_options(conn: ldap.ldapobject.SimpleLDAPObject) -> None:
+    """
+    Sets TLS options of settings.py on the connection. Options of a python-ldap connection take effect
+    only with a context of its own (OPT_X_TLS_NEWCTX) which can not resume sessions of other connections,
+    so they are set as global options of libldap, all connections use its global TLS context
+    """
+    global _python_ldap_options
+    options: Dict[int, Any] = tls_options()
+    for option, value in options.items():
+        conn.set_option(option, value)
+    from .pure_ldap import PureLDAPObject
+    if PYTHON_LDAP and not isinstance(conn, PureLDAPObject) and options != _python_ldap_options:
+        for option, value in options.items():
+            ldap.set_option(option, value)
+        _python_ldap_options = options
@@ -0,0 +1,13 @@
+"""
+django_adtools/urls.py
+"""
+__author__ = 'shmakovpn <shmakovpn@yandex.ru>'
+__date__ = '2020-10-11'
+
+from django.urls import path
+from . import views
+
+app_name = 'django_adtools'
+urlpatterns = [
+    path('metrics', views.metrics, name='metrics'),
+]
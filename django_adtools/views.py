@@ -1,3 +1,19 @@
-from django.shortcuts import render
+"""
+django_adtools/views.py
+"""
+__author__ = 'shmakovpn <shmakovpn@yandex.ru>'
+__date__ = '2020-10-11'
 
-# Create your views here.
+from django.http import HttpResponse, Http404
+from .instrumentation import PhaseMetrics, get_default_metrics
+from typing import Optional
+
+
+def metrics(request) -> HttpResponse:
+    """
+    Returns timings of phases of ad_login and discovery in the Prometheus text format, requires ADTOOLS_METRICS
+    """
+    phase_metrics: Optional[PhaseMetrics] = get_default_metrics()
+    if phase_metrics is None:
+        raise Http404('ADTOOLS_METRICS is not set')
+    return HttpResponse(phase_metrics.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -42,11 +42,13 @@ setup(
     install_requires=[
         'Django',
         'dnspython',
-        'python-ldap',
         'dnslib',  # using in tests like DNS Server emulator
         'unittest-dataprovider',  # using in tests like PHP @dataprovider
         # 'python-ldap-test',  # using in test like LDAP Server emulator
     ],
+    extras_require={
+        'python-ldap': ['python-ldap'],  # the default LDAP backend, the pure-Python one does not need it
+    },
     include_package_data=True,
     # test_suite='tests',
 )